@@ -0,0 +1,149 @@
+"""Admission control: per-client request rates and the upload byte budget.
+
+Requests are sorted into route classes ("poll", "upload", "admin") and each
+client gets a token bucket per class: `rate` tokens per second up to
+`burst`. A request that finds its bucket empty is refused with the number of
+seconds until a token is available (sent as Retry-After with a 429):
+
+    limiter = RateLimiter({"poll": parse_rate("20:40")})
+    retry_after = limiter.admit(client_id, "poll")   # 0.0 when admitted
+
+Upload bodies additionally draw on a byte budget shared by every upload in
+the process, so a burst of uploads cannot hold more than `max_bytes` in
+flight:
+
+    with budget.reserve(request.content_length or 0) as reservation:
+        for chunk in chunks:
+            reservation.charge(len(chunk))   # grows past the declared size
+
+Both raise or refuse instead of waiting, and are per process: with several
+workers every worker enforces its own limits.
+"""
+import threading
+import time
+
+
+class UploadBudgetExceeded(RuntimeError):
+    """Raised when an upload would take in-flight upload bytes over the budget."""
+
+
+def parse_rate(spec):
+    """(rate, burst) from "RATE[:BURST]" in requests per second, or None if disabled.
+
+    BURST defaults to twice RATE, and at least 1.
+    """
+    if not spec or not spec.strip():
+        return None
+    rate, _, burst = spec.partition(":")
+    rate = float(rate)
+    burst = float(burst) if burst.strip() else max(2 * rate, 1.0)
+    if rate < 0 or burst < 1:
+        raise ValueError(f"Invalid rate limit: {spec!r}")
+    return (rate, burst) if rate else None
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """0.0 if a token was taken, else the seconds until one is available."""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    def __init__(self, limits, max_buckets=10000, clock=time.monotonic):
+        self.limits = {route_class: limit for route_class, limit in limits.items() if limit}
+        self.max_buckets = max_buckets
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}  # (client, route class) -> TokenBucket
+
+    def admit(self, client, route_class):
+        """Take a token for `client` in `route_class`; 0.0, or seconds to wait."""
+        limit = self.limits.get(route_class)
+        if limit is None:
+            return 0.0
+        with self._lock:
+            now = self._clock()
+            bucket = self._buckets.get((client, route_class))
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._prune(now)
+                bucket = self._buckets[(client, route_class)] = TokenBucket(*limit, now)
+            return bucket.take(now)
+
+    def _prune(self, now):
+        # A full bucket is indistinguishable from a new one, so it can go
+        for key, bucket in list(self._buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self._buckets[key]
+
+
+class _Reservation:
+    def __init__(self, budget, size):
+        self._budget = budget
+        self.size = size
+        self.read = 0
+
+    def charge(self, size):
+        """Count `size` more bytes read; reserves more once past the declared size."""
+        self.read += size
+        if self.read > self.size:
+            self._budget._take(self.read - self.size, held=self.size)
+            self.size = self.read
+
+    def release(self):
+        self._budget._give(self.size)
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class ByteBudget:
+    """In-flight upload bytes, at most `max_bytes` (0: unlimited).
+
+    One upload is always admitted when nothing else is in flight, so a body
+    larger than the whole budget is refused by the size limits instead of
+    forever here.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        """Reserve `size` bytes; raises UploadBudgetExceeded if they do not fit."""
+        self._take(size)
+        return _Reservation(self, size)
+
+    def _take(self, size, held=0):
+        # `held`: bytes the caller already has in flight, which do not count as others'
+        with self._lock:
+            if self.max_bytes and self.in_flight > held and self.in_flight + size > self.max_bytes:
+                raise UploadBudgetExceeded(f"{self.in_flight} of {self.max_bytes} upload bytes in flight")
+            self.in_flight += size
+
+    def _give(self, size):
+        with self._lock:
+            self.in_flight -= size
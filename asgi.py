@@ -0,0 +1,594 @@
+"""ASGI entry point for deployments with many long-held client connections.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+The command stream (/commands/stream), /status and raw binary screenshot
+uploads are served natively on the event loop: an idle stream costs a
+coroutine instead of a worker thread, and upload bodies are spooled to disk
+as they arrive instead of pinning a thread for the whole transfer. Every
+other route is handed to the Flask app in server.py on a thread pool, so
+both entry points share state, configuration and behaviour. `server:app`
+remains the entry point for plain WSGI deployments.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from urllib.parse import parse_qs
+
+from werkzeug.exceptions import HTTPException
+
+import server
+from admission import UploadBudgetExceeded
+from auth import ALL_CLIENTS, request_token
+from compression import REQUEST_ENCODINGS, BodyDecoder
+from image_pipeline import PipelineFull
+from screenshot_store import ScreenshotTooLarge
+from state_backend import UnknownClient, DEFAULT_CLIENT_ID
+
+log = logging.getLogger("server.asgi")
+
+WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "16"))
+# How often the event loop checks for events published by other processes
+EVENT_POLL_INTERVAL = float(os.getenv("ASGI_EVENT_POLL_INTERVAL", "0.5"))
+# Request bodies handed to the WSGI app are kept in memory up to this size
+WSGI_SPOOL_SIZE = int(os.getenv("ASGI_WSGI_SPOOL_SIZE", str(1024 * 1024)))
+# Responses from the WSGI app are forwarded in pieces of about this size
+WSGI_RESPONSE_BATCH = int(os.getenv("ASGI_WSGI_RESPONSE_BATCH", str(256 * 1024)))
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class AsyncRequest:
+    """The parts of an ASGI HTTP scope the native handlers need."""
+
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.receive = receive
+        self.method = scope["method"]
+        self.path = scope["path"]
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        self.args = {name: values[-1] for name, values in query.items()}
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+        self.auth_client = None
+
+    @property
+    def mimetype(self):
+        return self.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    @property
+    def content_length(self):
+        """The declared body size, 0 without one; a malformed header is a 400."""
+        length = self.headers.get("content-length", "0").strip()
+        if not length.isdigit():
+            raise HTTPError(400, "Invalid Content-Length")
+        return int(length)
+
+    def client_id(self):
+        client_id = self.headers.get("x-client-id") or self.args.get("client_id") or self.auth_client or DEFAULT_CLIENT_ID
+        if not server.CLIENT_ID_PATTERN.fullmatch(client_id):
+            raise HTTPError(400, "Invalid client_id")
+        if self.auth_client and client_id != self.auth_client:
+            raise HTTPError(403, "Key is not valid for this client")
+        return client_id
+
+    def token(self):
+        return request_token(self.headers.get("authorization"), self.headers.get("x-key"), self.args.get("key"))
+
+    def authenticate(self, admin=False):
+        """Check the key as server.require_key does; native routes never look in the body."""
+        principal = server.tokens.authenticate(self.token())
+        if principal is None or (admin and principal != ALL_CLIENTS):
+            server.auth_rejected.inc(self.path)
+            log.warning("%s %s rejected: Invalid key", self.method, self.path)
+            raise HTTPError(403, "Invalid key")
+        self.auth_client = None if principal == ALL_CLIENTS else principal
+
+    def body_may_hold_key(self):
+        """Whether server.request_key may look for the key in the body.
+
+        Only small form or JSON bodies of requests without a key in the
+        headers or query string; gzip ones are decoded before Flask reads
+        them, so their declared size is a lower bound.
+        """
+        if self.token():
+            return False
+        return (
+            0 < self.content_length <= server.AUTH_BODY_KEY_MAX_SIZE
+            and self.headers.get("content-encoding", "").strip().lower() in ("", "identity", *REQUEST_ENCODINGS)
+            and (self.mimetype in server.FORM_MIMETYPES or self.mimetype == "application/json"
+                 or self.mimetype.endswith("+json"))
+        )
+
+    def rate_limit(self, route_class):
+        """server.rate_limit for the client named in the token, headers or query string."""
+        client_id = self.auth_client or self.headers.get("x-client-id") or self.args.get("client_id")
+        retry_after = server.rate_limiter.admit(client_id or DEFAULT_CLIENT_ID, route_class)
+        if retry_after:
+            server.rate_limited.inc(route_class)
+            log.info("%s %s rejected: %s rate limit exceeded for %s", self.method, self.path, route_class, client_id)
+            raise HTTPError(429, "Too many requests, retry later", [("Retry-After", str(math.ceil(retry_after)))])
+
+    async def iter_body(self):
+        while True:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ClientDisconnected()
+            if message.get("body"):
+                yield message["body"]
+            if not message.get("more_body"):
+                break
+
+
+async def send_response(send, status, body, content_type="text/html; charset=utf-8", headers=()):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode("latin-1")),
+            (b"content-length", str(len(body)).encode("latin-1")),
+            *[(name.encode("latin-1"), value.encode("latin-1")) for name, value in headers],
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, data, status=200, headers=()):
+    await send_response(send, status, json.dumps(data), "application/json", headers)
+
+
+class EventHub:
+    """Wakes coroutines waiting for a client's command events.
+
+    Publishes made in this process (including by the WSGI routes running on
+    the thread pool) arrive through a backend listener; publishes made by
+    other processes sharing a SQLite backend are picked up by polling the
+    backend's event watermark.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.loop = None
+        self._waiters = {}  # client_id -> asyncio.Event, replaced once set
+        self._poller = None
+
+    def start(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.backend.add_listener(self._published)
+        self._poller = self.loop.create_task(self._poll_watermark())
+
+    async def stop(self):
+        if self._poller is not None:
+            self._poller.cancel()
+
+    def _published(self, client_id):
+        # Called from whichever thread published
+        self.loop.call_soon_threadsafe(self._wake, client_id)
+
+    def _wake(self, client_id):
+        waiter = self._waiters.pop(client_id, None)
+        if waiter is not None:
+            waiter.set()
+
+    def _wake_all(self):
+        waiters, self._waiters = self._waiters, {}
+        for waiter in waiters.values():
+            waiter.set()
+
+    async def _poll_watermark(self):
+        watermark = await asyncio.to_thread(self.backend.event_watermark)
+        while True:
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+            current = await asyncio.to_thread(self.backend.event_watermark)
+            if current != watermark:
+                watermark = current
+                self._wake_all()
+
+    async def wait_until(self, client_id, check, timeout):
+        """Re-run `check()` after every change for the client until it returns
+        (True, value) or `timeout` expires; return the last value."""
+        deadline = self.loop.time() + timeout
+        while True:
+            # Take the waiter before checking so a change in between still wakes us
+            waiter = self._waiters.get(client_id)
+            if waiter is None:
+                waiter = self._waiters[client_id] = asyncio.Event()
+            done, value = await asyncio.to_thread(check)
+            remaining = deadline - self.loop.time()
+            if done or remaining <= 0:
+                return value
+            try:
+                await asyncio.wait_for(waiter.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def wait_for_events(self, client_id, since, timeout):
+        """Async counterpart of StateBackend.wait_for_events."""
+        def check():
+            events = self.backend.wait_for_events(client_id, since, 0)
+            return bool(events), events
+        return await self.wait_until(client_id, check, timeout)
+
+    async def wait_for_version(self, client_id, since, timeout):
+        """Async counterpart of StateBackend.wait_for_version."""
+        def check():
+            version = self.backend.version(client_id)
+            return version != since, version
+        return await self.wait_until(client_id, check, timeout)
+
+
+hub = EventHub(server.state)
+wsgi_executor = ThreadPoolExecutor(max_workers=WSGI_THREADS, thread_name_prefix="wsgi")
+
+
+async def command_stream(request, send):
+    """Native /commands/stream; same protocol as server.command_stream."""
+    request.authenticate()
+    request.rate_limit("poll")
+    client_id = request.client_id()
+    await asyncio.to_thread(server.state.head, client_id)  # 404 before the stream starts
+    since = request.headers.get("last-event-id") or request.args.get("since")
+    try:
+        timeout = server.parse_stream_timeout(request.args)
+    except ValueError:
+        raise HTTPError(400, "Invalid timeout")
+
+    resumable = since is not None and since.isdigit() and await asyncio.to_thread(
+        server.state.events_resumable, client_id, int(since)
+    )
+    if not resumable:
+        initial, last_id = await asyncio.to_thread(server.command_snapshot, client_id)
+    else:
+        initial, last_id = [], int(since)
+
+    async def next_events(last_id):
+        events = await hub.wait_for_events(client_id, last_id, timeout)
+        return await asyncio.to_thread(server.consume_command_events, client_id, events)
+
+    if request.args.get("mode") == "poll":
+        events = initial or await next_events(last_id)
+        if events:
+            last_id = max(last_id, events[-1]["id"])
+        await send_json(send, {"events": events, "last_id": last_id}, headers=[("Cache-Control", "no-store")])
+        return
+
+    async def stream(last_id):
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream; charset=utf-8"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        for event in initial:
+            await send({"type": "http.response.body", "body": server.format_sse(event).encode(), "more_body": True})
+        while True:
+            events = await next_events(last_id)
+            if not events:
+                await send({"type": "http.response.body", "body": b": keepalive\n\n", "more_body": True})
+                continue
+            body = "".join(server.format_sse(event) for event in events)
+            await send({"type": "http.response.body", "body": body.encode(), "more_body": True})
+            last_id = events[-1]["id"]
+
+    async def wait_for_disconnect():
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+
+    tasks = [asyncio.ensure_future(stream(last_id)), asyncio.ensure_future(wait_for_disconnect())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+
+async def status(request, send):
+    """Native /status; same ETag / ?since= handling as server.versioned_response."""
+    request.authenticate()
+    request.rate_limit("poll")
+    client_id = request.client_id()
+    try:
+        since, timeout = server.parse_since(request.args)
+    except ValueError:
+        raise HTTPError(400, "Invalid since or timeout parameter")
+
+    if since is None:
+        version = await asyncio.to_thread(server.state.version, client_id)
+    else:
+        version = await hub.wait_for_version(client_id, since, timeout)
+    etag = f'"{version}"'
+    if version == since or etag in request.headers.get("if-none-match", ""):
+        await send_response(send, 304, b"", headers=[("ETag", etag)])
+        return
+
+    status_info = await asyncio.to_thread(server.build_status, client_id)
+    status_info["version"] = version
+    body, encoding = server.compress_body(json.dumps(status_info).encode("utf-8"), request.headers.get("accept-encoding"))
+    headers = [("Cache-Control", "no-cache")]
+    if encoding is not None:
+        headers += [("Content-Encoding", encoding), ("Vary", "Accept-Encoding")]
+        etag = f"W/{etag}"
+    await send_response(send, 200, body, "application/json", headers=[("ETag", etag), *headers])
+
+
+async def upload_screenshot(request, send):
+    """Native raw-body /upload_screenshot; the body is spooled to disk as it arrives."""
+    log.debug("Received screenshot upload")
+    request.authenticate()
+    request.rate_limit("upload")
+    timestamp = request.headers.get("x-timestamp") or request.args.get("timestamp") or datetime.now().isoformat()
+    client_id = request.client_id()
+    capture_id = request.headers.get("x-capture-id") or request.args.get("capture_id")
+    store = await asyncio.to_thread(server.screenshot_store_for, client_id)
+    if store.max_bytes and request.content_length > store.max_bytes:
+        raise HTTPError(413, f"Screenshot of {request.content_length} bytes exceeds the {store.max_bytes} byte budget")
+
+    known_hash = request.headers.get("x-content-sha256")
+    if known_hash:
+        entry = await asyncio.to_thread(server.ingest_known_screenshot, client_id, store, known_hash, timestamp, capture_id)
+        if entry is not None:
+            log.info("Duplicate screenshot recorded by hash. Total screenshots: %d", len(store))
+            await send_upload_response(send, entry)
+            return
+        if request.headers.get("content-length", "0") == "0" and "transfer-encoding" not in request.headers:
+            raise HTTPError(404, "Unknown screenshot hash")
+
+    encoding = request.headers.get("content-encoding", "").strip().lower()
+    if encoding not in ("", "identity", *REQUEST_ENCODINGS):
+        raise HTTPError(415, f"Unsupported Content-Encoding: {encoding}")
+    decoder = BodyDecoder(server.DECODED_BODY_MAX_SIZE) if encoding in REQUEST_ENCODINGS else None
+
+    try:
+        reservation = server.admit_upload(request.content_length)
+    except PipelineFull as e:
+        raise pipeline_full(e)
+    except UploadBudgetExceeded as e:
+        raise upload_budget_exceeded(e)
+    with reservation, tempfile.TemporaryFile() as spool:
+        size = 0
+
+        async def write(data):
+            nonlocal size
+            size += len(data)
+            if store.max_bytes and size > store.max_bytes:
+                raise HTTPError(413, f"Screenshot exceeds the {store.max_bytes} byte budget")
+            reservation.charge(len(data))
+            await asyncio.to_thread(spool.write, data)
+
+        try:
+            async for chunk in request.iter_body():
+                if decoder is None:
+                    await write(chunk)
+                    continue
+                data = decoder.decode(chunk)
+                while data:
+                    await write(data)
+                    data = decoder.decode(b"") if decoder.pending else b""
+            if decoder is not None:
+                await write(decoder.finish())
+        except HTTPException as e:  # body not gzip or too large once decoded
+            log.info("Screenshot upload rejected: %s", e.description)
+            raise HTTPError(e.code, e.description)
+        except UploadBudgetExceeded as e:
+            raise upload_budget_exceeded(e)
+
+        def ingest():
+            spool.seek(0)
+            return server.ingest_screenshot(client_id, store, server.iter_upload_chunks(spool), timestamp, capture_id)
+
+        try:
+            entry = await asyncio.to_thread(ingest)
+        except ScreenshotTooLarge as e:
+            log.warning("Screenshot upload rejected: %s", e)
+            raise HTTPError(413, str(e))
+        except PipelineFull as e:
+            raise pipeline_full(e)
+
+    if entry is None:
+        log.info("Screenshot upload rejected: Empty body")
+        raise HTTPError(400, "Missing screenshot data")
+    log.info("Screenshot stored successfully (%d bytes). Total screenshots: %d", entry['size'], len(store))
+    await send_upload_response(send, entry)
+
+
+def pipeline_full(e):
+    message, status, headers = server.image_pipeline_full(e)
+    return HTTPError(status, message, list(headers.items()))
+
+
+def upload_budget_exceeded(e):
+    message, status, headers = server.upload_budget_exceeded(e)
+    return HTTPError(status, message, list(headers.items()))
+
+
+async def send_upload_response(send, entry):
+    await send_response(send, 200, "Screenshot uploaded successfully", headers=[
+        ("X-Screenshot-Id", str(entry["id"])),
+        ("X-Content-SHA256", entry["sha256"]),
+    ])
+
+
+def native_handler(request):
+    if request.path == "/commands/stream" and request.method == "GET":
+        return command_stream
+    if request.path == "/status" and request.method == "GET":
+        return status
+    if (request.path == "/upload_screenshot" and request.method == "POST"
+            and request.mimetype not in ("application/json", "multipart/form-data")):
+        return upload_screenshot
+    return None
+
+
+def required_key(request):
+    """"admin" or "client" if the Flask route for `request` checks a key, else None."""
+    try:
+        endpoint, _ = server.app.url_map.bind("localhost").match(request.path, method=request.method)
+    except HTTPException:  # 404, 405 and redirects are Flask's to answer
+        return None
+    return getattr(server.app.view_functions.get(endpoint), "required_key", None)
+
+
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server_name,
+        "SERVER_PORT": str(server_port),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+async def call_wsgi(request, send):
+    """Run the Flask app for one request on the WSGI thread pool."""
+    # A bad key is refused before the body is buffered; keys in small
+    # bodies are still checked by Flask
+    required = required_key(request)
+    if required and not request.body_may_hold_key():
+        request.authenticate(admin=required == "admin")
+    max_size = server.MAX_REQUEST_SIZE
+    if max_size and request.content_length > max_size:
+        raise HTTPError(413, "Request body too large")
+    with tempfile.SpooledTemporaryFile(max_size=WSGI_SPOOL_SIZE) as body:
+        size = 0
+        async for chunk in request.iter_body():
+            size += len(chunk)
+            if max_size and size > max_size:
+                raise HTTPError(413, "Request body too large")
+            body.write(chunk)
+        body.seek(0)
+        environ = wsgi_environ(request.scope, body)
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = headers
+
+        def read_batch(chunks):
+            # Join small chunks (e.g. send_file blocks) so each hop to the
+            # thread pool moves a useful amount; None once exhausted
+            batch = []
+            size = 0
+            for chunk in chunks:
+                batch.append(chunk)
+                size += len(chunk)
+                if size >= WSGI_RESPONSE_BATCH:
+                    break
+            return b"".join(batch) if batch else None
+
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(wsgi_executor, server.app, environ, start_response)
+        chunks = iter(result)
+        try:
+            # Large responses (e.g. spooled /latest content) are passed on
+            # as they are produced instead of being joined in memory
+            content = await loop.run_in_executor(wsgi_executor, read_batch, chunks)
+            await send({
+                "type": "http.response.start",
+                "status": started["status"],
+                "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in started["headers"]],
+            })
+            while True:
+                following = None if content is None else await loop.run_in_executor(wsgi_executor, read_batch, chunks)
+                await send({"type": "http.response.body", "body": content or b"", "more_body": following is not None})
+                if following is None:
+                    break
+                content = following
+        finally:
+            if hasattr(result, "close"):
+                await loop.run_in_executor(wsgi_executor, result.close)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            hub.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await hub.stop()
+            wsgi_executor.shutdown(wait=False)
+            await asyncio.to_thread(server.image_pipeline.shutdown)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+def instrumented(request, send):
+    """Wrap `send` to record request metrics for a natively served route."""
+    started = time.perf_counter()
+
+    async def send_and_record(message):
+        if message["type"] == "http.response.start":
+            headers = dict(message.get("headers", ()))
+            size = int(headers[b"content-length"]) if b"content-length" in headers else None
+            server.observe_request(request.method, request.path, message["status"], time.perf_counter() - started, size)
+        await send(message)
+
+    return send_and_record
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    hub.start()  # for servers that skip the lifespan protocol
+    request = AsyncRequest(scope, receive)
+    handler = native_handler(request)
+    if handler is None:
+        handler = call_wsgi  # the Flask app records its own metrics
+    else:
+        send = instrumented(request, send)
+    try:
+        await handler(request, send)
+    except HTTPError as e:
+        await send_response(send, e.status, e.message, headers=e.headers)
+    except UnknownClient as e:
+        await send_response(send, 404, f"Unknown client: {e.args[0]}")
+    except ClientDisconnected:
+        pass
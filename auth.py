@@ -0,0 +1,96 @@
+"""Request authentication: the shared key and per-client tokens.
+
+The shared key (SECRET_KEY) is valid for every client and for admin
+routes. Per-client tokens are valid only for the client they are issued to.
+They are configured as a JSON file or inline pairs:
+
+    CLIENT_TOKENS=tokens.json              # {"laptop": "s3cret", ...}
+    CLIENT_TOKENS="laptop=s3cret,desk=0ther"
+
+    tokens = TokenTable(SECRET_KEY, load_client_tokens(os.getenv("CLIENT_TOKENS")))
+    principal = tokens.authenticate(request_token(authorization, x_key, query_key))
+    # None (rejected), ALL_CLIENTS (shared key) or the token's client id
+
+Tokens are looked up by their SHA-256 digest in a table built once at
+startup. Comparing digests rather than the tokens leaks nothing about how
+much of a guess matched, and the shared key is checked with
+hmac.compare_digest.
+"""
+import hashlib
+import hmac
+import json
+import os
+import re
+
+# Principal of the shared key; never a valid client id
+ALL_CLIENTS = "*"
+
+# Client ids appear in URLs and screenshot directory names; the leading
+# alphanumeric rules out "." and ".."
+CLIENT_ID_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9_.-]{0,63}')
+
+
+def _digest(token):
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def load_client_tokens(spec):
+    """{client_id: token} from a JSON file path or "client=token,..." pairs.
+
+    Raises ValueError for malformed entries and ids that are not valid client
+    ids, since a token for one could never be used.
+    """
+    if not spec:
+        return {}
+    if os.path.isfile(spec):
+        with open(spec) as f:
+            tokens = json.load(f)
+        if not isinstance(tokens, dict):
+            raise ValueError(f"{spec} must hold an object of client id -> token")
+        tokens = {client_id: str(token) for client_id, token in tokens.items()}
+    else:
+        tokens = {}
+        for pair in spec.split(","):
+            client_id, separator, token = pair.strip().partition("=")
+            if not separator or not client_id or not token:
+                raise ValueError(f"Malformed client token entry: {pair.strip()!r}")
+            tokens[client_id] = token
+    for client_id in tokens:
+        if not CLIENT_ID_PATTERN.fullmatch(client_id):
+            raise ValueError(f"Invalid client id for a token: {client_id!r}")
+    return tokens
+
+
+def request_token(authorization=None, x_key=None, query_key=None):
+    """The token a request carries in headers or the query string, or None.
+
+    Authorization: Bearer <token> wins over X-Key, which wins over ?key=.
+    """
+    if authorization:
+        scheme, _, credentials = authorization.partition(" ")
+        if scheme.lower() == "bearer" and credentials.strip():
+            return credentials.strip()
+    return x_key or query_key or None
+
+
+class TokenTable:
+    def __init__(self, shared_key, client_tokens=None):
+        self._shared = _digest(shared_key)
+        self._clients = {}
+        for client_id, token in (client_tokens or {}).items():
+            digest = _digest(token)
+            if hmac.compare_digest(digest, self._shared) or digest in self._clients:
+                raise ValueError(f"Token for client {client_id} is not unique")
+            self._clients[digest] = client_id
+
+    def __len__(self):
+        return len(self._clients)
+
+    def authenticate(self, token):
+        """ALL_CLIENTS for the shared key, a client id for its token, else None."""
+        if not isinstance(token, str) or not token:
+            return None
+        digest = _digest(token)
+        if hmac.compare_digest(digest, self._shared):
+            return ALL_CLIENTS
+        return self._clients.get(digest)
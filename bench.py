@@ -0,0 +1,583 @@
+"""Load tests and benchmarks for the server's hot paths.
+
+    python bench.py                                   # every scenario, Flask test client
+    python bench.py --target gunicorn --clients 32 --duration 20
+    python bench.py --target all --scenarios poll,upload --upload-size 500000
+    python bench.py --baseline bench-main.json        # exit 1 on a regression
+
+Scenarios run `--clients` simulated clients (one thread each, with its own
+client id) for `--duration` seconds after `--warmup` seconds that are not
+measured:
+
+    poll       GET /check_screenshot_command, /check_kill_switch and /status
+    submit     POST /submit, GET /next, POST /acknowledge
+    upload     POST /upload_screenshot with raw images of --upload-size bytes
+    dashboard  GET / and /dashboard/state with --gallery screenshots stored
+
+Targets are the Flask test client in this process ("flask") and a gunicorn
+server started on a free local port ("gunicorn"). Each target gets fresh
+state, screenshots and content spool in a temporary directory; gunicorn
+with more than one worker uses the sqlite and disk backends so the workers
+share them. Results (throughput, p50/p99/max latency overall and per
+endpoint, status counts and the peak RSS of the server's process tree) are
+printed and written as JSON to --output. With --baseline, throughput lower
+or p99 higher than the baseline's by more than --tolerance is reported as a
+regression.
+"""
+import argparse
+import collections
+import io
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import http.client
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it uploads are random bytes
+    Image = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("poll", "submit", "upload", "dashboard")
+TARGETS = ("flask", "gunicorn")
+BENCH_KEY = "bench-key"
+GALLERY_CLIENT = "bench-gallery"
+RSS_SAMPLE_INTERVAL = 0.05
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(latencies):
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+        "max_ms": ms(latencies[-1] if latencies else None),
+    }
+
+
+def tree_rss(pid):
+    """Resident bytes of `pid` and all its descendants; None without /proc."""
+    parents = collections.defaultdict(list)
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces; fields resume after ')'
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        parents[ppid].append(int(entry))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            continue
+        pending.extend(parents.get(current, ()))
+    return total
+
+
+class RSSSampler:
+    """Track the peak RSS of a process tree on a background thread."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = tree_rss(pid)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(RSS_SAMPLE_INTERVAL):
+            rss = tree_rss(self.pid)
+            if rss is not None and (self.peak is None or rss > self.peak):
+                self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+class Recorder:
+    """Latencies and status codes per endpoint for one simulated client."""
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.statuses = collections.defaultdict(collections.Counter)
+        self.enabled = False
+
+    def add(self, label, status, latency):
+        if self.enabled:
+            self.latencies[label].append(latency)
+            self.statuses[label][status] += 1
+
+
+class Session:
+    """One simulated client's connection; `request` returns (status, headers, body)."""
+
+    def __init__(self, recorder):
+        self.recorder = recorder
+
+    def request(self, method, path, label=None, query=None, headers=None, body=None):
+        if query:
+            path = f"{path}?{urlencode(query)}"
+        started = time.perf_counter()
+        try:
+            status, response_headers, data = self._send(method, path, headers or {}, body)
+        except (OSError, http.client.HTTPException):
+            status, response_headers, data = 0, {}, b""
+        self.recorder.add(label or f"{method} {path.split('?')[0]}", status, time.perf_counter() - started)
+        return status, response_headers, data
+
+    def close(self):
+        pass
+
+
+class FlaskSession(Session):
+    def __init__(self, recorder, app):
+        super().__init__(recorder)
+        self.client = app.test_client()
+
+    def _send(self, method, path, headers, body):
+        response = self.client.open(path, method=method, headers=headers, data=body)
+        try:
+            return response.status_code, response.headers, response.get_data()
+        finally:
+            response.close()
+
+
+class HTTPSession(Session):
+    def __init__(self, recorder, port):
+        super().__init__(recorder)
+        self.connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    def _send(self, method, path, headers, body):
+        try:
+            self.connection.request(method, path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            return response.status, response.headers, response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()  # reconnects on the next request
+            raise
+
+    def close(self):
+        self.connection.close()
+
+
+def server_env(root, backend, screenshot_backend, log_level):
+    return {
+        "SECRET_KEY": BENCH_KEY,
+        "STATE_BACKEND": backend,
+        "STATE_DB_PATH": os.path.join(root, "state.db"),
+        "STATE_JOURNAL_DIR": "",
+        "SCREENSHOT_BACKEND": screenshot_backend,
+        "SCREENSHOT_DIR": os.path.join(root, "screenshots"),
+        "CONTENT_SPOOL_DIR": os.path.join(root, "content-spool"),
+        "LOG_LEVEL": log_level,
+        # Measure the server, not its admission control
+        "RATE_LIMIT_POLL": "",
+        "RATE_LIMIT_UPLOAD": "",
+        "RATE_LIMIT_ADMIN": "",
+        "UPLOAD_BUDGET_BYTES": "0",
+    }
+
+
+class FlaskTarget:
+    """The Flask app imported into this process, driven by its test client."""
+
+    name = "flask"
+
+    def __init__(self, args, root):
+        self.config = {"state_backend": args.state_backend or "memory",
+                       "screenshot_backend": args.screenshot_backend or "memory"}
+        # server.py reads its configuration at import time
+        os.environ.update(server_env(root, self.config["state_backend"],
+                                     self.config["screenshot_backend"], args.log_level))
+        import server
+        self.app = server.app
+        self.pid = os.getpid()
+
+    def session(self, recorder):
+        return FlaskSession(recorder, self.app)
+
+    def close(self):
+        pass
+
+
+class GunicornTarget:
+    """A gunicorn server for server:app on a free local port."""
+
+    name = "gunicorn"
+
+    def __init__(self, args, root):
+        shared = args.workers > 1
+        self.config = {
+            "workers": args.workers,
+            "threads": args.threads,
+            "state_backend": args.state_backend or ("sqlite" if shared else "memory"),
+            "screenshot_backend": args.screenshot_backend or ("disk" if shared else "memory"),
+        }
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        env = dict(os.environ, **server_env(root, self.config["state_backend"],
+                                            self.config["screenshot_backend"], args.log_level))
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "server:app",
+             "--bind", f"127.0.0.1:{self.port}",
+             "--workers", str(args.workers), "--threads", str(args.threads),
+             "--log-level", "warning"],
+            cwd=HERE, env=env,
+        )
+        self.pid = self.process.pid
+        self._wait_ready()
+
+    def _wait_ready(self, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with status {self.process.returncode}")
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=5)
+                connection.request("GET", f"/check_kill_switch?key={BENCH_KEY}")
+                if connection.getresponse().status == 200:
+                    connection.close()
+                    return
+            except OSError:
+                pass
+            time.sleep(0.1)
+        self.close()
+        raise RuntimeError("gunicorn did not become ready")
+
+    def session(self, recorder):
+        return HTTPSession(recorder, self.port)
+
+    def close(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Images:
+    """Upload bodies of about `size` bytes, each with a distinct SHA-256.
+
+    A few noise images are encoded up front; bytes appended after the end
+    of the image make every upload unique (so none are deduplicated) without
+    encoding a new image each time.
+    """
+
+    def __init__(self, size, seed, variants=4):
+        rng = random.Random(seed)
+        self._bodies = [self._encode(size, rng) for _ in range(variants)]
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _encode(size, rng):
+        if Image is None:
+            return rng.randbytes(size)
+        side = max(1, int((size / 3) ** 0.5))
+        image = Image.frombytes("RGB", (side, side), rng.randbytes(side * side * 3))
+        output = io.BytesIO()
+        image.save(output, format="PNG", compress_level=1)
+        return output.getvalue()
+
+    def next(self):
+        with self._lock:
+            self._counter += 1
+            n = self._counter
+        return self._bodies[n % len(self._bodies)] + n.to_bytes(8, "big")
+
+
+def random_text(length, seed):
+    rng = random.Random(seed)
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz     \n") for _ in range(length)).strip() or "x"
+
+
+def register(session, client_id):
+    status, _, _ = session.request(
+        "POST", "/clients/register", body=urlencode({"key": BENCH_KEY, "client_id": client_id, "name": client_id}),
+        headers={"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    if status != 200:
+        raise RuntimeError(f"Registering {client_id} failed with status {status}")
+
+
+def upload(session, client_id, body, label=None):
+    return session.request(
+        "POST", "/upload_screenshot", label,
+        headers={"X-Key": BENCH_KEY, "X-Client-Id": client_id, "Content-Type": "application/octet-stream"},
+        body=body,
+    )
+
+
+def poll_step(session, client_id, context):
+    query = {"key": BENCH_KEY, "client_id": client_id}
+    session.request("GET", "/check_screenshot_command", query=query)
+    session.request("GET", "/check_kill_switch", query=query)
+    session.request("GET", "/status", query=query)
+
+
+def submit_step(session, client_id, context):
+    form = {"content": context["content"], "client_id": client_id}
+    session.request("POST", "/submit", body=urlencode(form),
+                    headers={"Content-Type": "application/x-www-form-urlencoded"})
+    session.request("GET", "/next", query={"key": BENCH_KEY, "client_id": client_id})
+    session.request("POST", "/acknowledge", body=urlencode({"key": BENCH_KEY, "client_id": client_id}),
+                    headers={"Content-Type": "application/x-www-form-urlencoded"})
+
+
+def upload_step(session, client_id, context):
+    status, headers, _ = upload(session, client_id, context["images"].next())
+    if status == 503:
+        # Back off as the server asks, like a real client would
+        time.sleep(float(headers.get("Retry-After") or 1))
+
+
+def dashboard_setup(session, context):
+    register(session, GALLERY_CLIENT)
+    for _ in range(context["gallery"]):
+        status, headers, _ = upload(session, GALLERY_CLIENT, context["images"].next())
+        while status == 503:
+            time.sleep(float(headers.get("Retry-After") or 1))
+            status, headers, _ = upload(session, GALLERY_CLIENT, context["images"].next())
+
+
+def dashboard_step(session, client_id, context):
+    session.request("GET", "/", query={"client_id": GALLERY_CLIENT})
+    session.request("GET", "/dashboard/state", query={"key": BENCH_KEY, "client_id": GALLERY_CLIENT})
+
+
+STEPS = {
+    "poll": (None, poll_step),
+    "submit": (None, submit_step),
+    "upload": (None, upload_step),
+    "dashboard": (dashboard_setup, dashboard_step),
+}
+
+
+def run_scenario(target, scenario, args, context):
+    setup, step = STEPS[scenario]
+    if setup is not None:
+        session = target.session(Recorder())
+        try:
+            setup(session, context)
+        finally:
+            session.close()
+
+    recorders = [Recorder() for _ in range(args.clients)]
+    measuring = threading.Event()
+    stop = threading.Event()
+    ready = threading.Barrier(args.clients + 1)
+
+    def simulate(index, recorder):
+        session = target.session(recorder)
+        client_id = f"bench-{scenario}-{index}"
+        try:
+            register(session, client_id)
+            ready.wait()
+            while not stop.is_set():
+                recorder.enabled = measuring.is_set()
+                step(session, client_id, context)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=simulate, args=(index, recorder), daemon=True)
+               for index, recorder in enumerate(recorders)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    time.sleep(args.warmup)
+    with RSSSampler(target.pid) as rss:
+        measuring.set()
+        started = time.perf_counter()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+    latencies = collections.defaultdict(list)
+    statuses = collections.defaultdict(collections.Counter)
+    for recorder in recorders:
+        for label, values in recorder.latencies.items():
+            latencies[label].extend(values)
+            statuses[label].update(recorder.statuses[label])
+
+    def summary(values, counts):
+        return dict(
+            requests=len(values),
+            errors=sum(n for status, n in counts.items() if not 200 <= status < 400),
+            throughput_rps=round(len(values) / elapsed, 2),
+            statuses={str(status): n for status, n in sorted(counts.items())},
+            **latency_summary(values),
+        )
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    all_statuses = sum(statuses.values(), collections.Counter())
+    return dict(
+        summary(all_latencies, all_statuses),
+        elapsed_s=round(elapsed, 3),
+        peak_rss_bytes=rss.peak,
+        endpoints={label: summary(values, statuses[label]) for label, values in sorted(latencies.items())},
+    )
+
+
+def run_target(target_class, args):
+    with tempfile.TemporaryDirectory(prefix=f"bench-{target_class.name}-") as root:
+        target = target_class(args, root)
+        try:
+            context = {
+                "images": Images(args.upload_size, args.seed),
+                "content": random_text(args.content_size, args.seed),
+                "gallery": args.gallery,
+            }
+            results = {}
+            for scenario in args.scenarios:
+                print(f"{target.name}: {scenario} ({args.clients} clients, {args.duration}s)", file=sys.stderr)
+                results[scenario] = run_scenario(target, scenario, args, context)
+                print(format_result(results[scenario]), file=sys.stderr)
+            return {"config": target.config, "scenarios": results}
+        finally:
+            target.close()
+
+
+def format_result(result):
+    rss = f"{result['peak_rss_bytes'] / 2 ** 20:.1f} MiB" if result["peak_rss_bytes"] is not None else "n/a"
+    lines = [f"  {result['throughput_rps']:>9.1f} req/s  p50 {result['p50_ms']} ms  p99 {result['p99_ms']} ms  "
+             f"errors {result['errors']}/{result['requests']}  peak RSS {rss}"]
+    for label, endpoint in result["endpoints"].items():
+        lines.append(f"    {label:<32} {endpoint['throughput_rps']:>9.1f} req/s  "
+                     f"p50 {endpoint['p50_ms']} ms  p99 {endpoint['p99_ms']} ms")
+    return "\n".join(lines)
+
+
+def compare(results, baseline, tolerance):
+    """Return regression messages for scenarios present in both result sets."""
+    regressions = []
+    for target, current in results["targets"].items():
+        previous = baseline.get("targets", {}).get(target)
+        if previous is None:
+            continue
+        for scenario, result in current["scenarios"].items():
+            before = previous["scenarios"].get(scenario)
+            if before is None:
+                continue
+            if result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+                regressions.append(f"{target}/{scenario}: throughput {result['throughput_rps']} req/s "
+                                   f"(baseline {before['throughput_rps']})")
+            if None not in (result["p99_ms"], before["p99_ms"]) and result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+                regressions.append(f"{target}/{scenario}: p99 {result['p99_ms']} ms (baseline {before['p99_ms']})")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--target", choices=TARGETS + ("all",), default="flask")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--clients", type=int, default=8, help="simulated clients per scenario")
+    parser.add_argument("--duration", type=float, default=10, help="measured seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=1, help="unmeasured seconds before each scenario")
+    parser.add_argument("--upload-size", type=int, default=200 * 1024, help="approximate screenshot size in bytes")
+    parser.add_argument("--content-size", type=int, default=200, help="characters per submitted item")
+    parser.add_argument("--gallery", type=int, default=50, help="screenshots stored for the dashboard scenario")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--state-backend", choices=("memory", "sqlite"))
+    parser.add_argument("--screenshot-backend", choices=("memory", "disk"))
+    parser.add_argument("--log-level", default="WARNING", help="server LOG_LEVEL during the run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file ('-' for stdout)")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    targets = {"flask": FlaskTarget, "gunicorn": GunicornTarget}
+    names = TARGETS if args.target == "all" else (args.target,)
+    # gunicorn first: the Flask target imports the server into this process
+    names = sorted(names, key=lambda name: name != "gunicorn")
+
+    results = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pillow": Image is not None,
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "targets": {},
+    }
+    for name in names:
+        results["targets"][name] = run_target(targets[name], args)
+
+    output = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+        print(f"Results written to {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print(f"REGRESSION {message}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
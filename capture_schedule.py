@@ -0,0 +1,141 @@
+"""Capture schedules: one-shot, burst and interval screenshot requests.
+
+A schedule asks for `count` captures (None: until stopped), the first at
+`start` and then one every `interval` seconds; a burst is a schedule with a
+short interval, a one-shot has count 1. Capture n of schedule s has the id
+"s:n" and is due at start + n * interval. State backends store schedules as
+dicts with a ``fulfilled`` dict (n -> capture latency in seconds) and
+``settled`` totals; the functions here derive everything else from those:
+
+    due_captures(schedule, now)     # what the client should capture next
+    schedule_summary(schedule, now) # fulfilled / dropped / pending counts
+
+A capture that is still unfulfilled `grace` seconds after it was due counts
+as dropped and is no longer handed out. Past that point a capture cannot
+change any more, so schedules that run until stopped fold their older
+``fulfilled`` entries into ``settled`` (see settle) instead of keeping one
+entry per capture forever.
+"""
+import math
+
+CAPTURE_GRACE = 30.0
+
+
+def capture_id(schedule_id, n):
+    return f"{schedule_id}:{n}"
+
+
+def parse_capture_id(value):
+    """Return (schedule_id, n) for a capture id; raises ValueError if malformed."""
+    schedule_id, n = value.split(":")
+    return int(schedule_id), int(n)
+
+
+def schedule_ends_at(start, interval, count):
+    """Due time of the last capture, or None for a schedule that runs until stopped."""
+    if count is None:
+        return None
+    return start + interval * (count - 1)
+
+
+def new_settled():
+    """Empty ``settled`` totals for a new schedule."""
+    return {"before": 0, "fulfilled": 0, "latency_sum": 0.0, "latency_max": None}
+
+
+def settle_point(schedule, now, grace=CAPTURE_GRACE):
+    """Capture number below which ``fulfilled`` entries can be settled.
+
+    0 for schedules with a count, which hold at most `count` entries.
+    """
+    if schedule["count"] is not None:
+        return 0
+    return _last_n(schedule, now - grace) + 1
+
+
+def settle(schedule, before):
+    """Fold the fulfilled captures numbered below `before` into schedule["settled"]."""
+    settled = schedule["settled"]
+    if before <= settled["before"]:
+        return
+    for n in [n for n in schedule["fulfilled"] if n < before]:
+        latency = schedule["fulfilled"].pop(n)
+        settled["fulfilled"] += 1
+        settled["latency_sum"] += latency
+        settled["latency_max"] = max(latency, settled["latency_max"] or 0.0)
+    settled["before"] = before
+
+
+def _due(schedule, n):
+    return schedule["start"] + n * schedule["interval"]
+
+
+def _last_n(schedule, until):
+    """Highest capture number due at or before `until` (-1 if none)."""
+    if until < schedule["start"]:
+        return -1
+    ends_at = schedule["ends_at"]
+    if ends_at is not None:
+        until = min(until, ends_at)
+    if schedule["interval"] <= 0:
+        return (schedule["count"] or 1) - 1
+    last = math.floor((until - schedule["start"]) / schedule["interval"] + 1e-9)
+    if schedule["count"] is not None:
+        last = min(last, schedule["count"] - 1)
+    return last
+
+
+def due_captures(schedule, now, horizon=0.0, limit=20, grace=CAPTURE_GRACE):
+    """Return [{"id", "due"}] for unfulfilled captures due from `now - grace`
+    up to `now + horizon`, oldest first."""
+    first = _last_n(schedule, now - grace) + 1
+    last = _last_n(schedule, now + horizon)
+    captures = []
+    for n in range(first, last + 1):
+        if n not in schedule["fulfilled"]:
+            captures.append({"id": capture_id(schedule["id"], n), "due": _due(schedule, n)})
+            if len(captures) >= limit:
+                break
+    return captures
+
+
+def next_due(schedule, now):
+    """Due time of the first capture after `now`, or None if there is none."""
+    n = _last_n(schedule, now) + 1
+    due = _due(schedule, n)
+    if schedule["interval"] <= 0 or (schedule["ends_at"] is not None and due > schedule["ends_at"]):
+        return None
+    return due
+
+
+def is_active(schedule, now, grace=CAPTURE_GRACE):
+    return schedule["ends_at"] is None or schedule["ends_at"] >= now - grace
+
+
+def schedule_summary(schedule, now, grace=CAPTURE_GRACE):
+    """Public view of a schedule with fulfilled / dropped / pending counts."""
+    overdue = _last_n(schedule, now - grace) + 1
+    due = _last_n(schedule, now) + 1
+    settled = schedule["settled"]
+    fulfilled = schedule["fulfilled"]
+    fulfilled_count = settled["fulfilled"] + len(fulfilled)
+    # Settled captures all come before `overdue`
+    fulfilled_overdue = settled["fulfilled"] + sum(1 for n in fulfilled if n < overdue)
+    latencies = list(fulfilled.values())
+    if settled["latency_max"] is not None:
+        latencies.append(settled["latency_max"])
+    return {
+        "id": schedule["id"],
+        "start": schedule["start"],
+        "interval": schedule["interval"],
+        "count": schedule["count"],
+        "ends_at": schedule["ends_at"],
+        "stopped": schedule["stopped"],
+        "active": is_active(schedule, now, grace),
+        "next_due": next_due(schedule, now),
+        "fulfilled": fulfilled_count,
+        "dropped": overdue - fulfilled_overdue,
+        "pending": due - overdue - (fulfilled_count - fulfilled_overdue),
+        "latency_avg": (settled["latency_sum"] + sum(fulfilled.values())) / fulfilled_count if fulfilled_count else None,
+        "latency_max": max(latencies) if latencies else None,
+    }
@@ -0,0 +1,222 @@
+"""Content-Encoding for responses and request bodies.
+
+Responses are compressed with the best encoding the client accepts from
+ENCODINGS (zstd and br only when the zstandard / brotli packages are
+installed, gzip always):
+
+    encoding = choose_encoding(request.headers.get("Accept-Encoding"), offered)
+    body = compress(body, encoding)                 # whole bodies
+    chunks = compress_stream(chunks, encoding)      # streamed bodies
+
+Request bodies sent with ``Content-Encoding: gzip`` are decoded as they are
+read, by DecodeRequestBody around the WSGI app or by BodyDecoder for code
+that reads the body itself; other encodings are answered with 415. Decoded
+bodies are limited to `max_size` bytes so a small upload cannot expand
+without bound. Form and JSON bodies are decoded up front into a spooled file
+so the app sees their decoded Content-Length like that of a plain body.
+"""
+import io
+import tempfile
+import zlib
+
+from werkzeug.exceptions import RequestEntityTooLarge, BadRequest, UnsupportedMediaType
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import ClosingIterator, get_input_stream
+
+try:
+    import zstandard
+except ImportError:  # optional; zstd is offered only when installed
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:  # optional; br is offered only when installed
+    brotli = None
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+BROTLI_QUALITY = 4  # brotli's default (11) is far too slow for responses
+DECODE_CHUNK_SIZE = 64 * 1024
+DECODE_SPOOL_MEMORY = 1024 * 1024  # decoded form bodies up to this size stay in memory
+
+# Compressing these again gains nothing; text/event-stream must not be buffered
+COMPRESSIBLE_TYPES = ('application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+UNCOMPRESSIBLE_TYPES = ('text/event-stream',)
+# Bodies the app parses as a whole (and may take a key from) are decoded up front
+FORM_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data', 'application/json')
+
+
+class _Brotli:
+    """brotli.Compressor with the compressobj interface."""
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+# Preferred first; every factory returns an object with compress() and flush()
+ENCODINGS = {}
+if zstandard is not None:
+    ENCODINGS["zstd"] = lambda: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+if brotli is not None:
+    ENCODINGS["br"] = _Brotli
+ENCODINGS["gzip"] = lambda: zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+REQUEST_ENCODINGS = ("gzip", "x-gzip")
+
+
+class BodyDecodeError(BadRequest):
+    description = "Request body does not match its Content-Encoding"
+
+
+class DecodedBodyTooLarge(RequestEntityTooLarge):
+    description = "Decoded request body is too large"
+
+
+def available_encodings(names):
+    """The entries of `names` this installation can produce, in ENCODINGS order."""
+    return [name for name in ENCODINGS if name in names]
+
+
+def is_compressible(mimetype):
+    if mimetype in UNCOMPRESSIBLE_TYPES:
+        return False
+    return mimetype.startswith("text/") or mimetype in COMPRESSIBLE_TYPES
+
+
+def choose_encoding(accept_encoding, offered):
+    """Best of `offered` for an Accept-Encoding header, or None for identity."""
+    if not accept_encoding or not offered:
+        return None
+    return parse_accept_header(accept_encoding).best_match(offered)
+
+
+def compress(data, encoding):
+    compressor = ENCODINGS[encoding]()
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    compressor = ENCODINGS[encoding]()
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+class BodyDecoder:
+    """Incremental gzip decoding of a request body, bounded to `max_size` bytes."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._decompressor = zlib.decompressobj(31)
+
+    def decode(self, data):
+        """Decoded bytes for the next piece of the body (at most DECODE_CHUNK_SIZE
+        per call; feed b"" to drain the rest)."""
+        try:
+            if self._decompressor.unconsumed_tail:
+                data = self._decompressor.unconsumed_tail + data
+            decoded = self._decompressor.decompress(data, DECODE_CHUNK_SIZE)
+        except zlib.error:
+            raise BodyDecodeError() from None
+        self.size += len(decoded)
+        if self.size > self.max_size:
+            raise DecodedBodyTooLarge()
+        return decoded
+
+    @property
+    def pending(self):
+        return bool(self._decompressor.unconsumed_tail)
+
+    def finish(self):
+        """Return any remaining decoded bytes; checks the body was a complete gzip stream."""
+        try:
+            rest = self._decompressor.flush()
+        except zlib.error:
+            raise BodyDecodeError() from None
+        self.size += len(rest)
+        if self.size > self.max_size:
+            raise DecodedBodyTooLarge()
+        if not self._decompressor.eof:
+            raise BodyDecodeError()
+        return rest
+
+
+class _DecodingReader(io.RawIOBase):
+    def __init__(self, stream, decoder):
+        self._stream = stream
+        self._decoder = decoder
+        self._buffer = b""
+        self._done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer and not self._done:
+            data = b"" if self._decoder.pending else self._stream.read(DECODE_CHUNK_SIZE)
+            if not data and not self._decoder.pending:
+                self._buffer = self._decoder.finish()
+                self._done = True
+                break
+            self._buffer = self._decoder.decode(data)
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class DecodeRequestBody:
+    """WSGI middleware that decodes gzip request bodies.
+
+    The app sees the decoded body with no Content-Encoding. Form and JSON
+    bodies are decoded before the app runs and get their decoded
+    Content-Length; other bodies are decoded as they are read, with no
+    Content-Length (wsgi.input_terminated is set instead). A malformed
+    Content-Length is answered with 400.
+    """
+
+    def __init__(self, app, max_size):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        length = environ.get("CONTENT_LENGTH", "").strip()
+        if length and not length.isdigit():
+            return BadRequest("Invalid Content-Length")(environ, start_response)
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if encoding in ("", "identity"):
+            return self.app(environ, start_response)
+        if encoding not in REQUEST_ENCODINGS:
+            error = UnsupportedMediaType(f"Unsupported Content-Encoding: {encoding}")
+            return error(environ, start_response)
+        reader = io.BufferedReader(_DecodingReader(get_input_stream(environ), BodyDecoder(self.max_size)))
+        del environ["HTTP_CONTENT_ENCODING"]
+        if environ.get("CONTENT_TYPE", "").split(";")[0].strip().lower() in FORM_TYPES:
+            spool = tempfile.SpooledTemporaryFile(DECODE_SPOOL_MEMORY)
+            try:
+                while data := reader.read(DECODE_CHUNK_SIZE):
+                    spool.write(data)
+            except (BodyDecodeError, DecodedBodyTooLarge) as error:
+                spool.close()
+                return error(environ, start_response)
+            environ["CONTENT_LENGTH"] = str(spool.tell())
+            spool.seek(0)
+            environ["wsgi.input"] = spool
+            return ClosingIterator(self.app(environ, start_response), spool.close)
+        environ["wsgi.input"] = reader
+        environ["wsgi.input_terminated"] = True
+        environ.pop("CONTENT_LENGTH", None)
+        return self.app(environ, start_response)
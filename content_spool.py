@@ -0,0 +1,149 @@
+"""Disk spool for large queue items.
+
+Items larger than `threshold` bytes (UTF-8) are written to a file under
+`root`; the state backend only stores a short stub naming the file, with a
+preview of the text for status pages and logs:
+
+    spool = ContentSpool("content-spool", threshold=64 * 1024)
+    content = spool.put_text(text)          # text itself, or a stub
+    content = spool.put_stream(chunks)      # same, from a byte stream
+    info = describe(content)                # {"size", "spooled", "preview"}
+    path = spool.path(content)              # None for inline content
+    spool.copy(content)                     # a second stub with its own file
+    spool.delete(content)
+
+Files are named by a random id and written to a temporary name first, so a
+stub never points at a partial file. Several worker processes can share one
+spool directory.
+"""
+import codecs
+import os
+import shutil
+import tempfile
+import uuid
+
+# Submitted text never contains NUL (the server strips it), so stubs cannot
+# be forged by submitting one
+STUB_PREFIX = "\x00spool:"
+PREVIEW_CHARS = 1024
+
+
+class InvalidContent(ValueError):
+    """Raised for a streamed body that is not valid UTF-8."""
+
+
+def _stub(name, size, preview):
+    return f"{STUB_PREFIX}{name}:{size}:{preview}"
+
+
+def parse_stub(content):
+    """Return (name, size, preview) for a stub, or None for inline content."""
+    if not content.startswith(STUB_PREFIX):
+        return None
+    name, size, preview = content[len(STUB_PREFIX):].split(":", 2)
+    return name, int(size), preview
+
+
+def describe(content):
+    """Size, spooled flag and preview text for stored `content`."""
+    stub = parse_stub(content)
+    if stub is None:
+        return {"size": len(content.encode("utf-8")), "spooled": False, "preview": content[:PREVIEW_CHARS]}
+    return {"size": stub[1], "spooled": True, "preview": stub[2]}
+
+
+class ContentSpool:
+    def __init__(self, root, threshold=64 * 1024):
+        self.root = root
+        self.threshold = threshold
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, content):
+        """File holding spooled `content`, or None if it is stored inline."""
+        stub = parse_stub(content)
+        return os.path.join(self.root, f"{stub[0]}.txt") if stub else None
+
+    def put_text(self, text):
+        data = text.encode("utf-8")
+        if len(data) <= self.threshold:
+            return text
+        return self._commit(self._write([data]), len(data), text[:PREVIEW_CHARS])
+
+    def put_stream(self, chunks):
+        """Store a UTF-8 byte stream without holding it in memory.
+
+        Bodies up to `threshold` bytes come back as plain text. Raises
+        InvalidContent if the body is not valid UTF-8.
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        head = []  # bytes until the threshold is crossed
+        head_size = 0
+        preview = ""
+        size = 0
+        tmp = None
+        try:
+            for chunk in chunks:
+                try:
+                    text = decoder.decode(chunk)
+                except UnicodeDecodeError as e:
+                    raise InvalidContent(str(e)) from None
+                if len(preview) < PREVIEW_CHARS:
+                    preview += text[:PREVIEW_CHARS - len(preview)]
+                size += len(chunk)
+                if tmp is None:
+                    head.append(chunk)
+                    head_size += len(chunk)
+                    if head_size > self.threshold:
+                        tmp = self._open_temp()
+                        tmp.writelines(head)
+                        head = None
+                else:
+                    tmp.write(chunk)
+            try:
+                decoder.decode(b"", final=True)
+            except UnicodeDecodeError as e:
+                raise InvalidContent(str(e)) from None
+            if tmp is None:
+                return b"".join(head).decode("utf-8")
+            tmp.close()
+            return self._commit(tmp.name, size, preview)
+        except BaseException:
+            if tmp is not None:
+                tmp.close()
+                os.unlink(tmp.name)
+            raise
+
+    def copy(self, content):
+        """Another stub for the same text with its own file (a hard link where possible)."""
+        stub = parse_stub(content)
+        if stub is None:
+            return content
+        tmp = self._open_temp()
+        tmp.close()
+        try:
+            os.unlink(tmp.name)
+            os.link(self.path(content), tmp.name)
+        except OSError:
+            shutil.copyfile(self.path(content), tmp.name)
+        return self._commit(tmp.name, stub[1], stub[2])
+
+    def delete(self, content):
+        path = self.path(content)
+        if path is not None:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _open_temp(self):
+        return tempfile.NamedTemporaryFile("wb", dir=self.root, suffix=".tmp", delete=False)
+
+    def _write(self, chunks):
+        with self._open_temp() as tmp:
+            tmp.writelines(chunks)
+        return tmp.name
+
+    def _commit(self, tmp_name, size, preview):
+        name = uuid.uuid4().hex
+        os.replace(tmp_name, os.path.join(self.root, f"{name}.txt"))
+        return _stub(name, size, preview)
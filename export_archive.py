@@ -0,0 +1,96 @@
+"""Tar and zip archives streamed from a generator.
+
+Members are (name, size, mtime, binary file object) tuples, copied one at
+a time in ARCHIVE_CHUNK_SIZE pieces and closed. Given a generator that
+opens each file as it is reached, an archive of any number of files is
+produced in constant memory and can be sent as a streamed response:
+
+    members = ((name, size, mtime, open(path, "rb")) for name, size, mtime, path in files)
+    chunks = stream_archive("zip", members)
+
+Tar members need their exact size up front (it goes in the header); zip
+members are written with data descriptors, since the output cannot seek
+back.
+"""
+import tarfile
+import time
+import zipfile
+
+ARCHIVE_CHUNK_SIZE = 64 * 1024
+ARCHIVE_FORMATS = {
+    "tar": "application/x-tar",
+    "zip": "application/zip",
+}
+
+_TAR_BLOCK = tarfile.BLOCKSIZE
+_ZIP_EPOCH = time.mktime((1980, 1, 1, 0, 0, 0, 0, 0, -1))  # earliest date a zip can hold
+
+
+class _Sink:
+    """Write-only file object whose output is drained between writes."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _read_chunks(source, size=None):
+    """Up to `size` bytes of `source` (all of it if None), ARCHIVE_CHUNK_SIZE at a time."""
+    remaining = size
+    with source:
+        while remaining is None or remaining > 0:
+            chunk = source.read(ARCHIVE_CHUNK_SIZE if remaining is None else min(ARCHIVE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+    if remaining:
+        raise OSError("Archive member is shorter than its size")
+
+
+def stream_tar(members):
+    for name, size, mtime, source in members:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(mtime)
+        yield info.tobuf(tarfile.PAX_FORMAT)
+        yield from _read_chunks(source, size)
+        padding = -size % _TAR_BLOCK
+        if padding:
+            yield b"\0" * padding
+    yield b"\0" * (2 * _TAR_BLOCK)
+
+
+def stream_zip(members):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED) as archive:
+        for name, size, mtime, source in members:
+            info = zipfile.ZipInfo(name, time.localtime(max(mtime, _ZIP_EPOCH))[:6])
+            info.file_size = size
+            with archive.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as dest:
+                for chunk in _read_chunks(source):
+                    dest.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()  # the data descriptor
+    yield sink.drain()  # the central directory
+
+
+def stream_archive(archive_format, members):
+    """Chunks of a `archive_format` ("tar" or "zip") archive of `members`."""
+    if archive_format == "tar":
+        return stream_tar(members)
+    if archive_format == "zip":
+        return stream_zip(members)
+    raise ValueError(f"Unknown archive format: {archive_format}")
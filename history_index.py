@@ -0,0 +1,71 @@
+"""Time-ordered index for browsing screenshots and content history.
+
+Ids are kept sorted by (timestamp, id), so a page of the newest `limit`
+entries before a cursor and within a time range costs O(log n + k):
+
+    index = TimeIndex()
+    index.add(entry_id, parse_timestamp(entry["timestamp"], entry["created"]))
+    ids, more = index.page(before=last_seen_id, limit=50, start=t0, end=t1)
+
+Pages are newest first; `more` says whether older entries match. A cursor
+whose entry has left the index raises ExpiredCursor.
+"""
+import bisect
+import math
+from datetime import datetime
+
+
+class ExpiredCursor(LookupError):
+    """Raised for a `before` cursor whose entry is no longer indexed."""
+
+
+def parse_timestamp(value, default=None):
+    """Unix seconds for an ISO 8601 string or a number; `default` if unparseable.
+
+    Naive ISO times are taken as local time, like datetime.now().isoformat().
+    """
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        try:
+            seconds = datetime.fromisoformat(value).timestamp()
+        except (TypeError, ValueError, OverflowError, OSError):
+            return default
+    return seconds if math.isfinite(seconds) else default
+
+
+class TimeIndex:
+    def __init__(self):
+        self._keys = []   # (timestamp, id), ascending
+        self._by_id = {}  # id -> its key
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, item_id, timestamp):
+        self.discard(item_id)
+        key = (timestamp, item_id)
+        self._by_id[item_id] = key
+        if not self._keys or key > self._keys[-1]:
+            self._keys.append(key)  # the usual case: entries arrive in time order
+        else:
+            bisect.insort(self._keys, key)
+
+    def discard(self, item_id):
+        key = self._by_id.pop(item_id, None)
+        if key is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def page(self, before=None, limit=50, start=None, end=None):
+        """Return (ids newest first, more) for up to `limit` entries older than
+        the entry `before` with start <= timestamp <= end."""
+        keys = self._keys
+        hi = len(keys) if end is None else bisect.bisect_right(keys, (end, math.inf))
+        if before is not None:
+            key = self._by_id.get(before)
+            if key is None:
+                raise ExpiredCursor(before)
+            hi = min(hi, bisect.bisect_left(keys, key))
+        lo = 0 if start is None else bisect.bisect_left(keys, (start, -math.inf))
+        first = max(lo, hi - limit)
+        return [key[1] for key in reversed(keys[first:hi])], first > lo
@@ -0,0 +1,207 @@
+"""Background image processing on a process pool, with a bounded queue.
+
+Uploads are stored as received; the gallery thumbnail and a lossy display
+copy are rendered by worker processes so request threads never decode or
+encode images themselves:
+
+    pipeline = ImagePipeline(workers=2, max_pending=32)
+    with pipeline.slot() as submit:        # raises PipelineFull when saturated
+        entry = store.add(chunks, timestamp)
+        submit(render_variants, data, options, callback=lambda future: ...)
+
+A slot is taken before the upload is read and held until its job finishes,
+so at most `max_pending` images are in flight (queued or being rendered) at
+once; callers answer PipelineFull with 503 and Retry-After. A slot whose
+block ends without submitting is given back. Callbacks run on a pool thread
+in this process. Requests that need a job's result wait for it with run().
+
+Workers are started with forkserver (or spawn where that is missing), never
+fork: forking a threaded server copies locks held by other threads. With
+`workers=0`, or when the platform cannot start worker processes at all, jobs
+run inline in the calling thread.
+"""
+import contextlib
+import io
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow is optional; without it no variants are rendered
+    Image = None
+
+log = logging.getLogger("server.images")
+
+CONTENT_TYPES = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+
+class PipelineFull(Exception):
+    """Raised by ImagePipeline.slot() when `max_pending` jobs are in flight."""
+
+
+def display_format(preferred):
+    """`preferred` ("webp" or "jpeg") if this Pillow can write it, else "jpeg"."""
+    if preferred == "webp" and Image is not None and features.check("webp"):
+        return "webp"
+    return "jpeg"
+
+
+def compose_delta(base, tiles):
+    """Paste (x, y, image bytes) tiles over the `base` image bytes; return PNG bytes.
+
+    Runs in a worker process.
+    """
+    with Image.open(io.BytesIO(base)) as image:
+        composite = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    for x, y, data in tiles:
+        with Image.open(io.BytesIO(data)) as tile:
+            composite.paste(tile.convert(composite.mode), (x, y))
+    output = io.BytesIO()
+    composite.save(output, format="PNG")
+    return output.getvalue()
+
+
+def _mp_context():
+    """The forkserver context, else spawn, else the platform default; None if none works."""
+    for method in ("forkserver", "spawn", None):
+        try:
+            return multiprocessing.get_context(method)
+        except ValueError:
+            continue
+    return None
+
+
+def render_variants(data, thumbnail_size=320, display="jpeg", quality=80, display_max_size=0):
+    """Return {"thumb": (bytes, content_type), "display": ...} for an image.
+
+    Runs in a worker process. The display copy is only returned when it is
+    smaller than the original.
+    """
+    variants = {}
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        rgb = image if image.mode in ("RGB", "L") else image.convert("RGB")
+
+        thumb = rgb.copy()
+        thumb.thumbnail((thumbnail_size, thumbnail_size))
+        output = io.BytesIO()
+        thumb.save(output, format="JPEG", quality=80)
+        variants["thumb"] = (output.getvalue(), CONTENT_TYPES["jpeg"])
+
+        copy = image.convert("RGBA") if display == "webp" and "A" in image.getbands() else rgb.copy()
+        if display_max_size and max(copy.size) > display_max_size:
+            copy.thumbnail((display_max_size, display_max_size))
+        output = io.BytesIO()
+        copy.save(output, format=display.upper(), quality=quality)
+        if output.tell() < len(data):
+            variants["display"] = (output.getvalue(), CONTENT_TYPES[display])
+    return variants
+
+
+class ImagePipeline:
+    def __init__(self, workers=2, max_pending=32):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def pending(self):
+        return self._pending
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Reserve room for one job; yields submit(fn, *args, callback)."""
+        if not self._slots.acquire(blocking=False):
+            raise PipelineFull(f"{self.max_pending} images already in flight")
+        with self._lock:
+            self._pending += 1
+        submitted = False
+
+        def submit(fn, *args, callback):
+            nonlocal submitted
+            self._submit(fn, args, callback)
+            submitted = True  # the job's callback releases the slot from now on
+
+        try:
+            yield submit
+        finally:
+            if not submitted:
+                self._release()
+
+    def run(self, fn, *args):
+        """Take a slot, run one job and return its result (or raise its error).
+
+        Raises PipelineFull like slot() when the pipeline is saturated.
+        """
+        finished = Future()
+        with self.slot() as submit:
+            submit(fn, *args, callback=finished.set_result)
+        return finished.result().result()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def _pool(self):
+        # Created on first use so every (forked) server worker gets its own.
+        # Jobs are module-level functions here, so workers need only this
+        # module (the start method still imports the main script once, as
+        # the dev server's reloader does). None when no worker can start.
+        with self._lock:
+            if self._executor is None and self.workers:
+                context = _mp_context()
+                try:
+                    if context is None:
+                        raise NotImplementedError("no multiprocessing start method")
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+                except (NotImplementedError, OSError) as e:  # e.g. no sem_open on this platform
+                    log.warning("Image workers unavailable, processing images inline: %s", e)
+                    self.workers = 0
+            return self._executor
+
+    def _reset_pool(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _submit(self, fn, args, callback):
+        executor = self._pool()
+        if executor is None:
+            future = Future()
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+            self._finish(future, callback)
+            return
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._reset_pool(executor)  # a worker died (e.g. out of memory); start over once
+            executor = self._pool()
+            future = executor.submit(fn, *args)
+        future.add_done_callback(lambda done: self._finish(done, callback, executor))
+
+    def _finish(self, future, callback, executor=None):
+        try:
+            if executor is not None and isinstance(future.exception(), BrokenProcessPool):
+                self._reset_pool(executor)
+            callback(future)
+        except Exception:
+            log.exception("Image pipeline callback failed")
+        finally:
+            self._release()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
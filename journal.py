@@ -0,0 +1,192 @@
+"""Append-only journal with group commit and snapshot compaction.
+
+Used by the in-process state backend to survive restarts:
+
+    journal = Journal("state-journal", snapshot=backend.dump, snapshot_every=10000)
+    snapshot, records = journal.recover()   # rebuild state from these first
+    journal.start()
+    seq = journal.append({"op": "flags", ...})  # under the caller's lock
+    journal.wait(seq)                           # after releasing it: durable
+
+Records are JSON lines in numbered segment files (journal.<n>.log). A single
+writer thread drains everything appended since its last pass, writes it and
+fsyncs once, so concurrent writers share one fsync ("group commit").
+
+Every `snapshot_every` records the writer seals the current segment, starts
+a new one, asks `snapshot()` for the full state and stores it atomically
+together with the sequence number the sealed segments end at; the sealed
+segments are then deleted. The snapshot may already include some records
+from the new segment, so records must be idempotent when replayed in order.
+Recovery replays at most one snapshot interval of records.
+
+If writing, fsync or a snapshot fails the writer stops, and `wait` raises
+JournalError for every record that did not reach the disk.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+SEGMENT_PATTERN = re.compile(r"journal\.(\d+)\.log$")
+
+
+class JournalError(RuntimeError):
+    """Raised by Journal.wait when the writer failed before the record was durable."""
+
+
+class Journal:
+    SNAPSHOT_NAME = "snapshot.json"
+
+    def __init__(self, root, snapshot, snapshot_every=10000, commit_delay=0.0):
+        self.root = root
+        self.snapshot = snapshot
+        self.snapshot_every = snapshot_every
+        self.commit_delay = commit_delay
+        os.makedirs(root, exist_ok=True)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._seq = 0           # last sequence number handed out
+        self._durable_seq = 0   # last sequence number fsync'd
+        self._since_snapshot = 0
+        self._segment = None
+        self._segment_number = 0
+        self._thread = None
+        self._closed = False
+        self._error = None      # what stopped the writer thread, if anything
+
+    # -- recovery ---------------------------------------------------------
+    def _segments(self):
+        numbers = []
+        for name in os.listdir(self.root):
+            match = SEGMENT_PATTERN.match(name)
+            if match:
+                numbers.append(int(match.group(1)))
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return os.path.join(self.root, f"journal.{number}.log")
+
+    def recover(self):
+        """Return (snapshot state or None, records to replay in order)."""
+        snapshot, snapshot_seq = None, 0
+        snapshot_path = os.path.join(self.root, self.SNAPSHOT_NAME)
+        if os.path.exists(snapshot_path):
+            with open(snapshot_path, encoding="utf-8") as f:
+                stored = json.load(f)
+            snapshot, snapshot_seq = stored["state"], stored["seq"]
+
+        records = []
+        last_seq = snapshot_seq
+        segments = self._segments()
+        for number in segments:
+            with open(self._segment_path(number), encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn final line after a crash
+                    last_seq = max(last_seq, record["seq"])
+                    if record["seq"] > snapshot_seq:
+                        records.append(record)
+        self._seq = self._durable_seq = last_seq
+        self._since_snapshot = len(records)
+        self._segment_number = (segments[-1] + 1) if segments else 1
+        return snapshot, records
+
+    # -- writing ----------------------------------------------------------
+    def start(self):
+        self._segment = open(self._segment_path(self._segment_number), "a", encoding="utf-8")
+        self._fsync_root()
+        self._thread = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self._thread.start()
+
+    def append(self, record):
+        """Queue `record` and return its sequence number; see `wait`."""
+        with self._cond:
+            self._seq += 1
+            record["seq"] = self._seq
+            if self._error is None:  # otherwise wait() reports it; nothing drains the queue
+                self._pending.append(record)
+            self._cond.notify_all()
+            return self._seq
+
+    def wait(self, seq):
+        """Block until the record with sequence number `seq` is on disk.
+
+        Raises JournalError if the writer failed before writing it.
+        """
+        with self._cond:
+            while self._durable_seq < seq and not self._closed and self._error is None:
+                self._cond.wait()
+            if self._durable_seq < seq and self._error is not None:
+                raise JournalError(f"Journal record {seq} was not written: {self._error}") from self._error
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        try:
+            self._write_batches()
+        except BaseException as e:
+            with self._cond:
+                self._error = e
+                self._cond.notify_all()
+            self._segment.close()
+            raise  # reported once by threading.excepthook
+
+    def _write_batches(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+            if self.commit_delay:
+                time.sleep(self.commit_delay)  # let a larger group form
+            with self._cond:
+                batch, self._pending = self._pending, []
+                closed = self._closed
+            if batch:
+                self._segment.write("".join(json.dumps(record) + "\n" for record in batch))
+                self._segment.flush()
+                os.fsync(self._segment.fileno())
+                with self._cond:
+                    self._durable_seq = batch[-1]["seq"]
+                    self._cond.notify_all()
+                self._since_snapshot += len(batch)
+                if self._since_snapshot >= self.snapshot_every:
+                    self._take_snapshot()
+            if closed:
+                self._segment.close()
+                return
+
+    def _fsync_root(self):
+        # Make created/renamed files themselves survive a crash
+        fd = os.open(self.root, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _take_snapshot(self):
+        # Everything up to sealed_seq is in the sealed segments; later records
+        # go to the new one and may also be reflected in the snapshot
+        sealed_seq = self._durable_seq
+        sealed = self._segments()
+        self._segment.close()
+        self._segment_number += 1
+        self._segment = open(self._segment_path(self._segment_number), "a", encoding="utf-8")
+
+        tmp_path = os.path.join(self.root, self.SNAPSHOT_NAME + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": sealed_seq, "state": self.snapshot()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.root, self.SNAPSHOT_NAME))
+        self._fsync_root()
+        for number in sealed:
+            os.unlink(self._segment_path(number))
+        self._since_snapshot = 0
@@ -0,0 +1,95 @@
+"""Logging configuration for the server.
+
+Request threads only put records on an in-memory queue; a QueueListener
+thread formats them and writes them to stdout. Loggers under "server":
+
+    server        route activity (submissions, acks, uploads, admin actions)
+    server.poll   high-frequency client polling (/status, /check_*, /latest,
+                  /next, /commands/stream); DEBUG for routine traffic and
+                  rate-limited so a misbehaving poller cannot flood the log
+
+    LOG_LEVEL=DEBUG python server.py
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "%(asctime)s %(levelname)s [%(name)s] %(message)s")
+# Repeats of the same poll log message are dropped within this many seconds
+POLL_LOG_INTERVAL = float(os.getenv("POLL_LOG_INTERVAL", "60"))
+
+_listener = None
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    The stock handler merges the arguments into the message before queueing;
+    the listener runs in the same process, so the record can be queued as is.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """Pass at most one record per message template every `interval` seconds.
+
+    The next record let through for a template notes how many were dropped.
+    """
+
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last = {}
+        self._suppressed = {}
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(key)
+            if last is not None and now - last < self.interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return False
+            self._last[key] = now
+            suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            record.msg = f"{record.msg} (+{suppressed} similar)"
+        return True
+
+
+def _restart_listener():
+    _listener._thread = None
+    _listener.start()
+
+
+def configure_logging(level=None):
+    """Attach the queue handler to the "server" logger (once per process)."""
+    global _listener
+    logger = logging.getLogger("server")
+    logger.setLevel(level or LOG_LEVEL)
+    if _listener is not None:
+        return logger
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    # A forked worker (e.g. gunicorn --preload) needs its own listener thread
+    os.register_at_fork(after_in_child=_restart_listener)
+
+    logger.addHandler(DeferredQueueHandler(records))
+    logger.propagate = False
+    if POLL_LOG_INTERVAL > 0:
+        logging.getLogger("server.poll").addFilter(RateLimitFilter(POLL_LOG_INTERVAL))
+    return logger
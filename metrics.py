@@ -0,0 +1,176 @@
+"""Minimal in-process metrics in the Prometheus text exposition format.
+
+    requests = registry.counter("http_requests_total", "Requests served", ["route"])
+    requests.inc("/status")
+    registry.gauge("queue_depth", "Queued items", lambda: [((), 3)])
+    registry.render()
+
+Values are per process; with several gunicorn workers each one reports its
+own counters, so scrape them individually or aggregate in Prometheus.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152, 8388608)
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labelvalues, value in values:
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._lock = threading.Lock()
+        self._series = {}  # labelvalues -> [bucket counts..., sum, count]
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = sorted((labelvalues, list(series)) for labelvalues, series in self._series.items())
+        for labelvalues, series in snapshot:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                le = _labels(self.labelnames, labelvalues, [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """A gauge whose samples are read from `collect()` at scrape time.
+
+    `collect` returns an iterable of (labelvalues, value) pairs.
+    """
+
+    def __init__(self, name, documentation, collect, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.collect = collect
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labelvalues, value in self.collect():
+            lines.append(f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, collect, labelnames=()):
+        return self._register(Gauge(name, documentation, collect, labelnames))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class InFlightTimer:
+    """Track start times of open operations (e.g. submitted but unacknowledged
+    items) and report their duration when they finish.
+
+    At most `max_open` operations are remembered; the oldest are forgotten
+    first, e.g. items acknowledged through another worker process.
+    """
+
+    def __init__(self, max_open=10000):
+        self.max_open = max_open
+        self._lock = threading.Lock()
+        self._started = OrderedDict()  # key -> monotonic start time
+
+    def start(self, key):
+        with self._lock:
+            self._started.setdefault(key, time.monotonic())
+            while len(self._started) > self.max_open:
+                self._started.popitem(last=False)
+
+    def finish(self, key):
+        """Return seconds since `key` started, or None if it was not open."""
+        with self._lock:
+            started = self._started.pop(key, None)
+        return None if started is None else time.monotonic() - started
+
+    def discard(self, predicate):
+        with self._lock:
+            for key in [key for key in self._started if predicate(key)]:
+                del self._started[key]
+
+    def oldest(self, group=lambda key: key):
+        """Return {group(key): age in seconds of the oldest open operation}."""
+        now = time.monotonic()
+        ages = {}
+        with self._lock:
+            for key, started in self._started.items():
+                ages.setdefault(group(key), now - started)
+        return ages
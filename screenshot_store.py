@@ -0,0 +1,438 @@
+"""Bounded screenshot storage backends.
+
+Both backends keep a small metadata record per screenshot and evict by
+maximum count, maximum total bytes (the recorded ``size``) and age. Eviction
+for the count and byte budgets is least-recently-used; age eviction drops
+everything older than ``max_age`` seconds.
+
+    store = create_screenshot_store("disk", root="screenshots", max_bytes=256 << 20)
+    entry = store.add(chunks, timestamp)
+    data = store.read(entry["id"])
+
+Derived images (e.g. the "thumb" variant) are attached to an entry with
+``put_variant`` and count towards the byte budget; they are removed together
+with the original.
+
+Images are deduplicated by SHA-256: entries with identical bytes share one
+stored blob (and its variants), which is reference counted and deleted with
+its last entry. A capture of an image the store already holds can also be
+recorded by hash alone with ``add_existing``.
+
+Entries are also indexed by capture time (their ``timestamp``, or when they
+were stored if it does not parse) for ``page``, which browses them newest
+first in O(log n + k).
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from history_index import TimeIndex, parse_timestamp
+
+
+class ScreenshotTooLarge(ValueError):
+    """Raised when a single screenshot exceeds the store's byte budget."""
+
+
+class ScreenshotStore:
+    """Common bookkeeping and eviction; subclasses own the image bytes."""
+
+    def __init__(self, max_count=None, max_bytes=None, max_age=None):
+        self.max_count = max_count or None
+        self.max_bytes = max_bytes or None
+        self.max_age = max_age or None
+        self._lock = threading.RLock()
+        self._entries = {}            # id -> metadata, in insertion (= age) order
+        self._lru = OrderedDict()     # id -> None, least recently used first
+        self._blobs = {}              # blob id -> shared bytes info, see _insert
+        self._by_hash = {}            # sha256 -> blob id
+        self._by_time = TimeIndex()   # ids by capture time, for page()
+        self._total_bytes = 0
+        self._next_id = 1
+
+    # -- subclass hooks (keyed by blob id) ---------------------------------
+    def _write(self, screenshot_id, chunks, variant=None):
+        """Persist the chunks and return the number of bytes written."""
+        raise NotImplementedError
+
+    def _read(self, screenshot_id, variant=None):
+        raise NotImplementedError
+
+    def _delete(self, screenshot_id, variant=None):
+        raise NotImplementedError
+
+    def _record(self, op, entry):
+        """Hook called after an entry is added ('add') or removed ('remove')."""
+
+    # -- public API -----------------------------------------------------
+    def add(self, chunks, timestamp, content_type="image/png"):
+        """Store an image given as an iterable of byte chunks.
+
+        Returns the metadata dict for the new entry. The SHA-256 of the image
+        is computed while it is written and recorded as ``sha256``; if the
+        store already holds those bytes the new copy is discarded and the
+        entry shares the existing blob (its ``blob`` differs from its ``id``).
+        """
+        with self._lock:
+            screenshot_id = self._next_id
+            self._next_id += 1
+
+        digest = hashlib.sha256()
+
+        def hashed(chunks):
+            # Stops the copy as soon as the budget is passed; _write discards the partial blob
+            size = 0
+            for chunk in chunks:
+                size += len(chunk)
+                if self.max_bytes and size > self.max_bytes:
+                    raise ScreenshotTooLarge(f"Screenshot exceeds the {self.max_bytes} byte budget")
+                digest.update(chunk)
+                yield chunk
+
+        size = self._write(screenshot_id, hashed(chunks))
+
+        entry = {
+            "id": screenshot_id,
+            "timestamp": timestamp,
+            "size": size,
+            "content_type": content_type,
+            "created": time.time(),
+            "sha256": digest.hexdigest(),
+            "blob": screenshot_id,
+            "variants": {},
+        }
+        with self._lock:
+            existing = self._by_hash.get(entry["sha256"])
+            if existing is not None:
+                entry["blob"] = existing
+                self._delete(screenshot_id)
+            self._insert(entry)
+            self._record("add", entry)
+            self._evict()
+        return entry
+
+    def add_existing(self, sha256, timestamp):
+        """Record a capture of an image the store already holds, by hash.
+
+        Returns the new entry, or None if no stored image has that hash.
+        """
+        with self._lock:
+            self._expire()
+            blob_id = self._by_hash.get(sha256)
+            if blob_id is None:
+                return None
+            blob = self._blobs[blob_id]
+            entry = {
+                "id": self._next_id,
+                "timestamp": timestamp,
+                "size": blob["size"],
+                "content_type": blob["content_type"],
+                "created": time.time(),
+                "sha256": sha256,
+                "blob": blob_id,
+                "variants": blob["variants"],
+            }
+            self._insert(entry)
+            self._record("add", entry)
+            self._evict()
+            return entry
+
+    def open_by_hash(self, sha256):
+        """Return a readable file object for the stored image with `sha256`, or None."""
+        with self._lock:
+            blob_id = self._by_hash.get(sha256)
+        return self._open(blob_id) if blob_id is not None else None
+
+    def get(self, screenshot_id):
+        """Return the metadata for `screenshot_id`, or None if it is gone."""
+        with self._lock:
+            self._expire()
+            return self._entries.get(screenshot_id)
+
+    def put_variant(self, screenshot_id, variant, data, content_type):
+        """Attach derived image bytes (e.g. a thumbnail) to an existing entry."""
+        with self._lock:
+            entry = self._entries.get(screenshot_id)
+            if entry is None:
+                return None
+            blob_id = entry["blob"]
+        size = self._write(blob_id, [data], variant)
+        with self._lock:
+            blob = self._blobs.get(blob_id)
+            if blob is None:  # evicted while the variant was being written
+                self._delete(blob_id, variant)
+                return None
+            previous = blob["variants"].get(variant)
+            if previous:
+                self._total_bytes -= previous["size"]
+            blob["variants"][variant] = {"size": size, "content_type": content_type}
+            self._total_bytes += size
+            entry = self._entries.get(screenshot_id)
+            if entry is not None:
+                self._record("add", entry)
+            self._evict()
+            return entry
+
+    def read(self, screenshot_id, variant=None):
+        """Return the image bytes for `screenshot_id`, or None if it is gone."""
+        blob_id = self._touch(screenshot_id, variant)
+        if blob_id is None:
+            return None
+        return self._read(blob_id, variant)
+
+    def open(self, screenshot_id, variant=None):
+        """Return a readable binary file object for `screenshot_id`, or None."""
+        blob_id = self._touch(screenshot_id, variant)
+        if blob_id is None:
+            return None
+        return self._open(blob_id, variant)
+
+    def _open(self, screenshot_id, variant=None):
+        data = self._read(screenshot_id, variant)
+        return io.BytesIO(data) if data is not None else None
+
+    def _touch(self, screenshot_id, variant):
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(screenshot_id)
+            if entry is None or (variant is not None and variant not in entry["variants"]):
+                return None
+            self._lru.move_to_end(screenshot_id)
+            return entry["blob"]
+
+    def recent(self, limit):
+        """Return metadata for the newest `limit` screenshots, oldest first."""
+        with self._lock:
+            self._expire()
+            ids = list(self._entries)[-limit:] if limit else []
+            return [self._entries[i] for i in ids]
+
+    def page(self, before=None, limit=50, start=None, end=None):
+        """Return (entries newest first, more) by capture time; see TimeIndex.page.
+
+        Raises ExpiredCursor if the `before` screenshot is gone.
+        """
+        with self._lock:
+            self._expire()
+            ids, more = self._by_time.page(before, limit, start, end)
+            return [self._entries[i] for i in ids], more
+
+    def remove(self, screenshot_id):
+        with self._lock:
+            entry = self._entries.get(screenshot_id)
+            if entry is not None:
+                self._drop(entry)
+
+    def clear(self):
+        with self._lock:
+            for entry in list(self._entries.values()):
+                self._drop(entry)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    # -- internals (caller holds the lock) -------------------------------
+    def _insert(self, entry):
+        # Bytes are counted once per blob; entries sharing it share its variants
+        entry.setdefault("blob", entry["id"])
+        blob = self._blobs.get(entry["blob"])
+        if blob is None:
+            blob = self._blobs[entry["blob"]] = {
+                "sha256": entry["sha256"],
+                "size": entry["size"],
+                "content_type": entry["content_type"],
+                "variants": {},
+                "refs": 0,
+            }
+            self._by_hash[entry["sha256"]] = entry["blob"]
+            self._total_bytes += entry["size"]
+        for name, variant in entry.get("variants", {}).items():
+            if name not in blob["variants"]:
+                blob["variants"][name] = variant
+                self._total_bytes += variant["size"]
+        entry["variants"] = blob["variants"]
+        blob["refs"] += 1
+        self._entries[entry["id"]] = entry
+        self._lru[entry["id"]] = None
+        self._by_time.add(entry["id"], parse_timestamp(entry["timestamp"], entry["created"]))
+        self._next_id = max(self._next_id, entry["id"] + 1)
+
+    def _drop(self, entry):
+        del self._entries[entry["id"]]
+        self._lru.pop(entry["id"], None)
+        self._by_time.discard(entry["id"])
+        blob = self._blobs[entry["blob"]]
+        blob["refs"] -= 1
+        if not blob["refs"]:
+            del self._blobs[entry["blob"]]
+            if self._by_hash.get(blob["sha256"]) == entry["blob"]:
+                del self._by_hash[blob["sha256"]]
+            self._total_bytes -= blob["size"] + sum(v["size"] for v in blob["variants"].values())
+            for variant in blob["variants"]:
+                self._delete(entry["blob"], variant)
+            self._delete(entry["blob"])
+        self._record("remove", entry)
+
+    def _expire(self):
+        if not self.max_age:
+            return
+        cutoff = time.time() - self.max_age
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest["created"] >= cutoff:
+                break
+            self._drop(oldest)
+
+    def _evict(self):
+        self._expire()
+        while self._lru and (
+            (self.max_count and len(self._entries) > self.max_count)
+            or (self.max_bytes and self._total_bytes > self.max_bytes)
+        ):
+            lru_id = next(iter(self._lru))
+            self._drop(self._entries[lru_id])
+
+
+class MemoryScreenshotStore(ScreenshotStore):
+    """In-process ring buffer of image bytes bounded by count, bytes and age."""
+
+    def __init__(self, **limits):
+        super().__init__(**limits)
+        self._data = {}
+
+    def _write(self, screenshot_id, chunks, variant=None):
+        image = bytearray()
+        for chunk in chunks:
+            image.extend(chunk)
+        self._data[screenshot_id, variant] = bytes(image)
+        return len(image)
+
+    def _read(self, screenshot_id, variant=None):
+        return self._data.get((screenshot_id, variant))
+
+    def _delete(self, screenshot_id, variant=None):
+        self._data.pop((screenshot_id, variant), None)
+
+
+class DiskScreenshotStore(ScreenshotStore):
+    """Image files under `root` plus an append-only metadata index.
+
+    The index (index.jsonl) records add/remove operations and is compacted
+    on startup and whenever removals outnumber live entries.
+    """
+
+    INDEX_NAME = "index.jsonl"
+
+    def __init__(self, root, **limits):
+        super().__init__(**limits)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._index_path = os.path.join(root, self.INDEX_NAME)
+        self._index = None
+        self._removed_since_compaction = 0
+        self._load()
+
+    def _path(self, screenshot_id, variant=None):
+        if variant:
+            return os.path.join(self.root, f"{screenshot_id}.{variant}.img")
+        return os.path.join(self.root, f"{screenshot_id}.img")
+
+    def _write(self, screenshot_id, chunks, variant=None):
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, self._path(screenshot_id, variant))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return size
+
+    def _read(self, screenshot_id, variant=None):
+        try:
+            with open(self._path(screenshot_id, variant), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _open(self, screenshot_id, variant=None):
+        try:
+            return open(self._path(screenshot_id, variant), "rb")
+        except FileNotFoundError:
+            return None
+
+    def _delete(self, screenshot_id, variant=None):
+        try:
+            os.unlink(self._path(screenshot_id, variant))
+        except FileNotFoundError:
+            pass
+
+    def _record(self, op, entry):
+        if op == "remove":
+            self._index.write(json.dumps({"op": "remove", "id": entry["id"]}) + "\n")
+            self._removed_since_compaction += 1
+            if self._removed_since_compaction > max(len(self._entries), 64):
+                self._compact()
+        else:
+            self._index.write(json.dumps({"op": "add", **entry}) + "\n")
+        self._index.flush()
+
+    def _load(self):
+        for name in os.listdir(self.root):
+            if name.endswith(".part"):
+                os.unlink(os.path.join(self.root, name))  # interrupted upload
+        entries = {}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn final line after a crash
+                    op = record.pop("op", None)
+                    if op == "add":
+                        entries[record["id"]] = record
+                    elif op == "remove":
+                        entries.pop(record["id"], None)
+        for entry in sorted(entries.values(), key=lambda e: e["id"]):
+            blob_id = entry.setdefault("blob", entry["id"])
+            if os.path.exists(self._path(blob_id)):
+                entry["variants"] = {
+                    name: variant for name, variant in entry.get("variants", {}).items()
+                    if os.path.exists(self._path(blob_id, name))
+                }
+                self._insert(entry)
+        self._compact()
+        with self._lock:
+            self._evict()
+
+    def _compact(self):
+        if self._index is not None:
+            self._index.close()
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in self._entries.values():
+                f.write(json.dumps({"op": "add", **entry}) + "\n")
+        os.replace(tmp_path, self._index_path)
+        self._index = open(self._index_path, "a", encoding="utf-8")
+        self._removed_since_compaction = 0
+
+
+def create_screenshot_store(backend="memory", root=None, **limits):
+    """Build a screenshot store by backend name ('memory' or 'disk')."""
+    if backend == "memory":
+        return MemoryScreenshotStore(**limits)
+    if backend == "disk":
+        return DiskScreenshotStore(root or "screenshots", **limits)
+    raise ValueError(f"Unknown screenshot store backend: {backend}")
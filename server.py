@@ -1,19 +1,515 @@
-from flask import Flask, request, render_template_string, jsonify, redirect, make_response
+from flask import Flask, request, jsonify, redirect, make_response, Response, stream_with_context, send_file, abort, g
 import os
 from dotenv import load_dotenv
+from screenshot_store import create_screenshot_store, ScreenshotTooLarge
+from state_backend import create_state_backend, UnknownClient, DEFAULT_CLIENT_ID
+from capture_schedule import due_captures, parse_capture_id, schedule_summary
+from image_pipeline import ImagePipeline, PipelineFull, compose_delta, display_format, render_variants
+from content_spool import ContentSpool, InvalidContent, describe
+from export_archive import ARCHIVE_FORMATS, stream_archive
+from history_index import ExpiredCursor, parse_timestamp
+from auth import ALL_CLIENTS, CLIENT_ID_PATTERN, TokenTable, load_client_tokens, request_token
+from admission import ByteBudget, RateLimiter, UploadBudgetExceeded, parse_rate
+from compression import DecodeRequestBody, available_encodings, choose_encoding, compress, compress_stream, is_compressible
+from logging_setup import configure_logging
+from metrics import Registry, InFlightTimer, SIZE_BUCKETS, DURATION_BUCKETS
 import base64
+import functools
+import hashlib
+import io
 import json
-from datetime import datetime
+import logging
+import math
+import mimetypes
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlencode
+from werkzeug.exceptions import HTTPException
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it thumbnails and display copies fall back to the full image
+    Image = None
 
 load_dotenv()
 app = Flask(__name__)
 
-content_store = []
-screenshot_store = []  # New: Store screenshots
-submission_locked = False
-screenshot_capture_requested = False  # New: Flag for screenshot requests
-kill_switch_activated = False  # New: Kill switch flag
+configure_logging()
+log = logging.getLogger("server")
+poll_log = logging.getLogger("server.poll")  # high-frequency client polling, rate-limited
+
 SECRET_KEY = os.getenv("SECRET_KEY", "my-secret-2025")
+# SECRET_KEY is valid for every client; per-client tokens (CLIENT_TOKENS, a
+# JSON file or client=token pairs) only for their own client, which requests
+# then default to. Keys are read from Authorization: Bearer, X-Key or ?key=
+# before the body; form and JSON bodies are only searched for a key up to
+# AUTH_BODY_KEY_MAX_SIZE bytes, so larger uploads must use a header.
+tokens = TokenTable(SECRET_KEY, load_client_tokens(os.getenv("CLIENT_TOKENS")))
+AUTH_BODY_KEY_MAX_SIZE = int(os.getenv("AUTH_BODY_KEY_MAX_SIZE", str(64 * 1024)))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(64 * 1024)))
+
+# Screenshot stores, one per client: "memory" (ring buffer) or "disk" (files
+# under SCREENSHOT_DIR/<client_id>). Each evicts by count, total bytes and age
+# (seconds); 0 disables a limit.
+SCREENSHOT_BACKEND = os.getenv("SCREENSHOT_BACKEND", "memory")
+SCREENSHOT_DIR = os.getenv("SCREENSHOT_DIR", "screenshots")
+SCREENSHOT_LIMITS = {
+    "max_count": int(os.getenv("SCREENSHOT_MAX_COUNT", "200")),
+    "max_bytes": int(os.getenv("SCREENSHOT_MAX_BYTES", str(256 * 1024 * 1024))),
+    "max_age": int(os.getenv("SCREENSHOT_MAX_AGE", "0")),
+}
+# Request bodies over MAX_REQUEST_SIZE bytes (0: no limit) get 413 before
+# they are read; the default leaves room for a SCREENSHOT_MAX_BYTES image
+# sent base64-encoded in JSON, and is unlimited when that budget is.
+MAX_REQUEST_SIZE = int(os.getenv("MAX_REQUEST_SIZE", str(SCREENSHOT_LIMITS["max_bytes"] * 4 // 3 + 64 * 1024 if SCREENSHOT_LIMITS["max_bytes"] else 0)))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE or None
+screenshot_stores = {}
+screenshot_stores_lock = threading.Lock()
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "320"))
+# Thumbnails and a lossy display copy (DISPLAY_FORMAT webp or jpeg, at most
+# DISPLAY_MAX_SIZE pixels per side, 0 keeps the size) are rendered by
+# IMAGE_WORKERS processes (0: in the request thread); originals are kept. At
+# most IMAGE_QUEUE_SIZE uploads are in the pipeline at once, further ones get
+# 503 with Retry-After: IMAGE_RETRY_AFTER.
+DISPLAY_FORMAT = display_format(os.getenv("DISPLAY_FORMAT", "webp"))
+DISPLAY_QUALITY = int(os.getenv("DISPLAY_QUALITY", "80"))
+DISPLAY_MAX_SIZE = int(os.getenv("DISPLAY_MAX_SIZE", "2560"))
+IMAGE_RETRY_AFTER = int(os.getenv("IMAGE_RETRY_AFTER", "2"))
+image_pipeline = ImagePipeline(
+    workers=int(os.getenv("IMAGE_WORKERS", "2")),
+    max_pending=int(os.getenv("IMAGE_QUEUE_SIZE", "32")),
+)
+SCREENSHOT_CACHE_MAX_AGE = int(os.getenv("SCREENSHOT_CACHE_MAX_AGE", str(24 * 3600)))
+# Admission control (per worker process). Each client gets a token bucket per
+# route class, "<requests per second>[:<burst>]" (empty or 0 disables):
+# RATE_LIMIT_POLL for status and command polling, RATE_LIMIT_UPLOAD for
+# screenshot uploads and RATE_LIMIT_ADMIN for admin routes; requests over the
+# limit get 429 with Retry-After. Submitting, acknowledging and the dashboard
+# are not limited. Upload bodies being received share UPLOAD_BUDGET_BYTES
+# (0: unlimited); an upload that does not fit gets 503 with Retry-After:
+# IMAGE_RETRY_AFTER.
+rate_limiter = RateLimiter({
+    "poll": parse_rate(os.getenv("RATE_LIMIT_POLL", "20:40")),
+    "upload": parse_rate(os.getenv("RATE_LIMIT_UPLOAD", "5:20")),
+    "admin": parse_rate(os.getenv("RATE_LIMIT_ADMIN", "5:20")),
+})
+upload_budget = ByteBudget(int(os.getenv("UPLOAD_BUDGET_BYTES", str(64 * 1024 * 1024))))
+# GET /screenshots and GET /items page through screenshot metadata and the
+# content history (the newest CONTENT_HISTORY items per client) newest first:
+# ?limit= (default HISTORY_PAGE_SIZE, at most HISTORY_MAX_LIMIT), ?from= and
+# ?to= (ISO 8601 or Unix seconds), and ?before=<id> from the previous page.
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_LIMIT = int(os.getenv("HISTORY_MAX_LIMIT", "500"))
+
+# Content queues, submission locks, flags and command events live in a state
+# backend, keyed by client id: "memory" for a single worker, "sqlite" (WAL
+# file at STATE_DB_PATH) to share them between gunicorn workers. The memory
+# backend survives restarts when STATE_JOURNAL_DIR is set: changes are
+# journaled (fsync'd in groups) and a snapshot is taken every
+# STATE_SNAPSHOT_EVERY changes, which bounds replay time on startup.
+# Clients hold /commands/stream open (SSE) or long-poll it and get kill-switch,
+# capture and new-content events as they happen.
+# SUBMIT_WINDOW is how many items may be queued but unacknowledged at once
+# (1 keeps the original lock-step submit/acknowledge behaviour).
+COMMAND_STREAM_TIMEOUT = float(os.getenv("COMMAND_STREAM_TIMEOUT", "25"))
+SUBMIT_WINDOW = int(os.getenv("SUBMIT_WINDOW", "1"))
+NEXT_MAX_ITEMS = int(os.getenv("NEXT_MAX_ITEMS", "100"))
+# Items larger than CONTENT_SPOOL_THRESHOLD bytes are written to files under
+# CONTENT_SPOOL_DIR (shared by all workers); the state backend and command
+# events only carry a preview. /latest and /items/<id>/content stream the
+# full text and accept Range or ?offset=&length= (bytes of UTF-8).
+CONTENT_SPOOL_DIR = os.getenv("CONTENT_SPOOL_DIR", "content-spool")
+CONTENT_SPOOL_THRESHOLD = int(os.getenv("CONTENT_SPOOL_THRESHOLD", str(64 * 1024)))
+content_spool = ContentSpool(CONTENT_SPOOL_DIR, CONTENT_SPOOL_THRESHOLD)
+# Text, HTML and JSON responses of at least COMPRESS_MIN_SIZE bytes are
+# compressed with the first of COMPRESS_ENCODINGS the client accepts (zstd and
+# br need the zstandard / brotli packages; empty disables compression).
+# Request bodies may be sent with Content-Encoding: gzip, up to
+# DECODED_BODY_MAX_SIZE bytes once decoded.
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_ENCODINGS = available_encodings(os.getenv("COMPRESS_ENCODINGS", "zstd,br,gzip").split(","))
+DECODED_BODY_MAX_SIZE = int(os.getenv("DECODED_BODY_MAX_SIZE", str(256 * 1024 * 1024)))
+app.wsgi_app = DecodeRequestBody(app.wsgi_app, DECODED_BODY_MAX_SIZE)
+# /status and /dashboard/state carry the client's state version as ETag;
+# ?since=<version> waits up to this many seconds for it to change
+STATUS_WAIT_TIMEOUT = float(os.getenv("STATUS_WAIT_TIMEOUT", "20"))
+state = create_state_backend(
+    os.getenv("STATE_BACKEND", "memory"),
+    path=os.getenv("STATE_DB_PATH", "state.db"),
+    journal_dir=os.getenv("STATE_JOURNAL_DIR") or None,
+    snapshot_every=int(os.getenv("STATE_SNAPSHOT_EVERY", "10000")),
+    event_history=int(os.getenv("COMMAND_EVENT_HISTORY", "256")),
+    submit_window=SUBMIT_WINDOW,
+    schedule_history=int(os.getenv("CAPTURE_SCHEDULE_HISTORY", "32")),
+    content_history=int(os.getenv("CONTENT_HISTORY", "10000")),
+)
+# Captures are scheduled server-side: one-shot, bursts (count + interval) and
+# interval schedules (interval, optionally duration) that run until stopped.
+# /check_screenshot_command lists the captures due within CAPTURE_HORIZON
+# seconds; uploads name the capture they answer in X-Capture-Id. A schedule
+# has at most CAPTURE_MAX_COUNT captures, and its interval, duration and
+# delay are each at most CAPTURE_MAX_DURATION seconds.
+CAPTURE_HORIZON = float(os.getenv("CAPTURE_HORIZON", "10"))
+CAPTURE_MIN_INTERVAL = float(os.getenv("CAPTURE_MIN_INTERVAL", "0.2"))
+CAPTURE_MAX_COUNT = int(os.getenv("CAPTURE_MAX_COUNT", "1000"))
+CAPTURE_MAX_DURATION = float(os.getenv("CAPTURE_MAX_DURATION", str(24 * 3600)))
+
+# Request metrics and queue/store gauges, served at /metrics (Prometheus text
+# format). Lock time is submit -> acknowledge per item; capture latency is a
+# scheduled capture's due time -> its upload.
+metrics = Registry()
+http_requests = metrics.counter("http_requests_total", "HTTP requests served", ["method", "route", "status"])
+http_latency = metrics.histogram("http_request_duration_seconds", "Time to produce the response (first byte for streams)", ["route"])
+http_response_size = metrics.histogram("http_response_size_bytes", "Response body size", ["route"], SIZE_BUCKETS)
+auth_rejected = metrics.counter("http_auth_rejected_total", "Requests rejected for a missing or invalid key", ["route"])
+lock_duration = metrics.histogram("content_lock_duration_seconds", "Time from submit to acknowledge of an item", buckets=DURATION_BUCKETS)
+capture_rtt = metrics.histogram("screenshot_capture_rtt_seconds", "Time from a capture's due time to its upload", buckets=DURATION_BUCKETS)
+image_processing_time = metrics.histogram("image_processing_seconds", "Time from upload to stored thumbnail and display copy")
+image_pipeline_rejected = metrics.counter("image_pipeline_rejected_total", "Uploads refused with 503 while the image pipeline was full")
+rate_limited = metrics.counter("http_rate_limited_total", "Requests refused with 429 by per-client rate limits", ["route_class"])
+typed_characters = metrics.counter("content_typed_characters_total", "Characters clients reported typing (POST /progress)", ["client_id"])
+upload_budget_rejected = metrics.counter("upload_budget_rejected_total", "Uploads refused with 503 while the upload byte budget was spent")
+lock_timer = InFlightTimer()  # (client_id, item_id)
+metrics.gauge("content_queue_depth", "Items queued but not acknowledged",
+              lambda: [((c["client_id"],), state.queue_size(c["client_id"])) for c in state.clients()], ["client_id"])
+metrics.gauge("content_lock_inflight_seconds", "Age of the oldest unacknowledged item",
+              lambda: [((client_id,), age) for client_id, age in lock_timer.oldest(lambda key: key[0]).items()], ["client_id"])
+metrics.gauge("screenshot_capture_pending_seconds", "Age of the oldest due capture not uploaded yet",
+              lambda: [((client_id,), age) for client_id, age in oldest_pending_captures().items()], ["client_id"])
+metrics.gauge("screenshot_captures_dropped", "Captures of retained schedules never uploaded within the grace period",
+              lambda: [((client_id,), dropped) for client_id, dropped in dropped_captures().items()], ["client_id"])
+metrics.gauge("image_pipeline_pending", "Uploads queued or being processed by the image pipeline",
+              lambda: [((), image_pipeline.pending)])
+metrics.gauge("upload_bytes_in_flight", "Upload body bytes being received, counted against UPLOAD_BUDGET_BYTES",
+              lambda: [((), upload_budget.in_flight)])
+metrics.gauge("screenshots_stored", "Screenshots held in the store",
+              lambda: [((client_id,), len(store)) for client_id, store in list(screenshot_stores.items())], ["client_id"])
+metrics.gauge("screenshots_stored_bytes", "Bytes held in the store, including thumbnails",
+              lambda: [((client_id,), store.total_bytes) for client_id, store in list(screenshot_stores.items())], ["client_id"])
+
+FORM_MIMETYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+RAW_CONTENT_MIMETYPES = ('text/plain', 'application/octet-stream')
+DELTA_TILE_FIELD = re.compile(r'tile-(\d+)-(\d+)')
+CAPTURE_SCHEDULE_FIELDS = ('count', 'interval', 'duration', 'delay')
+
+
+def valid_client_id(client_id):
+    if not isinstance(client_id, str) or not CLIENT_ID_PATTERN.fullmatch(client_id):
+        abort(400, description="Invalid client_id")
+    return client_id
+
+
+def request_client_id(body=None):
+    """Return the client a request is scoped to.
+
+    Read from the X-Client-Id header, the client_id query/form parameter or
+    the parsed JSON `body`; requests without one belong to the client of
+    their token, or the "default" client. A client token is refused (403)
+    for any other client.
+    """
+    client_id = request.headers.get('X-Client-Id') or request.args.get('client_id')
+    if not client_id and request.mimetype in FORM_MIMETYPES:
+        client_id = request.form.get('client_id')
+    if not client_id and body:
+        client_id = body.get('client_id')
+    auth_client = g.get('auth_client')
+    client_id = valid_client_id(client_id or auth_client or DEFAULT_CLIENT_ID)
+    check_client_access([client_id])
+    return client_id
+
+
+def check_client_access(client_ids):
+    """403 unless the request's key is valid for every one of `client_ids`."""
+    auth_client = g.get('auth_client')
+    if auth_client and any(client_id != auth_client for client_id in client_ids):
+        abort(403, description="Key is not valid for this client")
+
+
+def request_key():
+    """The key a request carries; headers and the query string come first.
+
+    Older clients send it in form or JSON bodies, which are only read for it
+    up to AUTH_BODY_KEY_MAX_SIZE bytes: a larger body without a key in a
+    header is rejected unread.
+    """
+    key = request_token(request.headers.get('Authorization'), request.headers.get('X-Key'), request.args.get('key'))
+    if key or not request.content_length or request.content_length > AUTH_BODY_KEY_MAX_SIZE:
+        return key
+    if request.mimetype in FORM_MIMETYPES:
+        return request.form.get('key')
+    if request.is_json:
+        body = request.get_json(silent=True)
+        return body.get('key') if isinstance(body, dict) else None
+    return None
+
+
+def require_key(admin=False, logger=log, limit=None):
+    """Route decorator: answer 403 unless the request carries a valid key.
+
+    Runs before the view reads the body. Client tokens are scoped to their
+    client by request_client_id; `admin` routes need SECRET_KEY itself.
+    Requests are then counted against the client's `limit` route class
+    ("poll" or "upload"; admin routes are always "admin"), see rate_limit.
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            principal = tokens.authenticate(request_key())
+            if principal is None or (admin and principal != ALL_CLIENTS):
+                auth_rejected.inc(request.url_rule.rule)
+                logger.warning("%s %s rejected: Invalid key", request.method, request.path)
+                return "Invalid key", 403
+            g.auth_client = None if principal == ALL_CLIENTS else principal
+            route_class = "admin" if admin else limit
+            if route_class is not None:
+                client_id = g.auth_client or request.headers.get('X-Client-Id') or request.args.get('client_id')
+                refused = rate_limit(route_class, client_id or DEFAULT_CLIENT_ID, logger)
+                if refused is not None:
+                    return refused
+            return view(*args, **kwargs)
+        wrapper.required_key = "admin" if admin else "client"  # read by asgi.py before the body arrives
+        return wrapper
+    return decorate
+
+
+def rate_limit(route_class, client_id, logger=log):
+    """None if `client_id` may make another `route_class` request, else a 429 response.
+
+    Clients are told by their token, X-Client-Id or ?client_id= (a client_id
+    in the body is not read for this); requests without one count as the
+    default client.
+    """
+    retry_after = rate_limiter.admit(client_id, route_class)
+    if not retry_after:
+        return None
+    rate_limited.inc(route_class)
+    logger.info("%s %s rejected: %s rate limit exceeded for %s", request.method, request.path, route_class, client_id)
+    return "Too many requests, retry later", 429, {'Retry-After': str(math.ceil(retry_after))}
+
+
+def target_client_ids(client_id, options):
+    """Clients a fan-out capable request applies to.
+
+    `options` is the form or JSON body: broadcast=1 targets every registered
+    client, clients=a,b,c a list, otherwise just `client_id`.
+    """
+    if str(options.get('broadcast', '')).lower() in ('1', 'true', 'on'):
+        targets = [client["client_id"] for client in state.clients()]
+    elif options.get('clients'):
+        clients = options['clients']
+        if isinstance(clients, str):
+            clients = clients.split(',')
+        targets = [valid_client_id(c.strip()) for c in clients if c.strip()]
+    else:
+        return [client_id]
+    check_client_access(targets)
+    return targets
+
+
+def request_capture_id(body=None):
+    """Return the capture an upload answers, or None.
+
+    Read from the X-Capture-Id header, the capture_id query/form parameter or
+    the parsed JSON `body`.
+    """
+    capture_id = request.headers.get('X-Capture-Id') or request.args.get('capture_id')
+    if not capture_id and request.mimetype in FORM_MIMETYPES:
+        capture_id = request.form.get('capture_id')
+    if not capture_id and body:
+        capture_id = body.get('capture_id')
+    return capture_id
+
+
+def screenshot_store_for(client_id):
+    """Return (creating on first use) the screenshot store for a registered client."""
+    store = screenshot_stores.get(client_id)
+    if store is None:
+        if not state.has_client(client_id):
+            raise UnknownClient(client_id)
+        with screenshot_stores_lock:
+            store = screenshot_stores.get(client_id)
+            if store is None:
+                store = screenshot_stores[client_id] = create_screenshot_store(
+                    SCREENSHOT_BACKEND, root=os.path.join(SCREENSHOT_DIR, client_id), **SCREENSHOT_LIMITS
+                )
+    return store
+
+
+def command_snapshot(client_id):
+    """Return (events, last_id) describing the current state for a fresh subscriber.
+
+    A pending capture request is consumed here, the same way
+    /check_screenshot_command consumes it; captures already due are listed.
+    """
+    snapshot = state.subscribe_snapshot(client_id)
+    last_id = snapshot["last_event_id"]
+    captures = pending_captures(client_id, CAPTURE_HORIZON)
+    events = []
+    if snapshot["kill_switch"]:
+        events.append({"id": last_id, "type": "kill_switch", "data": {"active": True}})
+    if snapshot["capture_requested"] or captures:
+        events.append({"id": last_id, "type": "capture_screenshot", "data": {"captures": captures}})
+    if snapshot["head"] is not None:
+        events.append({"id": last_id, "type": "content", "data": public_item(snapshot["head"])})
+    return events, last_id
+
+
+def consume_command_events(client_id, events):
+    """Clear the legacy capture flag for capture events delivered over the stream."""
+    if any(event["type"] == "capture_screenshot" for event in events):
+        state.take_capture_request(client_id)
+    return events
+
+
+def public_item(item):
+    """A queue item as clients see it.
+
+    Spooled items carry a preview as `content`, plus `size` and
+    `spooled`; fetch the full text from /items/<id>/content. Items being
+    typed carry `typed`, the characters already confirmed via /progress.
+    """
+    info = describe(item["content"])
+    if not info["spooled"]:
+        return item
+    public = {"id": item["id"], "content": info["preview"], "size": info["size"], "spooled": True}
+    if "typed" in item:
+        public["typed"] = item["typed"]
+    return public
+
+
+def release_items(items):
+    """Delete the spool files of items that left the queue."""
+    for item in items:
+        content_spool.delete(item["content"])
+
+
+def send_item_content(item):
+    """Stream a queue item's full text.
+
+    Supports Range requests and ?offset=&length= (both in bytes of the UTF-8
+    text); X-Content-Size is the full size. X-Typed-Offset is the number of
+    characters already confirmed typed: a resumed item continues from there.
+    """
+    try:
+        offset = int(request.args.get('offset') or 0)
+        length = int(request.args['length']) if request.args.get('length') else None
+    except ValueError:
+        abort(400, description="Invalid offset or length")
+    if offset < 0 or (length is not None and length < 0):
+        abort(400, description="Invalid offset or length")
+
+    path = content_spool.path(item['content'])
+    size = describe(item['content'])['size']
+    try:
+        if request.args.get('offset') or request.args.get('length'):
+            body = open(path, 'rb') if path else io.BytesIO(item['content'].encode('utf-8'))
+            offset = min(offset, size)
+            end = size if length is None else min(size, offset + length)
+            body.seek(offset)
+            response = Response(iter_file_range(body, end - offset), mimetype='text/plain')
+            response.content_length = end - offset
+            response.headers['X-Content-Offset'] = str(offset)
+        else:
+            response = send_file(
+                path or io.BytesIO(item['content'].encode('utf-8')),
+                mimetype='text/plain',
+                etag=f"item-{item['id']}",
+                conditional=True,
+                max_age=0,
+            )
+    except FileNotFoundError:  # acknowledged while we were looking it up
+        return "No content available", 404
+    response.headers['X-Item-Id'] = str(item['id'])
+    response.headers['X-Content-Size'] = str(size)
+    response.headers['X-Typed-Offset'] = str(item.get('typed', 0))
+    return response
+
+
+def iter_file_range(body, length):
+    with body:
+        while length > 0:
+            chunk = body.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def pending_captures(client_id, horizon=0.0, now=None):
+    """Unfulfilled captures due by `now + horizon` across the client's schedules, oldest first."""
+    now = time.time() if now is None else now
+    captures = []
+    for schedule in state.capture_schedules(client_id, active=True):
+        captures.extend(due_captures(schedule, now, horizon))
+    return sorted(captures, key=lambda capture: capture["due"])
+
+
+def parse_capture_schedule(options):
+    """Read (count, interval, start) for a capture schedule from form fields.
+
+    `count` captures (default 1, or until stopped when an `interval` is
+    given) `interval` seconds apart; `duration` bounds an interval schedule
+    in seconds and `delay` postpones the first capture. Raises ValueError.
+    """
+    interval = float(options.get('interval') or 0)
+    delay = float(options.get('delay') or 0)
+    duration = float(options['duration']) if options.get('duration') else None
+    count = int(options['count']) if options.get('count') else None
+    if not all(math.isfinite(value) and value >= 0 for value in (interval, delay, duration or 0)):
+        raise ValueError("interval, duration and delay must be non-negative numbers")
+    for name, value in (("interval", interval), ("duration", duration or 0), ("delay", delay)):
+        if value > CAPTURE_MAX_DURATION:
+            raise ValueError(f"{name} must be at most CAPTURE_MAX_DURATION ({CAPTURE_MAX_DURATION:g} seconds)")
+    if 0 < interval < CAPTURE_MIN_INTERVAL:
+        raise ValueError(f"interval must be at least CAPTURE_MIN_INTERVAL ({CAPTURE_MIN_INTERVAL:g} seconds)")
+    if count is not None and not 1 <= count <= CAPTURE_MAX_COUNT:
+        raise ValueError(f"count must be between 1 and CAPTURE_MAX_COUNT ({CAPTURE_MAX_COUNT})")
+    if duration is not None:
+        if not interval:
+            raise ValueError("duration needs an interval")
+        runs = math.floor(duration / interval) + 1
+        if count is None and runs > CAPTURE_MAX_COUNT:
+            raise ValueError(f"duration={duration:g} at interval={interval:g} asks for {runs} captures, "
+                             f"over CAPTURE_MAX_COUNT ({CAPTURE_MAX_COUNT}); pass a count or a longer interval")
+        count = min(count, runs) if count else runs
+    if count is None and not interval:
+        count = 1
+    return count, interval, time.time() + delay
+
+
+def parse_ack_selection(form):
+    """Read which queue items an acknowledgement covers.
+
+    Accepts repeated `id` fields, a comma-separated `ids` field and/or an
+    inclusive `from`/`to` range. Returns (ids, id_range); both None means
+    "the queue head". Raises ValueError on malformed ids.
+    """
+    ids = [int(i) for i in form.getlist('id')]
+    if form.get('ids'):
+        ids.extend(int(i) for i in form['ids'].split(',') if i.strip())
+    id_range = None
+    if form.get('from') or form.get('to'):
+        id_range = (int(form.get('from') or 0), int(form['to']) if form.get('to') else 2**63 - 1)
+    return (ids or None), id_range
+
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+
+def parse_stream_timeout(args):
+    """?timeout= for /commands/stream, clamped to [1, COMMAND_STREAM_TIMEOUT] seconds.
+
+    Raises ValueError on malformed values.
+    """
+    timeout = float(args.get('timeout', COMMAND_STREAM_TIMEOUT))
+    if math.isnan(timeout):
+        raise ValueError(timeout)
+    return max(1.0, min(timeout, COMMAND_STREAM_TIMEOUT))
+
 
 FORM_RENDER = '''
 <!DOCTYPE html>
@@ -24,11 +520,18 @@ FORM_RENDER = '''
     <title>Content & Screenshot Manager</title>
     <script src="https://cdn.tailwindcss.com"></script>
 </head>
-<body class="bg-gray-100 min-h-screen">
+<body class="bg-gray-100 min-h-screen" data-key="{{ secret_key }}" data-client-id="{{ client_id }}" data-version="{{ version }}">
     <div class="container mx-auto p-4">
         <!-- Header -->
         <div class="bg-white p-6 rounded-lg shadow-lg mb-6">
             <h1 class="text-3xl font-bold mb-4 text-gray-800">Content & Screenshot Manager</h1>
+
+            <div class="mb-4 flex flex-wrap gap-2 text-sm">
+                <span class="font-medium text-gray-700">Client:</span>
+                {% for client in clients %}
+                    <a href="/?client_id={{ client.client_id }}" class="px-2 py-1 rounded {% if client.client_id == client_id %}bg-indigo-600 text-white{% else %}bg-gray-200 text-gray-800{% endif %}">{{ client.name }}</a>
+                {% endfor %}
+            </div>
             
             <div id="status" class="mb-6 p-4 bg-{% if locked %}yellow-100{% else %}green-100{% endif %} rounded">
                 <p class="text-sm font-medium">
@@ -39,6 +542,9 @@ FORM_RENDER = '''
                     {% endif %}
                 </p>
                 <p class="text-sm">Content queue size: <span id="queue-size">{{ queue_size }}</span></p>
+                <p class="text-sm">Typing progress: <span id="typing-progress">{% if progress %}item {{ progress.id }}: {{ progress.typed }}{% if progress.length %} / {{ progress.length }}{% endif %} characters{% if progress.length %} ({{ (100 * progress.typed // progress.length) if progress.typed < progress.length else 100 }}%){% endif %}{% else %}Idle{% endif %}</span></p>
+                <p id="parked" class="text-sm{% if not parked %} hidden{% endif %}">Interrupted: <span id="parked-items">{% for item in parked %}item {{ item.id }} at {{ item.typed }} characters{% if not loop.last %}, {% endif %}{% endfor %}</span>
+                    <button type="button" onclick="resumeItems()" class="ml-2 text-indigo-600 hover:text-indigo-800">Resume</button></p>
                 <p class="text-sm">Screenshots collected: <span id="screenshot-count">{{ screenshot_count }}</span></p>
                 <p class="text-sm">Kill switch: <span id="kill-status" class="{% if kill_switch %}text-red-700 font-bold{% else %}text-green-700{% endif %}">{% if kill_switch %}ACTIVATED{% else %}Inactive{% endif %}</span></p>
             </div>
@@ -54,6 +560,9 @@ FORM_RENDER = '''
                 <button onclick="deactivateKillSwitch()" class="bg-green-600 text-white py-2 px-4 rounded-md hover:bg-green-700 focus:outline-none focus:ring-2 focus:ring-green-500 focus:ring-offset-2">
                     ✅ Deactivate Kill Switch
                 </button>
+                <button onclick="activateKillSwitch(true)" class="bg-red-800 text-white py-2 px-4 rounded-md hover:bg-red-900 focus:outline-none focus:ring-2 focus:ring-red-500 focus:ring-offset-2 font-bold">
+                    🛑 Kill All Clients
+                </button>
             </div>
             <p class="text-sm text-red-600 mt-2">
                 <strong>Warning:</strong> Kill switch will immediately terminate the client application. Use only in emergencies.
@@ -64,6 +573,7 @@ FORM_RENDER = '''
         <div class="bg-white p-6 rounded-lg shadow-lg mb-6">
             <h2 class="text-xl font-semibold mb-4 text-gray-800">Submit Content</h2>
             <form id="submit-form" method="POST" action="/submit" class="space-y-4">
+                <input type="hidden" name="client_id" value="{{ client_id }}">
                 <div>
                     <label for="content" class="block text-sm font-medium text-gray-700">Content</label>
                     <textarea id="content" name="content" rows="6" class="mt-1 block w-full rounded-md border-gray-300 shadow-sm focus:border-indigo-300 focus:ring focus:ring-indigo-200 focus:ring-opacity-50" required></textarea>
@@ -75,10 +585,14 @@ FORM_RENDER = '''
                     <button type="button" onclick="clearQueue()" class="bg-orange-600 text-white py-2 px-4 rounded-md hover:bg-orange-700 focus:outline-none focus:ring-2 focus:ring-orange-500 focus:ring-offset-2">
                         Clear Queue
                     </button>
+                    <label class="flex items-center text-sm text-gray-700">
+                        <input type="checkbox" name="broadcast" value="1" class="mr-2">
+                        Send to all clients
+                    </label>
                 </div>
             </form>
             <div class="mt-4 text-sm text-gray-600">
-                <p><strong>Note:</strong> Press ESC while typing to interrupt the current task. The task will be removed from the queue and you'll need to resubmit it.</p>
+                <p><strong>Note:</strong> Press ESC while typing to interrupt the current task. The task will be removed from the queue and you'll need to resubmit it, unless the client keeps it as interrupted: then Resume continues from the last character it reported.</p>
             </div>
         </div>
 
@@ -89,10 +603,30 @@ FORM_RENDER = '''
                 <button onclick="requestScreenshot()" class="bg-green-600 text-white py-2 px-4 rounded-md hover:bg-green-700 focus:outline-none focus:ring-2 focus:ring-green-500 focus:ring-offset-2">
                     Capture Screenshot
                 </button>
+                <button onclick="requestScreenshot(true)" class="bg-green-800 text-white py-2 px-4 rounded-md hover:bg-green-900 focus:outline-none focus:ring-2 focus:ring-green-500 focus:ring-offset-2">
+                    Capture All Clients
+                </button>
                 <button onclick="clearScreenshots()" class="bg-red-600 text-white py-2 px-4 rounded-md hover:bg-red-700 focus:outline-none focus:ring-2 focus:ring-red-500 focus:ring-offset-2">
                     Clear All Screenshots
                 </button>
             </div>
+            <div class="mt-4 flex flex-wrap items-end gap-4 text-sm">
+                <label class="text-gray-700">Count
+                    <input id="capture-count" type="number" min="1" placeholder="until stopped" class="mt-1 block w-32 rounded-md border-gray-300 shadow-sm">
+                </label>
+                <label class="text-gray-700">Every (seconds)
+                    <input id="capture-interval" type="number" min="0" step="0.1" value="2" class="mt-1 block w-32 rounded-md border-gray-300 shadow-sm">
+                </label>
+                <label class="text-gray-700">For (seconds)
+                    <input id="capture-duration" type="number" min="0" placeholder="until stopped" class="mt-1 block w-32 rounded-md border-gray-300 shadow-sm">
+                </label>
+                <button onclick="startCaptureSchedule()" class="bg-green-600 text-white py-2 px-4 rounded-md hover:bg-green-700 focus:outline-none focus:ring-2 focus:ring-green-500 focus:ring-offset-2">
+                    Start Schedule
+                </button>
+                <button onclick="stopCaptureSchedules()" class="bg-gray-600 text-white py-2 px-4 rounded-md hover:bg-gray-700 focus:outline-none focus:ring-2 focus:ring-gray-500 focus:ring-offset-2">
+                    Stop Schedules
+                </button>
+            </div>
         </div>
 
         <!-- Screenshot Gallery -->
@@ -101,8 +635,8 @@ FORM_RENDER = '''
             <div id="screenshot-gallery" class="grid grid-cols-1 md:grid-cols-2 lg:grid-cols-3 gap-4">
                 {% if screenshots %}
                     {% for screenshot in screenshots %}
-                        <div class="border rounded-lg p-3 bg-gray-50">
-                            <img src="data:image/png;base64,{{ screenshot.data }}" alt="Screenshot {{ loop.index }}" class="w-full h-48 object-cover rounded cursor-pointer" onclick="openModal('{{ screenshot.data }}', '{{ screenshot.timestamp }}')">
+                        <div class="border rounded-lg p-3 bg-gray-50" data-screenshot-id="{{ screenshot.id }}" data-timestamp="{{ screenshot.timestamp }}" data-thumb="{{ 'true' if 'thumb' in screenshot.variants else 'false' }}">
+                            <img src="/screenshots/{{ screenshot.id }}/thumb?key={{ secret_key }}&client_id={{ client_id }}" loading="lazy" alt="Screenshot {{ loop.index }}" class="w-full h-48 object-cover rounded cursor-pointer">
                             <p class="text-xs text-gray-500 mt-2">{{ screenshot.timestamp }}</p>
                         </div>
                     {% endfor %}
@@ -115,22 +649,22 @@ FORM_RENDER = '''
         <!-- Recent Content Submissions -->
         <div class="bg-white p-6 rounded-lg shadow-lg">
             <h2 class="text-xl font-semibold mb-4 text-gray-800">Recent Content Submissions</h2>
-            {% if recent_items %}
-                <ul class="space-y-2">
-                    {% for item in recent_items %}
-                        <li class="text-sm text-gray-600 bg-gray-50 p-3 rounded">{{ item[:200] }}{% if item|length > 200 %}...{% endif %}</li>
-                    {% endfor %}
-                </ul>
-            {% else %}
-                <p class="text-sm text-gray-500">No submissions yet</p>
-            {% endif %}
+            <div id="recent-items">
+                {% if recent_items %}
+                    <ul class="space-y-2">
+                        {% for item in recent_items %}
+                            <li class="text-sm text-gray-600 bg-gray-50 p-3 rounded">{{ item.content }}</li>
+                        {% endfor %}
+                    </ul>
+                {% else %}
+                    <p class="text-sm text-gray-500">No submissions yet</p>
+                {% endif %}
+            </div>
         </div>
 
-        {% if locked %}
-            <div class="mt-6 text-center">
-                <a href="/force_unlock?key={{ secret_key }}" class="text-sm text-red-600 hover:text-red-800">Emergency Force Unlock</a>
-            </div>
-        {% endif %}
+        <div id="force-unlock" class="mt-6 text-center{% if not locked %} hidden{% endif %}">
+            <a href="/force_unlock?key={{ secret_key }}&client_id={{ client_id }}" class="text-sm text-red-600 hover:text-red-800">Emergency Force Unlock</a>
+        </div>
     </div>
 
     <!-- Screenshot Modal -->
@@ -145,473 +679,1197 @@ FORM_RENDER = '''
         </div>
     </div>
 
-    <script>
-        function updateStatus() {
-            fetch('/status?key={{ secret_key }}')
-                .then(response => {
-                    if (!response.ok) {
-                        throw new Error(`HTTP error! status: ${response.status}`);
-                    }
-                    return response.json();
-                })
-                .then(data => {
-                    console.log('Status update:', data);
-                    const statusDiv = document.getElementById('status');
-                    const queueSizeSpan = document.getElementById('queue-size');
-                    const screenshotCountSpan = document.getElementById('screenshot-count');
-                    const killStatusSpan = document.getElementById('kill-status');
-                    const submitButton = document.querySelector('form button');
-
-                    queueSizeSpan.textContent = data.queue_size;
-                    screenshotCountSpan.textContent = data.screenshot_count || 0;
-                    
-                    // Update kill switch status
-                    if (data.kill_switch) {
-                        killStatusSpan.textContent = 'ACTIVATED';
-                        killStatusSpan.className = 'text-red-700 font-bold';
-                    } else {
-                        killStatusSpan.textContent = 'Inactive';
-                        killStatusSpan.className = 'text-green-700';
-                    }
-                    
-                    if (data.locked) {
-                        statusDiv.classList.remove('bg-green-100');
-                        statusDiv.classList.add('bg-yellow-100');
-                        statusDiv.querySelector('p:first-child').innerHTML = '<span class="text-yellow-700">Locked - Waiting for typing acknowledgement</span>';
-                        submitButton.disabled = true;
-                        submitButton.textContent = 'Submission Locked';
-                    } else {
-                        statusDiv.classList.remove('bg-yellow-100');
-                        statusDiv.classList.add('bg-green-100');
-                        statusDiv.querySelector('p:first-child').innerHTML = '<span class="text-green-700">Ready to accept submissions</span>';
-                        submitButton.disabled = false;
-                        submitButton.textContent = 'Submit Content';
-                    }
-                })
-                .catch(error => {
-                    console.error('Status update failed:', error);
-                });
-        }
+    <script src="{{ dashboard_js_url }}"></script>
+</body>
+</html>
+'''
 
-        function activateKillSwitch() {
-            if (confirm('⚠️ WARNING: This will immediately terminate the client application. Are you sure?')) {
-                fetch('/activate_kill_switch', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: `key={{ secret_key }}`
-                })
-                .then(response => response.text())
-                .then(data => {
-                    alert('🛑 KILL SWITCH ACTIVATED - Client will terminate');
-                    updateStatus();
-                })
-                .catch(error => {
-                    console.error('Error activating kill switch:', error);
-                    alert('Failed to activate kill switch');
-                });
-            }
-        }
+# Compiled once; render_template_string would re-parse the template per request
+DASHBOARD_TEMPLATE = app.jinja_env.from_string(FORM_RENDER)
+# The dashboard script is a static file; its URL carries a content hash so it
+# can be cached indefinitely
+DASHBOARD_ASSET_MAX_AGE = 365 * 24 * 3600
+with open(os.path.join(app.static_folder, 'dashboard.js'), 'rb') as f:
+    DASHBOARD_JS_URL = f"/static/dashboard.js?v={hashlib.sha256(f.read()).hexdigest()[:12]}"
 
-        function deactivateKillSwitch() {
-            fetch('/deactivate_kill_switch', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                },
-                body: `key={{ secret_key }}`
-            })
-            .then(response => response.text())
-            .then(data => {
-                alert('✅ Kill switch deactivated');
-                updateStatus();
-            })
-            .catch(error => {
-                console.error('Error deactivating kill switch:', error);
-                alert('Failed to deactivate kill switch');
-            });
-        }
 
-        function requestScreenshot() {
-            fetch('/request_screenshot', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                },
-                body: `key={{ secret_key }}`
-            })
-            .then(response => response.text())
-            .then(data => {
-                alert('Screenshot request sent to client');
-                setTimeout(() => location.reload(), 2000); // Reload after 2 seconds
-            })
-            .catch(error => {
-                console.error('Error requesting screenshot:', error);
-                alert('Failed to request screenshot');
-            });
-        }
+def recent_item_previews(client_id, limit=5):
+    previews = []
+    for item in state.recent(client_id, limit):
+        content = describe(item["content"])["preview"]  # spooled items are always longer than 200
+        previews.append({"id": item["id"], "content": content[:200] + ("..." if len(content) > 200 else "")})
+    return previews
 
-        function clearScreenshots() {
-            if (confirm('Are you sure you want to clear all screenshots?')) {
-                fetch('/clear_screenshots', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: `key={{ secret_key }}`
-                })
-                .then(response => response.text())
-                .then(data => {
-                    alert('Screenshots cleared');
-                    location.reload();
-                })
-                .catch(error => {
-                    console.error('Error clearing screenshots:', error);
-                    alert('Failed to clear screenshots');
-                });
-            }
-        }
+def finish_lock_timers(client_id, items):
+    for item in items:
+        elapsed = lock_timer.finish((client_id, item["id"]))
+        if elapsed is not None:
+            lock_duration.observe(elapsed)
 
-        function openModal(imageData, timestamp) {
-            const modal = document.getElementById('screenshot-modal');
-            const modalImage = document.getElementById('modal-image');
-            const modalTimestamp = document.getElementById('modal-timestamp');
-            
-            modalImage.src = 'data:image/png;base64,' + imageData;
-            modalTimestamp.textContent = 'Captured: ' + timestamp;
-            modal.classList.remove('hidden');
-        }
 
-        function closeModal() {
-            const modal = document.getElementById('screenshot-modal');
-            modal.classList.add('hidden');
-        }
+def fulfil_capture(client_id, capture_id=None):
+    """Match an upload to the capture it answers and record the capture latency.
 
-        function clearQueue() {
-            if (confirm('Are you sure you want to clear the entire content queue?')) {
-                fetch('/clear_queue', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/x-www-form-urlencoded',
-                    },
-                    body: `key={{ secret_key }}`
-                })
-                .then(response => response.text())
-                .then(data => {
-                    alert('Content queue cleared');
-                    location.reload();
-                })
-                .catch(error => {
-                    console.error('Error clearing queue:', error);
-                    alert('Failed to clear queue');
-                });
-            }
-        }
+    Uploads without a capture id (older clients) answer the oldest due
+    capture. Returns the matched capture id, or None.
+    """
+    now = time.time()
+    schedules = {schedule["id"]: schedule for schedule in state.capture_schedules(client_id, active=True)}
+    if not capture_id:
+        pending = sorted(
+            (capture for schedule in schedules.values() for capture in due_captures(schedule, now, limit=1)),
+            key=lambda capture: capture["due"],
+        )
+        if not pending:
+            return None
+        capture_id = pending[0]["id"]
+    try:
+        schedule_id, n = parse_capture_id(capture_id)
+    except ValueError:
+        log.info("Ignoring malformed capture id %r", capture_id)
+        return None
+    schedule = schedules.get(schedule_id)
+    if schedule is None:
+        return None
+    latency = max(now - (schedule["start"] + n * schedule["interval"]), 0.0)
+    if not state.fulfil_capture(client_id, schedule_id, n, latency):
+        return None
+    capture_rtt.observe(latency)
+    return capture_id
 
-        setInterval(updateStatus, 5000);
-        updateStatus();
-    </script>
-</body>
-</html>
-'''
+
+def oldest_pending_captures():
+    now = time.time()
+    ages = {}
+    for client in state.clients():
+        captures = pending_captures(client["client_id"], now=now)
+        if captures:
+            ages[client["client_id"]] = now - captures[0]["due"]
+    return ages
+
+
+def dropped_captures():
+    now = time.time()
+    return {
+        client["client_id"]: sum(
+            schedule_summary(schedule, now)["dropped"] for schedule in state.capture_schedules(client["client_id"])
+        )
+        for client in state.clients()
+    }
+
+
+def observe_request(method, route, status, elapsed, size):
+    http_requests.inc(method, route, str(status))
+    http_latency.observe(elapsed, route)
+    if size is not None:
+        http_response_size.observe(size, route)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def cache_versioned_assets(response):
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code == 200:
+        response.cache_control.public = True
+        response.cache_control.max_age = DASHBOARD_ASSET_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        size = None if response.is_streamed else response.calculate_content_length()
+        observe_request(request.method, route, response.status_code, time.perf_counter() - started, size)
+    return response
+
+
+def compress_body(data, accept_encoding):
+    """(data, encoding) for a whole response body; encoding None if left as is."""
+    if len(data) < COMPRESS_MIN_SIZE:
+        return data, None
+    encoding = choose_encoding(accept_encoding, COMPRESS_ENCODINGS)
+    if encoding is None:
+        return data, None
+    return compress(data, encoding), encoding
+
+
+# Registered after the metrics hook so it runs first: sizes are recorded compressed
+@app.after_request
+def compress_response(response):
+    if (request.method == 'HEAD' or response.status_code != 200 or 'Content-Encoding' in response.headers
+            or not is_compressible(response.mimetype)):
+        return response
+    length = response.content_length if response.is_streamed else response.calculate_content_length()
+    if length is not None and length < COMPRESS_MIN_SIZE:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'), COMPRESS_ENCODINGS)
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        # e.g. spooled item content; compressed as it is sent
+        response.response = compress_stream(response.response, encoding)
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    # The encoded bytes differ, but If-None-Match still matches a weak tag
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+@app.errorhandler(UnknownClient)
+def unknown_client(e):
+    return f"Unknown client: {e.args[0]}", 404
+
+@app.errorhandler(PipelineFull)
+def image_pipeline_full(e):
+    image_pipeline_rejected.inc()
+    log.warning("Screenshot upload rejected: image pipeline full (%s)", e)
+    return "Image pipeline busy, retry later", 503, {'Retry-After': str(IMAGE_RETRY_AFTER)}
+
+@app.errorhandler(UploadBudgetExceeded)
+def upload_budget_exceeded(e):
+    upload_budget_rejected.inc()
+    log.warning("Screenshot upload rejected: upload byte budget spent (%s)", e)
+    return "Too many uploads in flight, retry later", 503, {'Retry-After': str(IMAGE_RETRY_AFTER)}
+
+@app.teardown_request
+def release_upload_reservation(exc):
+    reservation = g.pop('upload_reservation', None)
+    if reservation is not None:
+        reservation.release()
 
 @app.route('/')
 def index():
-    print("Rendering index page")
-    response = make_response(render_template_string(
-        FORM_RENDER,
-        locked=submission_locked,
-        queue_size=len(content_store),
-        screenshot_count=len(screenshot_store),
-        kill_switch=kill_switch_activated,
+    log.debug("Rendering index page")
+    client_id = request_client_id()
+    version = state.version(client_id)
+    current = build_status(client_id)
+    store = screenshot_store_for(client_id)
+    response = make_response(DASHBOARD_TEMPLATE.render(
+        client_id=client_id,
+        version=version,
+        clients=state.clients(),
+        locked=current["locked"],
+        queue_size=current["queue_size"],
+        progress=current["progress"],
+        parked=current["parked"],
+        screenshot_count=len(store),
+        kill_switch=current["kill_switch"],
         secret_key=SECRET_KEY,
-        recent_items=content_store[-5:] if content_store else [],
-        screenshots=screenshot_store[-10:] if screenshot_store else []  # Show last 10 screenshots
+        dashboard_js_url=DASHBOARD_JS_URL,
+        recent_items=recent_item_previews(client_id),
+        screenshots=store.recent(10)  # Show last 10 screenshots
     ))
     response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
     return response
 
-@app.route('/submit', methods=['POST'])
-def submit():
-    global submission_locked
+@app.route('/dashboard/state', methods=['GET'])
+@require_key(logger=poll_log)
+def dashboard_state():
+    """Everything the dashboard patches in place: status, gallery and recent items."""
+    return versioned_response(request_client_id(), build_dashboard_state)
+
+@app.route('/clients/register', methods=['POST'])
+@require_key(admin=True)
+def register_client():
+    """Register a client and return its id.
+
+    Pass client_id to choose the id (re-registering is harmless); otherwise
+    one is generated. An optional name is shown on the dashboard.
+    """
+    log.debug("Received client registration request")
     
-    print("Received submit request")
-    if submission_locked:
-        print("Submission rejected: Form is locked")
-        return "Submission locked. Wait for typing acknowledgement.", 403
+    client_id = valid_client_id(request.form.get('client_id') or uuid.uuid4().hex)
+    info = state.register_client(client_id, request.form.get('name'))
+    log.info("Client registered: %s", client_id)
     
-    content = request.form.get('content')
+    return jsonify(info)
+
+@app.route('/clients', methods=['GET'])
+@require_key(admin=True)
+def list_clients():
+    clients = []
+    for info in state.clients():
+        current = state.status(info["client_id"])
+        clients.append(dict(info, locked=current["locked"], queue_size=current["queue_size"],
+                            kill_switch=current["kill_switch"]))
+    return jsonify({"clients": clients})
+
+@app.route('/submit', methods=['POST'])
+def submit():
+    """Queue content for the client.
+
+    The dashboard form posts a single `content` field. Scripts can submit a
+    batch with repeated `content` fields or a JSON body {"items": [...]};
+    they get back the new item ids. A text/plain (or octet-stream) body is
+    one item, streamed to the content spool if it is large, with options in
+    the query string. A batch is accepted only if it fits in the in-flight
+    window (SUBMIT_WINDOW).
+    """
+    log.debug("Received submit request")
+    if request.mimetype in RAW_CONTENT_MIMETYPES:
+        options = request.args
+        try:
+            content = content_spool.put_stream(iter_upload_chunks(request.stream))
+        except InvalidContent:
+            log.info("Submission rejected: Body is not UTF-8")
+            return "Content must be UTF-8 text", 400
+        if not describe(content)["spooled"]:
+            content = content.replace('\x00', '').strip()
+        contents = [content] if content else []
+    else:
+        if request.is_json:
+            options = request.get_json(silent=True)
+            if not isinstance(options, dict) or not isinstance(options.get('items'), list):
+                log.info("Submission rejected: Body is not a JSON object with an items list")
+                return "Invalid JSON body", 400
+            texts = [c for c in options['items'] if isinstance(c, str)]
+        else:
+            options = request.form
+            texts = request.form.getlist('content')
+        # NUL never reaches the backend, so content cannot pose as a spool stub
+        texts = [c.replace('\x00', '').strip() for c in texts]
+        contents = [content_spool.put_text(c) for c in texts if c]
     
-    if not content:
-        print("Submission rejected: Missing content")
+    if not contents:
+        log.info("Submission rejected: Missing content")
         return "Missing content", 400
     
-    content_store.append(content.strip())
-    submission_locked = True
+    client_id = request_client_id(options if request.is_json else None)
+    targets = target_client_ids(client_id, options)
+    results = {}
+    for target in targets:
+        # Every client gets its own spool files, released on acknowledge
+        stored = contents if len(targets) == 1 else [content_spool.copy(c) for c in contents]
+        items = state.submit(target, stored)
+        if items is None:
+            log.info("Submission to %s rejected: Form is locked", target)
+            release_items({"content": c} for c in stored)
+            results[target] = None
+            continue
+        for item in items:
+            state.publish(target, "content", public_item(item))
+            lock_timer.start((target, item["id"]))
+        results[target] = [item["id"] for item in items]
+        log.info("%d item(s) submitted to %s", len(items), target)
+    if len(targets) > 1:
+        release_items({"content": c} for c in contents)
     
-    print(f"Content submitted and locked. Queue size: {len(content_store)}")
+    if len(targets) > 1:
+        if request.is_json:
+            return jsonify({"clients": {target: {"ids": ids} if ids is not None else {"error": "locked"}
+                                        for target, ids in results.items()}})
+        return redirect(f'/?client_id={client_id}', code=302)
     
-    return redirect('/', code=302)
+    ids = results.get(client_id)
+    if ids is None:
+        return "Submission locked. Wait for typing acknowledgement.", 403
+    if request.is_json or len(ids) > 1:
+        return jsonify({"ids": ids})
+    return redirect(f'/?client_id={client_id}', code=302)
 
 @app.route('/latest', methods=['GET'])
+@require_key(logger=poll_log, limit='poll')
 def get_latest():
-    key = request.args.get('key')
+    poll_log.debug("Received latest request")
     
-    print("Received latest request")
-    if not key:
-        print("Latest request rejected: Missing key")
-        return "Missing key parameter", 400
+    head = state.head(request_client_id())
+    if head is None:
+        poll_log.debug("Latest request: No content available")
+        return "No content available", 404
     
-    if key != SECRET_KEY:
-        print(f"Latest request rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
+    poll_log.debug("Returning next content (id %d): %.50s...", head['id'], public_item(head)['content'])
+    return send_item_content(head)
+
+@app.route('/items/<int:item_id>/content', methods=['GET'])
+@require_key(logger=poll_log, limit='poll')
+def item_content(item_id):
+    """The full text of any queued item; same Range / offset handling as /latest."""
+    items = state.next_items(request_client_id(), 1, after=item_id - 1)
+    if not items or items[0]['id'] != item_id:
+        return "Item not found", 404
     
-    if not content_store:
-        print("Latest request: No content available")
-        return "No content available", 404
+    return send_item_content(items[0])
+
+@app.route('/next', methods=['GET'])
+@require_key(logger=poll_log, limit='poll')
+def next_items():
+    """Return the next ?n= queued items in FIFO order, optionally ?after=<id>.
+
+    Spooled items are listed with a preview; see public_item.
+    """
+    try:
+        limit = min(max(int(request.args.get('n', 1)), 1), NEXT_MAX_ITEMS)
+        after = int(request.args['after']) if request.args.get('after') else None
+    except ValueError:
+        return "Invalid n or after parameter", 400
     
-    print(f"Returning latest content: {content_store[-1][:50]}...")
-    return content_store[-1]
+    return jsonify({"items": [public_item(item) for item in state.next_items(request_client_id(), limit, after)]})
 
 @app.route('/acknowledge', methods=['POST'])
+@require_key()
 def acknowledge():
-    global submission_locked, content_store
-    
-    print("Received ACK request")
-    
-    key = request.form.get('key')
-    if not key:
-        print("ACK rejected: Missing key parameter")
-        return "Missing key parameter", 400
+    log.debug("Received ACK request")
     
-    if key != SECRET_KEY:
-        print(f"ACK rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
+    try:
+        ids, id_range = parse_ack_selection(request.form)
+    except ValueError:
+        log.info("ACK rejected: Malformed item ids")
+        return "Invalid item ids", 400
     
-    print(f"ACK validated. Current queue size: {len(content_store)}, Locked: {submission_locked}")
+    client_id = request_client_id()
+    processed = state.acknowledge(client_id, ids, id_range)
+    finish_lock_timers(client_id, processed)
+    release_items(processed)
+    for item in processed:
+        log.info("Processed and removed content %d: %.50s...", item['id'], public_item(item)['content'])
+    if not processed:
+        log.info("No content in queue to process")
     
-    if content_store:
-        processed_content = content_store.pop(-1)
-        print(f"Processed and removed content: {processed_content[:50]}...")
-    else:
-        print("No content in queue to process")
-    
-    submission_locked = False
-    print(f"Acknowledgment processed. Submissions unlocked. New queue size: {len(content_store)}")
+    log.debug("Acknowledgment processed for %s", client_id)
     
+    if ids is not None or id_range is not None:
+        return jsonify({"acknowledged": [item["id"] for item in processed]})
     return "Acknowledgement received. New submissions allowed."
 
 @app.route('/interrupt_acknowledge', methods=['POST'])
+@require_key()
 def interrupt_acknowledge():
-    global submission_locked, content_store
-    
-    print("Received INTERRUPT ACK request")
+    log.debug("Received INTERRUPT ACK request")
     
-    key = request.form.get('key')
-    if not key:
-        print("Interrupt ACK rejected: Missing key parameter")
-        return "Missing key parameter", 400
+    try:
+        ids, id_range = parse_ack_selection(request.form)
+    except ValueError:
+        log.info("Interrupt ACK rejected: Malformed item ids")
+        return "Invalid item ids", 400
     
-    if key != SECRET_KEY:
-        print(f"Interrupt ACK rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
+    client_id = request_client_id()
+    if request.form.get('resume', '').lower() in ('1', 'true', 'on'):
+        return park_items(client_id, ids, id_range)
+    interrupted = state.acknowledge(client_id, ids, id_range, outcome="interrupted")
+    finish_lock_timers(client_id, interrupted)
+    release_items(interrupted)
+    for item in interrupted:
+        log.info("Interrupted and removed content %d: %.50s...", item['id'], public_item(item)['content'])
+    if interrupted:
+        log.info("Task was interrupted by user (ESC key) and removed from queue")
+    else:
+        log.info("No content in queue to remove")
     
-    print(f"Interrupt ACK validated. Current queue size: {len(content_store)}, Locked: {submission_locked}")
+    log.debug("Interrupt acknowledgment processed for %s", client_id)
     
-    if content_store:
-        interrupted_content = content_store.pop(-1)
-        print(f"Interrupted and removed content: {interrupted_content[:50]}...")
-        print("Task was interrupted by user (ESC key) and removed from queue")
+    if ids is not None or id_range is not None:
+        return jsonify({"interrupted": [item["id"] for item in interrupted]})
+    return "Interrupt acknowledgement received. Task removed from queue. New submissions allowed."
+
+def park_items(client_id, ids, id_range):
+    """interrupt_acknowledge with resume=1: keep the items and their progress for /resume."""
+    parked = state.park(client_id, ids, id_range)
+    for item in parked:
+        log.info("Interrupted and parked content %d at %d characters: %.50s...",
+                 item['id'], item['typed'], public_item(item)['content'])
+    if not parked:
+        log.info("No content in queue to park")
+    return jsonify({"parked": [{"id": item["id"], "typed": item["typed"]} for item in parked]})
+
+def parse_progress(data):
+    """{item_id: characters typed} from {"offsets": {"<id>": n, ...}} or item_id/offset fields."""
+    if isinstance(data.get('offsets'), dict):
+        pairs = data['offsets'].items()
     else:
-        print("No content in queue to remove")
+        pairs = [(data.get('item_id'), data.get('offset'))]
+    offsets = {}
+    for item_id, typed in pairs:
+        item_id, typed = int(item_id), int(typed)
+        if typed < 0:
+            raise ValueError(typed)
+        offsets[item_id] = max(typed, offsets.get(item_id, 0))
+    return offsets
+
+@app.route('/progress', methods=['POST'])
+@require_key(logger=poll_log, limit='poll')
+def report_progress():
+    """Record how many characters of queued items the client has typed.
+
+    Form fields item_id and offset, or a JSON batch {"offsets": {"<id>": n}}
+    to report several items at once; offsets count characters from the
+    start of the item and never move back. Report every few hundred
+    characters rather than every keystroke. Answers with the confirmed
+    offsets of the items still queued; missing ones have been acknowledged.
+    """
+    data = request.get_json(silent=True) if request.is_json else request.form
+    if not isinstance(data, dict):  # form data is a MultiDict
+        poll_log.info("Progress rejected: Body is not a JSON object")
+        return "Invalid JSON body", 400
+    try:
+        offsets = parse_progress(data)
+    except (TypeError, ValueError):
+        return "Invalid item_id or offset", 400
     
-    submission_locked = False
-    print(f"Interrupt acknowledgment processed. Submissions unlocked. New queue size: {len(content_store)}")
+    client_id = request_client_id(data if request.is_json else None)
+    confirmed = state.report_progress(client_id, offsets)
+    advanced = sum(advanced for _, advanced in confirmed.values())
+    if advanced:
+        typed_characters.inc(client_id, amount=advanced)
+    poll_log.debug("Progress for %s: %s", client_id, confirmed)
     
-    return "Interrupt acknowledgement received. Task removed from queue. New submissions allowed."
+    return jsonify({"progress": {str(item_id): typed for item_id, (typed, _) in confirmed.items()}})
+
+@app.route('/resume', methods=['POST'])
+@require_key()
+def resume_items():
+    """Put items parked by interrupt_acknowledge (resume=1) back in the queue.
+
+    Selects items like /acknowledge (default: every parked item). They are
+    sent to the client again as content events and continue from their
+    X-Typed-Offset. 403 while the queue has no room for them.
+    """
+    try:
+        ids, id_range = parse_ack_selection(request.form)
+    except ValueError:
+        return "Invalid item ids", 400
+    if id_range is not None:
+        return "Resume takes item ids, not a range", 400
+    
+    client_id = request_client_id()
+    resumed = state.resume(client_id, ids)
+    if resumed is None:
+        log.info("Resume for %s rejected: Queue is full", client_id)
+        return "Submission locked. Wait for typing acknowledgement.", 403
+    for item in resumed:
+        state.publish(client_id, "content", public_item(item))
+        log.info("Resumed content %d at %d characters", item['id'], item['typed'])
+    
+    return jsonify({"resumed": [item["id"] for item in resumed]})
 
 # New kill switch endpoints
 @app.route('/activate_kill_switch', methods=['POST'])
+@require_key()
 def activate_kill_switch():
-    global kill_switch_activated
+    log.debug("Received kill switch activation request")
     
-    print("Received kill switch activation request")
-    key = request.form.get('key')
-    
-    if not key or key != SECRET_KEY:
-        print(f"Kill switch activation rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
-    
-    kill_switch_activated = True
-    print("🛑 KILL SWITCH ACTIVATED - Client will be terminated")
+    for target in target_client_ids(request_client_id(), request.form):
+        state.set_kill_switch(target, True)
+        state.publish(target, "kill_switch", {"active": True})
+        log.warning("🛑 KILL SWITCH ACTIVATED - Client %s will be terminated", target)
     
     return "Kill switch activated - client will terminate"
 
 @app.route('/deactivate_kill_switch', methods=['POST'])
+@require_key()
 def deactivate_kill_switch():
-    global kill_switch_activated
-    
-    print("Received kill switch deactivation request")
-    key = request.form.get('key')
-    
-    if not key or key != SECRET_KEY:
-        print(f"Kill switch deactivation rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
+    log.debug("Received kill switch deactivation request")
     
-    kill_switch_activated = False
-    print("✅ Kill switch deactivated")
+    for target in target_client_ids(request_client_id(), request.form):
+        state.set_kill_switch(target, False)
+        state.publish(target, "kill_switch", {"active": False})
+        log.info("✅ Kill switch deactivated for %s", target)
     
     return "Kill switch deactivated"
 
 @app.route('/check_kill_switch', methods=['GET'])
+@require_key(logger=poll_log, limit='poll')
 def check_kill_switch():
-    key = request.args.get('key')
-    
-    if not key or key != SECRET_KEY:
-        return "Invalid key", 403
-    
-    return jsonify({"kill_switch_active": kill_switch_activated})
+    return jsonify({"kill_switch_active": state.status(request_client_id())["kill_switch"]})
 
 # New screenshot-related endpoints
 @app.route('/request_screenshot', methods=['POST'])
+@require_key()
 def request_screenshot():
-    global screenshot_capture_requested
+    log.debug("Received screenshot request")
     
-    print("Received screenshot request")
-    key = request.form.get('key')
-    
-    if not key or key != SECRET_KEY:
-        print(f"Screenshot request rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
+    try:
+        count, interval, start = parse_capture_schedule(request.form)
+    except ValueError as e:
+        return str(e), 400
     
-    screenshot_capture_requested = True
-    print("Screenshot capture requested")
+    schedules = {}
+    for target in target_client_ids(request_client_id(), request.form):
+        schedule = state.add_capture_schedule(target, count, interval, start)
+        now = time.time()
+        state.publish(target, "capture_screenshot", {
+            "schedule": {field: schedule[field] for field in ("id", "start", "interval", "count", "ends_at")},
+            "captures": due_captures(schedule, now, CAPTURE_HORIZON),
+        })
+        schedules[target] = schedule_summary(schedule, now)
+        if count == 1:
+            log.info("Screenshot capture requested from %s", target)
+        else:
+            log.info("Capture schedule %d for %s: %s captures every %.1fs",
+                     schedule["id"], target, count or "unlimited", interval)
     
-    return "Screenshot request sent to client"
+    if not any(request.form.get(field) for field in CAPTURE_SCHEDULE_FIELDS):
+        return "Screenshot request sent to client"
+    return jsonify({"schedules": schedules})
 
-@app.route('/check_screenshot_command', methods=['GET'])
-def check_screenshot_command():
-    global screenshot_capture_requested
+@app.route('/stop_screenshot_schedule', methods=['POST'])
+@require_key()
+def stop_screenshot_schedule():
+    """Stop one capture schedule (schedule_id) or all of a client's schedules."""
+    log.debug("Received stop screenshot schedule request")
     
-    key = request.args.get('key')
+    schedule_id = request.form.get('schedule_id')
+    if schedule_id and not schedule_id.isdigit():
+        return "Invalid schedule_id", 400
     
-    if not key or key != SECRET_KEY:
-        return "Invalid key", 403
+    stopped = {}
+    for target in target_client_ids(request_client_id(), request.form):
+        stopped[target] = state.stop_capture_schedules(target, int(schedule_id) if schedule_id else None)
+        if stopped[target]:
+            state.publish(target, "capture_schedule_stopped", {"schedule_ids": stopped[target]})
+            log.info("Capture schedules %s stopped for %s", stopped[target], target)
     
-    capture_requested = screenshot_capture_requested
-    screenshot_capture_requested = False  # Reset flag after checking
+    return jsonify({"stopped": stopped})
+
+@app.route('/screenshot_schedules', methods=['GET'])
+@require_key(logger=poll_log, limit='poll')
+def screenshot_schedules():
+    """The client's capture schedules with fulfilled, dropped and pending counts."""
+    client_id = request_client_id()
+    now = time.time()
+    return jsonify({
+        "client_id": client_id,
+        "server_time": now,
+        "schedules": [schedule_summary(schedule, now) for schedule in state.capture_schedules(client_id)],
+    })
+
+@app.route('/check_screenshot_command', methods=['GET'])
+@require_key(logger=poll_log, limit='poll')
+def check_screenshot_command():
+    """Poll for capture work.
+
+    `captures` lists every capture not uploaded yet that is due within
+    CAPTURE_HORIZON seconds, as {"id", "due"} (epoch seconds, compare with
+    `server_time`); the same capture is listed again until its upload
+    arrives with X-Capture-Id. `capture_requested` is the legacy one-shot
+    flag, cleared by this call.
+    """
+    client_id = request_client_id()
+    capture_requested = state.take_capture_request(client_id)  # Reset flag after checking
+    now = time.time()
     
-    return jsonify({"capture_requested": capture_requested})
+    return jsonify({
+        "capture_requested": capture_requested,
+        "captures": pending_captures(client_id, CAPTURE_HORIZON, now),
+        "server_time": now,
+    })
+
+@app.route('/commands/stream', methods=['GET'])
+@require_key(logger=poll_log, limit='poll')
+def command_stream():
+    """Push kill-switch, capture and new-content events to the client.
+
+    Default is Server-Sent Events; reconnecting clients send Last-Event-ID
+    (or ?since=) to resume. With ?mode=poll the request long-polls instead and
+    returns {"events": [...], "last_id": N} as soon as something happens or
+    after ?timeout= seconds.
+    """
+    client_id = request_client_id()
+    state.head(client_id)  # Unknown clients get a 404 before the stream starts
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    try:
+        timeout = parse_stream_timeout(request.args)
+    except ValueError:
+        return "Invalid timeout parameter", 400
+
+    if since is None or not since.isdigit() or not state.events_resumable(client_id, int(since)):
+        initial, last_id = command_snapshot(client_id)
+    else:
+        initial, last_id = [], int(since)
+
+    if request.args.get('mode') == 'poll':
+        events = initial or consume_command_events(client_id, state.wait_for_events(client_id, last_id, timeout))
+        if events:
+            last_id = max(last_id, events[-1]["id"])
+        response = jsonify({"events": events, "last_id": last_id})
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
+    def generate(last_id):
+        for event in initial:
+            yield format_sse(event)
+        while True:
+            events = consume_command_events(client_id, state.wait_for_events(client_id, last_id, timeout))
+            if not events:
+                yield ": keepalive\n\n"
+                continue
+            for event in events:
+                yield format_sse(event)
+            last_id = events[-1]["id"]
+
+    response = Response(stream_with_context(generate(last_id)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def iter_upload_chunks(stream, chunk_size=None, reservation=None):
+    """Yield the request body in fixed-size chunks without buffering it whole.
+
+    Chunks are charged to the upload byte budget `reservation` as they are read.
+    """
+    chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        if reservation is not None:
+            reservation.charge(len(chunk))
+        yield chunk
+
+
+def admit_upload(size=0):
+    """Refuse an upload before its body is read while the image pipeline is full
+    or `size` bytes do not fit in the upload byte budget.
+
+    Returns the budget reservation, to be released once the body is handled.
+    """
+    if image_pipeline.pending >= image_pipeline.max_pending:
+        raise PipelineFull(f"{image_pipeline.max_pending} images already in flight")
+    return upload_budget.reserve(size)
+
+
+def admit_request_upload():
+    """admit_upload for the current request's body; released when the request ends."""
+    g.upload_reservation = admit_upload(request.content_length or 0)
+    return g.upload_reservation
+
+
+def store_variants(client_id, store, screenshot_id, started, future):
+    """Pipeline callback: attach the rendered thumbnail and display copy."""
+    try:
+        variants = future.result()
+    except Exception as e:
+        log.warning("Image processing failed for screenshot %d: %s", screenshot_id, e)
+        return
+    for variant, (data, content_type) in variants.items():
+        store.put_variant(screenshot_id, variant, data, content_type)
+    image_processing_time.observe(time.perf_counter() - started)
+    state.touch(client_id)
+
+
+def ingest_screenshot(client_id, store, chunks, timestamp, capture_id=None):
+    """Store an uploaded image and queue its thumbnail and display copy; None if the body was empty.
+
+    Raises PipelineFull, before `chunks` is read, while the image pipeline is full.
+    """
+    with image_pipeline.slot() as submit:
+        started = time.perf_counter()
+        entry = store.add(chunks, timestamp)
+        if not entry['size']:
+            store.remove(entry['id'])
+            return None
+        fulfil_capture(client_id, capture_id)
+        # Duplicates share the original's variants
+        data = store.read(entry['id']) if Image is not None and entry['blob'] == entry['id'] else None
+        if data is not None:
+            submit(
+                render_variants, data, THUMBNAIL_SIZE, DISPLAY_FORMAT, DISPLAY_QUALITY, DISPLAY_MAX_SIZE,
+                callback=functools.partial(store_variants, client_id, store, entry['id'], started),
+            )
+    state.touch(client_id)
+    return entry
+
+def ingest_known_screenshot(client_id, store, sha256, timestamp, capture_id=None):
+    """Record a capture of an already stored image by hash; None if unknown."""
+    entry = store.add_existing(sha256.lower(), timestamp)
+    if entry is not None:
+        fulfil_capture(client_id, capture_id)
+        state.touch(client_id)
+    return entry
+
+def upload_response(entry, message="Screenshot uploaded successfully"):
+    # Clients keep X-Content-SHA256 as the base for delta uploads
+    response = make_response(message)
+    response.headers['X-Screenshot-Id'] = str(entry['id'])
+    response.headers['X-Content-SHA256'] = entry['sha256']
+    return response
 
 @app.route('/upload_screenshot', methods=['POST'])
+@require_key(limit='upload')
 def upload_screenshot():
-    print("Received screenshot upload")
+    """Accept a screenshot upload.
+
+    Three body formats are supported:
+      * application/json: {"screenshot" (base64), "timestamp"} (legacy;
+        needs a Content-Length, the body is not streamed)
+      * application/octet-stream: raw image bytes, timestamp in the
+        X-Timestamp header or the timestamp query parameter
+      * multipart/form-data: a "screenshot" file part plus a timestamp field
+    The key goes in the X-Key or Authorization header or the query string;
+    it is only read from small bodies (see require_key).
+    The binary modes are streamed from the request in chunks, decoded as
+    they arrive if sent with Content-Encoding: gzip. Identical images are
+    stored once. A binary upload may name its SHA-256 in
+    X-Content-SHA256: if the image is already stored the body is not read,
+    and an empty body with an unknown hash gets a 404 (send the image).
+    Responses carry X-Screenshot-Id and X-Content-SHA256. Uploads answering
+    a scheduled capture name it in X-Capture-Id (or a capture_id field).
+    """
+    log.debug("Received screenshot upload")
     
     try:
-        data = request.get_json()
-        key = data.get('key')
-        
-        if not key or key != SECRET_KEY:
-            print(f"Screenshot upload rejected: Invalid key provided: {key}")
-            return "Invalid key", 403
-        
-        screenshot_data = data.get('screenshot')
-        timestamp = data.get('timestamp', datetime.now().isoformat())
-        
-        if not screenshot_data:
-            print("Screenshot upload rejected: Missing screenshot data")
+        if request.mimetype == 'application/json':
+            return upload_screenshot_json()
+
+        multipart = request.mimetype == 'multipart/form-data'
+        timestamp = request.headers.get('X-Timestamp') or request.args.get('timestamp')
+        if multipart:
+            timestamp = timestamp or request.form.get('timestamp')
+
+        timestamp = timestamp or datetime.now().isoformat()
+        client_id = request_client_id()
+        store = screenshot_store_for(client_id)
+
+        known_hash = request.headers.get('X-Content-SHA256')
+        if known_hash:
+            screenshot_entry = ingest_known_screenshot(client_id, store, known_hash, timestamp, request_capture_id())
+            if screenshot_entry is not None:
+                log.info("Duplicate screenshot recorded by hash. Total screenshots: %d", len(store))
+                return upload_response(screenshot_entry)
+            # Decoded (gzip) and chunked bodies have no Content-Length
+            if not multipart and not (request.content_length or request.environ.get('wsgi.input_terminated')):
+                return "Unknown screenshot hash", 404
+
+        # A raw body is the image itself, so an oversized one is refused unread
+        if not multipart and store.max_bytes and (request.content_length or 0) > store.max_bytes:
+            raise ScreenshotTooLarge(f"Screenshot of {request.content_length} bytes exceeds the {store.max_bytes} byte budget")
+
+        reservation = admit_request_upload()
+        if multipart:
+            upload = request.files.get('screenshot')
+            if upload is None:
+                log.info("Screenshot upload rejected: Missing screenshot file")
+                return "Missing screenshot data", 400
+            chunks = iter_upload_chunks(upload.stream)
+        else:
+            chunks = iter_upload_chunks(request.stream, reservation=reservation)
+
+        screenshot_entry = ingest_screenshot(client_id, store, chunks, timestamp, request_capture_id())
+        if screenshot_entry is None:
+            log.info("Screenshot upload rejected: Empty body")
             return "Missing screenshot data", 400
-        
-        # Store screenshot with metadata
-        screenshot_entry = {
-            'data': screenshot_data,
-            'timestamp': timestamp,
-            'size': len(screenshot_data)
-        }
-        
-        screenshot_store.append(screenshot_entry)
-        print(f"Screenshot stored successfully. Total screenshots: {len(screenshot_store)}")
-        
-        return "Screenshot uploaded successfully"
-        
+
+        log.info("Screenshot stored successfully (%d bytes). Total screenshots: %d", screenshot_entry['size'], len(store))
+        return upload_response(screenshot_entry)
+
+    except (HTTPException, UnknownClient, PipelineFull, UploadBudgetExceeded):
+        raise
+    except ScreenshotTooLarge as e:
+        log.warning("Screenshot upload rejected: %s", e)
+        return str(e), 413
     except Exception as e:
-        print(f"Error processing screenshot upload: {e}")
+        log.exception("Error processing screenshot upload")
         return f"Error processing screenshot: {str(e)}", 500
 
-@app.route('/clear_screenshots', methods=['POST'])
-def clear_screenshots():
-    global screenshot_store
+def upload_screenshot_json():
+    # The body is parsed in one piece, so its size is reserved before it is read
+    if request.content_length is None:
+        log.info("Screenshot upload rejected: JSON body without Content-Length")
+        return "Content-Length required for JSON uploads", 411
+    if MAX_REQUEST_SIZE and request.content_length > MAX_REQUEST_SIZE:
+        log.info("Screenshot upload rejected: JSON body of %d bytes", request.content_length)
+        return "Request body too large", 413
+    admit_request_upload()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        log.info("Screenshot upload rejected: Body is not a JSON object")
+        return "Invalid JSON body", 400
+    screenshot_data = data.get('screenshot')
+    timestamp = data.get('timestamp', datetime.now().isoformat())
+
+    if not screenshot_data:
+        log.info("Screenshot upload rejected: Missing screenshot data")
+        return "Missing screenshot data", 400
+
+    # Decode once at ingest; the store keeps raw image bytes
+    try:
+        image = base64.b64decode(screenshot_data, validate=True)
+    except (TypeError, ValueError):  # binascii.Error is a ValueError
+        log.info("Screenshot upload rejected: Invalid base64 data")
+        return "Invalid screenshot data", 400
+    if not image:
+        log.info("Screenshot upload rejected: Empty screenshot data")
+        return "Missing screenshot data", 400
+    client_id = request_client_id(data)
+    store = screenshot_store_for(client_id)
+    screenshot_entry = ingest_screenshot(client_id, store, [image], timestamp, request_capture_id(data))
+    log.info("Screenshot stored successfully. Total screenshots: %d", len(store))
+
+    return upload_response(screenshot_entry)
+
+@app.route('/upload_screenshot/delta', methods=['POST'])
+@require_key(limit='upload')
+def upload_screenshot_delta():
+    """Accept a capture as the tiles that changed since a previous one.
+
+    multipart/form-data with a timestamp field, `base` (the previous
+    capture's X-Content-SHA256) and one image file part per changed tile,
+    named tile-<x>-<y> after its top-left pixel. The composite is stored
+    like any other upload. 409 means the base is no longer stored and a full
+    upload is needed.
+    """
+    log.debug("Received delta screenshot upload")
+    
+    if Image is None:
+        return "Delta uploads need Pillow on the server", 501
+    
+    admit_request_upload()
+    client_id = request_client_id()
+    store = screenshot_store_for(client_id)
+    timestamp = request.headers.get('X-Timestamp') or request.form.get('timestamp') or datetime.now().isoformat()
+    tiles = []
+    for name, tile_file in request.files.items(multi=True):
+        match = DELTA_TILE_FIELD.fullmatch(name)
+        if match is None:
+            return f"Unexpected file part: {name}", 400
+        tiles.append((int(match.group(1)), int(match.group(2)), tile_file.read()))
+    
+    base = store.open_by_hash((request.form.get('base') or '').lower())
+    if base is None:
+        log.info("Delta screenshot upload rejected: Unknown base")
+        return "Unknown base screenshot; send a full upload", 409
+    
+    try:
+        with base:
+            base_image = base.read()
+        # Decoding and re-encoding the composite is done by an image worker
+        composite = image_pipeline.run(compose_delta, base_image, tiles)
+        screenshot_entry = ingest_screenshot(client_id, store, [composite], timestamp, request_capture_id())
+    except ScreenshotTooLarge as e:
+        log.warning("Delta screenshot upload rejected: %s", e)
+        return str(e), 413
+    except (OSError, ValueError) as e:
+        log.info("Delta screenshot upload rejected: %s", e)
+        return "Invalid tile image", 400
+    
+    log.info("Delta screenshot stored (%d tiles). Total screenshots: %d", len(tiles), len(store))
+    return upload_response(screenshot_entry)
+
+def send_screenshot(store, screenshot_id, variant=None):
+    entry = store.get(screenshot_id)
+    if entry is None:
+        return "Screenshot not found", 404
+
+    fallback = variant is not None and variant not in entry['variants']
+    if fallback:
+        variant = None  # Not rendered (yet, or Pillow missing): serve the original
+    image = store.open(screenshot_id, variant)
+    if image is None:
+        return "Screenshot not found", 404
+
+    content_type = entry['variants'][variant]['content_type'] if variant else entry['content_type']
+    response = send_file(
+        image,
+        mimetype=content_type,
+        etag=f"{entry['sha256']}-{variant or 'full'}",
+        last_modified=datetime.fromtimestamp(entry['created'], timezone.utc),
+        max_age=SCREENSHOT_CACHE_MAX_AGE,
+        conditional=True,
+    )
+    # Screenshots never change once stored, but the URL carries the key
+    response.cache_control.public = False
+    response.cache_control.private = True
+    if fallback:
+        response.cache_control.no_cache = True  # revalidate until the variant exists
+    else:
+        response.cache_control.immutable = True
+    return response
+
+@app.route('/screenshots/<int:screenshot_id>', methods=['GET'])
+@require_key(logger=poll_log)
+def get_screenshot(screenshot_id):
+    return send_screenshot(screenshot_store_for(request_client_id()), screenshot_id)
+
+@app.route('/screenshots/<int:screenshot_id>/thumb', methods=['GET'])
+@require_key(logger=poll_log)
+def get_screenshot_thumb(screenshot_id):
+    return send_screenshot(screenshot_store_for(request_client_id()), screenshot_id, 'thumb')
+
+@app.route('/screenshots/<int:screenshot_id>/display', methods=['GET'])
+@require_key(logger=poll_log)
+def get_screenshot_display(screenshot_id):
+    """The lossy display copy (WebP or JPEG), or the original if there is none."""
+    return send_screenshot(screenshot_store_for(request_client_id()), screenshot_id, 'display')
+
+def parse_history_query(args):
+    """(before, limit, start, end) from ?before=&limit=&from=&to=; ValueError if malformed."""
+    before = int(args['before']) if args.get('before') else None
+    limit = min(max(int(args.get('limit', HISTORY_PAGE_SIZE)), 1), HISTORY_MAX_LIMIT)
+    bounds = []
+    for name in ('from', 'to'):
+        value = args.get(name)
+        bound = parse_timestamp(value) if value else None
+        if value and bound is None:
+            raise ValueError(f"Invalid {name} parameter")
+        bounds.append(bound)
+    return before, limit, *bounds
+
+def history_page(path, client_id, entries, more, limit):
+    """A page of metadata with the URL of the next (older) page, or None."""
+    next_url = None
+    if more:
+        query = {'client_id': client_id, 'before': entries[-1]['id'], 'limit': limit}
+        query.update((name, request.args[name]) for name in ('from', 'to') if request.args.get(name))
+        next_url = f"{path}?{urlencode(query)}"
+    return jsonify({"items": entries, "next": next_url})
+
+@app.route('/screenshots', methods=['GET'])
+@require_key(logger=poll_log)
+def list_screenshots():
+    """Screenshot metadata, newest capture first, with links to the images.
+
+    Paged with ?before=<id>&limit=, optionally within ?from=&to=; follow
+    "next" for older screenshots. 410 means the cursor screenshot was
+    evicted; start again from the first page. Links carry no key.
+    """
+    try:
+        before, limit, start, end = parse_history_query(request.args)
+    except ValueError:
+        return "Invalid before, limit, from or to parameter", 400
+    
+    client_id = request_client_id()
+    try:
+        entries, more = screenshot_store_for(client_id).page(before, limit, start, end)
+    except ExpiredCursor:
+        return "Cursor screenshot is no longer stored", 410
     
-    print("Received clear screenshots request")
-    key = request.form.get('key')
+    listed = []
+    for entry in entries:
+        url = f"/screenshots/{entry['id']}"
+        summary = {
+            "id": entry['id'],
+            "timestamp": entry['timestamp'],
+            "created": entry['created'],
+            "size": entry['size'],
+            "content_type": entry['content_type'],
+            "sha256": entry['sha256'],
+            "url": f"{url}?client_id={client_id}",
+        }
+        for variant in ('thumb', 'display'):
+            if variant in entry['variants']:
+                summary[f"{variant}_url"] = f"{url}/{variant}?client_id={client_id}"
+        listed.append(summary)
+    return history_page('/screenshots', client_id, listed, more, limit)
+
+@app.route('/items', methods=['GET'])
+@require_key(logger=poll_log)
+def content_history():
+    """Submitted items, newest first: size, preview, when they were submitted
+    and finished and how (queued, acknowledged, interrupted or cleared).
+
+    Paged like /screenshots. Items still queued link to their content.
+    """
+    try:
+        before, limit, start, end = parse_history_query(request.args)
+    except ValueError:
+        return "Invalid before, limit, from or to parameter", 400
     
-    if not key or key != SECRET_KEY:
-        print(f"Clear screenshots rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
+    client_id = request_client_id()
+    try:
+        records, more = state.content_history(client_id, before, limit, start, end)
+    except ExpiredCursor:
+        return "Cursor item is no longer in the history", 410
+    
+    for record in records:
+        if record['outcome'] == 'queued':
+            record['content_url'] = f"/items/{record['id']}/content?client_id={client_id}"
+    return history_page('/items', client_id, records, more, limit)
+
+def export_members(store, entries, variant, manifest):
+    """Archive members for `entries`, each image opened only when it is reached.
+
+    Screenshots evicted since the listing are skipped; with `manifest` a
+    manifest.json describing what was written comes last.
+    """
+    exported = []
+    for entry in entries:
+        chosen = variant if variant in entry['variants'] else None
+        image = store.open(entry['id'], chosen)
+        if image is None:
+            continue
+        info = entry['variants'][chosen] if chosen else entry
+        name = f"screenshot-{entry['id']}{mimetypes.guess_extension(info['content_type']) or '.bin'}"
+        exported.append({
+            "id": entry['id'],
+            "name": name,
+            "timestamp": entry['timestamp'],
+            "created": entry['created'],
+            "size": info['size'],
+            "content_type": info['content_type'],
+            "sha256": entry['sha256'],
+            "variant": chosen or "original",
+        })
+        yield name, info['size'], entry['created'], image
+    if manifest:
+        data = json.dumps({"screenshots": exported}, indent=2).encode('utf-8')
+        yield "manifest.json", len(data), time.time(), io.BytesIO(data)
+
+@app.route('/export/screenshots', methods=['GET'])
+@require_key()
+def export_screenshots():
+    """Stream the client's screenshots as an archive, oldest capture first.
+
+    ?format=tar (default) or zip; ?from=&to= select by capture time (ISO 8601
+    or Unix seconds); ?variant=display or thumb exports that copy where it
+    exists instead of the original; ?manifest=1 adds manifest.json with each
+    file's id, timestamps, size and hash. Images are read and written one at
+    a time, so memory does not grow with the number exported.
+    """
+    archive_format = request.args.get('format', 'tar')
+    variant = request.args.get('variant') or None
+    if archive_format not in ARCHIVE_FORMATS or variant not in (None, 'original', 'display', 'thumb'):
+        return "Invalid format or variant parameter", 400
+    try:
+        _, _, start, end = parse_history_query(request.args)
+    except ValueError:
+        return "Invalid from or to parameter", 400
+    
+    client_id = request_client_id()
+    store = screenshot_store_for(client_id)
+    entries, _ = store.page(limit=max(len(store), 1), start=start, end=end)
+    entries.reverse()
+    manifest = request.args.get('manifest', '').lower() in ('1', 'true', 'yes')
+    log.info("Exporting %d screenshots for %s as %s", len(entries), client_id, archive_format)
+    
+    chunks = stream_archive(archive_format, export_members(store, entries, variant, manifest))
+    response = Response(stream_with_context(chunks), mimetype=ARCHIVE_FORMATS[archive_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="screenshots-{client_id}.{archive_format}"'
+    response.cache_control.no_store = True
+    return response
+
+@app.route('/clear_screenshots', methods=['POST'])
+@require_key()
+def clear_screenshots():
+    log.debug("Received clear screenshots request")
     
-    screenshot_store.clear()
-    print("Screenshots cleared successfully")
+    client_id = request_client_id()
+    screenshot_store_for(client_id).clear()
+    state.touch(client_id)
+    log.info("Screenshots cleared successfully for %s", client_id)
     
     return "Screenshots cleared successfully"
 
 @app.route('/force_unlock', methods=['GET'])
+@require_key()
 def force_unlock():
-    global submission_locked
+    log.debug("Received force unlock request")
     
-    print("Received force unlock request")
-    key = request.args.get('key')
+    client_id = request_client_id()
+    state.unlock(client_id)
+    log.info("Force unlock executed for %s.", client_id)
     
-    if not key or key != SECRET_KEY:
-        print(f"Force unlock rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
+    return redirect(f'/?client_id={client_id}', code=302)
+
+def build_status(client_id):
+    current = state.status(client_id)
+    return {
+        "client_id": client_id,
+        "locked": current["locked"],
+        "queue_size": current["queue_size"],
+        "screenshot_count": len(screenshot_store_for(client_id)),
+        "kill_switch": current["kill_switch"],
+        "latest_preview": public_item(current["head"])["content"][:100] + "..." if current["head"] is not None else "No content",
+        "progress": typing_progress(current["head"]),
+        "parked": [{"id": item_id, "typed": current["progress"].get(item_id, 0)} for item_id in current["parked"]],
+    }
+
+def typing_progress(item):
+    """{id, typed, length} for the item being typed (length in characters, None if spooled)."""
+    if item is None:
+        return None
+    info = describe(item["content"])
+    return {"id": item["id"], "typed": item["typed"], "length": None if info["spooled"] else len(item["content"])}
+
+def build_dashboard_state(client_id):
+    dashboard = build_status(client_id)
+    dashboard["screenshots"] = [
+        {"id": entry["id"], "timestamp": entry["timestamp"], "thumb": "thumb" in entry["variants"]}
+        for entry in screenshot_store_for(client_id).recent(10)
+    ]
+    dashboard["recent_items"] = recent_item_previews(client_id)
+    return dashboard
+
+def parse_since(args):
+    """Return (since, timeout) from ?since=&timeout=; since is None when absent.
+
+    Raises ValueError on malformed values, including a non-finite timeout.
+    """
+    if args.get('since') is None:
+        return None, 0
+    timeout = float(args.get('timeout', STATUS_WAIT_TIMEOUT))
+    if not math.isfinite(timeout):
+        raise ValueError(f"timeout must be finite, not {timeout}")
+    return int(args['since']), min(max(timeout, 0), STATUS_WAIT_TIMEOUT)
+
+def versioned_response(client_id, build):
+    """JSON from `build(client_id)`, tagged with the client's state version.
+
+    Answers If-None-Match with 304. With ?since=<version> the request first
+    waits for the version to move on, and answers 304 if it does not.
+    """
+    try:
+        since, timeout = parse_since(request.args)
+    except ValueError:
+        abort(400, description="Invalid since or timeout parameter")
     
-    submission_locked = False
-    print("Force unlock executed.")
+    if since is None:
+        version = state.version(client_id)
+    else:
+        version = state.wait_for_version(client_id, since, timeout)
+        if version == since:
+            response = Response(status=304)
+            response.set_etag(str(version))
+            return response
     
-    return redirect('/', code=302)
+    # Read the version first: a change racing the build only makes the ETag stale
+    data = build(client_id)
+    data["version"] = version
+    response = jsonify(data)
+    response.set_etag(str(version))
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/status', methods=['GET'])
+@require_key(logger=poll_log, limit='poll')
 def status():
-    key = request.args.get('key')
-    
-    print("Received status request")
-    if not key or key != SECRET_KEY:
-        print(f"Status request rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
-    
-    status_info = {
-        "locked": submission_locked,
-        "queue_size": len(content_store),
-        "screenshot_count": len(screenshot_store),
-        "kill_switch": kill_switch_activated,
-        "latest_preview": content_store[-1][:100] + "..." if content_store else "No content"
-    }
-    print(f"Status response: {status_info}")
-    response = jsonify(status_info)
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    poll_log.debug("Received status request")
+    
+    response = versioned_response(request_client_id(), build_status)
+    poll_log.debug("Status response: %s (version %s)", response.status_code, response.get_etag()[0])
     return response
 
 @app.route('/clear_queue', methods=['POST'])
+@require_key()
 def clear_queue():
-    global content_store, submission_locked
-    
-    print("Received clear queue request")
-    key = request.form.get('key') or request.args.get('key')
+    log.debug("Received clear queue request")
     
-    if not key or key != SECRET_KEY:
-        print(f"Clear queue rejected: Invalid key provided: {key}")
-        return "Invalid key", 403
-    
-    content_store.clear()
-    submission_locked = False
-    print("Queue cleared successfully.")
+    client_id = request_client_id()
+    release_items(state.clear_queue(client_id))
+    lock_timer.discard(lambda key: key[0] == client_id)
+    log.info("Queue cleared successfully for %s.", client_id)
     
     return "Queue cleared successfully."
 
+@app.route('/metrics', methods=['GET'])
+@require_key(admin=True)
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == "__main__":
-    print(f"Secret key loaded: {'Yes' if SECRET_KEY else 'No'}")
-    print(f"Secret key value: {SECRET_KEY}")
-    print("Screenshot functionality enabled")
-    print("Kill switch functionality enabled")
+    log.info("Secret key loaded: %s", 'Yes' if SECRET_KEY else 'No')
+    log.info("Screenshot functionality enabled")
+    log.info("Kill switch functionality enabled")
     app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,1441 @@
+"""Shared state for the content queues, submission locks, flags and command events.
+
+Every route goes through a backend so the server can run either as a single
+process ("memory") or as several gunicorn workers sharing one SQLite file in
+WAL mode ("sqlite"). State is kept per client; every operation takes the
+client id first and is atomic:
+
+    state = create_state_backend("sqlite", path="state.db", submit_window=4)
+    state.register_client("office-pc")
+    items = state.submit("office-pc", [content])  # None while the window is full
+    batch = state.next_items("office-pc", 10)     # peek the FIFO head, oldest first
+    done = state.acknowledge("office-pc", ids=[item["id"] for item in batch])
+    if state.take_capture_request("office-pc"):   # test-and-clear
+        ...
+
+Queue items are dicts with an ``id`` (increasing) and ``content``. At most
+``submit_window`` items may be in flight (queued but not acknowledged) per
+client; once the window fills, that client's submissions are locked until
+acknowledgements bring the queue back under it (or the lock is forced open
+with ``unlock``).
+
+Each client has a state ``version`` that increases on every change to its
+queue or flags (and on ``touch``, for state kept outside the backend such as
+screenshots); ``wait_for_version`` blocks until it moves. Versions start at
+the registration time in milliseconds so they do not repeat after a reset.
+
+Callbacks registered with ``add_listener`` run after every publish or state
+change made by this process; ``event_watermark`` changes whenever any process
+publishes or changes state. Event-loop servers use the two to wake waiters
+without a thread each.
+
+Capture requests are schedules (see capture_schedule): ``add_capture_schedule``
+stores a one-shot, burst or interval schedule and also sets the legacy
+capture flag; uploads are matched to captures with ``fulfil_capture``. Each
+client keeps its active schedules plus the newest finished ones, up to
+``schedule_history``.
+
+Clients report how many characters of an item they have typed
+(``report_progress``). An interrupted item can be parked instead of removed:
+it keeps its place and progress but is skipped by ``head``/``next_items``
+and does not count against the submit window until it is resumed.
+
+Every submitted item also gets a content history record (id, submitted
+time, size, a short preview and, once it leaves the queue, when and how:
+acknowledged, interrupted or cleared); the newest ``content_history`` are
+kept per client and ``content_history()`` pages through them by submit time.
+
+The SQLite backend is durable by itself. The in-process backend can write
+its queue and flag changes to a journal (``journal_dir``) and rebuilds them
+from it on startup; command events are not journaled.
+
+Operations on a client that was never registered raise ``UnknownClient``.
+The ``default`` client always exists so single-client setups need no
+registration.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+from capture_schedule import CAPTURE_GRACE, is_active, new_settled, schedule_ends_at, settle, settle_point
+from content_spool import describe
+from history_index import ExpiredCursor, TimeIndex
+from journal import Journal
+
+DEFAULT_CLIENT_ID = "default"
+HISTORY_PREVIEW_CHARS = 100
+
+
+class UnknownClient(KeyError):
+    """Raised for a client id that has not been registered."""
+
+
+class StateBackend:
+    """Interface shared by the in-process and SQLite backends."""
+
+    def __init__(self):
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """Call `callback(client_id)` after every publish or change made by this process."""
+        self._listeners.append(callback)
+
+    def _notify_listeners(self, client_id):
+        for callback in self._listeners:
+            callback(client_id)
+
+    def event_watermark(self):
+        """Return a value that changes whenever any client's events or state change."""
+        raise NotImplementedError
+
+    def version(self, client_id):
+        """Return the client's state version."""
+        raise NotImplementedError
+
+    def touch(self, client_id):
+        """Bump the state version for a change made outside the backend."""
+        raise NotImplementedError
+
+    def wait_for_version(self, client_id, since, timeout):
+        """Block until the version differs from `since` or `timeout` expires; return it."""
+        raise NotImplementedError
+
+    def register_client(self, client_id, name=None):
+        """Create the client if needed and return its info dict (idempotent)."""
+        raise NotImplementedError
+
+    def has_client(self, client_id):
+        raise NotImplementedError
+
+    def clients(self):
+        """Return info dicts for every registered client, in registration order."""
+        raise NotImplementedError
+
+    def submit(self, client_id, contents):
+        """Enqueue every string in `contents` as one batch.
+
+        Returns the new items, or None if the lock is set or the batch does
+        not fit in the in-flight window (nothing is enqueued then). A batch
+        larger than the whole window is only accepted into an empty queue.
+        """
+        raise NotImplementedError
+
+    def head(self, client_id):
+        """Return the oldest queued item that is not parked, or None.
+
+        Items from head and next_items carry `typed`, their confirmed progress.
+        """
+        raise NotImplementedError
+
+    def next_items(self, client_id, limit, after=None):
+        """Return up to `limit` unparked queued items in FIFO order, optionally with id > `after`."""
+        raise NotImplementedError
+
+    def recent(self, client_id, limit):
+        """Return up to `limit` newest queued items, oldest first."""
+        raise NotImplementedError
+
+    def queue_size(self, client_id):
+        raise NotImplementedError
+
+    def acknowledge(self, client_id, ids=None, id_range=None, outcome="acknowledged"):
+        """Remove items by id and/or inclusive (first, last) id range.
+
+        With neither, removes the queue head. Returns the removed items and
+        unlocks submissions once the queue is back under the window. The
+        history records the items as `outcome` ("acknowledged" or
+        "interrupted").
+        """
+        raise NotImplementedError
+
+    def report_progress(self, client_id, offsets):
+        """Record {item_id: characters typed} for queued items; offsets only move forward.
+
+        Returns {item_id: (typed, advanced)} for the items still queued.
+        """
+        raise NotImplementedError
+
+    def park(self, client_id, ids=None, id_range=None):
+        """Set items (selected as in acknowledge) aside with their progress.
+
+        Unlocks submissions once the unparked items are back under the
+        window. Returns the newly parked items.
+        """
+        raise NotImplementedError
+
+    def resume(self, client_id, ids=None):
+        """Put parked items (default: all) back in line at their place in the queue.
+
+        Returns the resumed items with `typed`, or None (nothing resumed) if
+        the lock is set or they do not fit in the window.
+        """
+        raise NotImplementedError
+
+    def content_history(self, client_id, before=None, limit=50, start=None, end=None):
+        """Return (records, more): up to `limit` history records, newest first,
+        submitted before item `before` and between `start` and `end` (Unix
+        seconds, inclusive). Raises ExpiredCursor if `before` is no longer
+        in the history.
+        """
+        raise NotImplementedError
+
+    def clear_queue(self, client_id):
+        """Drop every queued item and unlock submissions; return the dropped items."""
+        raise NotImplementedError
+
+    def unlock(self, client_id):
+        raise NotImplementedError
+
+    def set_kill_switch(self, client_id, active):
+        raise NotImplementedError
+
+    def request_capture(self, client_id):
+        raise NotImplementedError
+
+    def take_capture_request(self, client_id):
+        """Atomically read and clear the capture flag."""
+        raise NotImplementedError
+
+    def add_capture_schedule(self, client_id, count=1, interval=0.0, start=None):
+        """Schedule `count` captures (None: until stopped) `interval` seconds
+        apart from `start` (default now) and set the capture flag.
+
+        Returns the schedule dict.
+        """
+        raise NotImplementedError
+
+    def stop_capture_schedules(self, client_id, schedule_id=None):
+        """End one or all of the client's schedules now; return the ids stopped."""
+        raise NotImplementedError
+
+    def capture_schedules(self, client_id, active=False):
+        """Return the client's schedules, oldest first, with their ``fulfilled`` captures.
+
+        Schedules that run until stopped fold captures past the grace period
+        into their ``settled`` totals. With `active`, only schedules that may
+        still have captures pending.
+        """
+        raise NotImplementedError
+
+    def fulfil_capture(self, client_id, schedule_id, n, latency):
+        """Record capture `n` of a schedule as uploaded; False if unknown or already recorded.
+
+        Captures of an until-stopped schedule that are past the grace period
+        count as dropped and are settled, so they are refused too.
+        """
+        raise NotImplementedError
+
+    def status(self, client_id):
+        """Return a dict with locked, queue_size, kill_switch, capture_requested,
+        head, parked (ids) and progress ({item_id: typed} for items with any)."""
+        raise NotImplementedError
+
+    def subscribe_snapshot(self, client_id):
+        """Return status() plus last_event_id, consuming any pending capture request."""
+        raise NotImplementedError
+
+    def publish(self, client_id, event_type, data=None):
+        """Append a command event for the client and wake its subscribers."""
+        raise NotImplementedError
+
+    def wait_for_events(self, client_id, since, timeout):
+        """Block until events newer than `since` exist or `timeout` expires."""
+        raise NotImplementedError
+
+    def events_resumable(self, client_id, since):
+        """True if every event after `since` can still be returned.
+
+        False when `since` is ahead of the log (ids from before a restart) or
+        older than the events it still holds; the subscriber then needs a fresh
+        subscribe_snapshot() instead.
+        """
+        raise NotImplementedError
+
+
+class _ClientState:
+    """One client's queue, flags and event log, guarded by its own condition."""
+
+    def __init__(self, client_id, name, event_history, registered_at=None, history_limit=10000):
+        self.info = {"client_id": client_id, "name": name or client_id, "registered_at": registered_at or time.time()}
+        self.cond = threading.Condition()
+        self.queue = OrderedDict()  # id -> content, oldest first
+        self.progress = {}  # id -> characters typed
+        self.parked = set()
+        self.next_id = 1
+        self.locked = False
+        self.capture_requested = False
+        self.kill_switch = False
+        self.events = deque(maxlen=event_history)
+        # Seeded from the clock like version, in microseconds so ids keep
+        # growing across restarts unless events outpaced one per microsecond
+        self.event_seq = time.time_ns() // 1000
+        self.schedules = OrderedDict()  # id -> capture schedule, oldest first
+        self.next_schedule_id = 1
+        self.history = OrderedDict()  # id -> content history record, oldest first
+        self.history_index = TimeIndex()
+        self.history_limit = history_limit
+        self.version = int(time.time() * 1000)
+
+    def changed(self, journal=None, op="flags", **fields):
+        """Bump the version and wake waiters; journal the change if `journal` is set.
+
+        Caller holds self.cond. Returns the journal sequence number, or None.
+        """
+        self.version += 1
+        self.cond.notify_all()
+        if journal is not None:
+            return journal.append({"op": op, "client_id": self.info["client_id"], **fields, **self.flags()})
+        return None
+
+    def flags(self):
+        return {"locked": self.locked, "kill_switch": self.kill_switch, "capture_requested": self.capture_requested}
+
+    def dump(self):
+        return {
+            **self.info, **self.flags(),
+            "queue": list(self.queue.items()),
+            "progress": list(self.progress.items()),
+            "parked": sorted(self.parked),
+            "next_id": self.next_id,
+            "schedules": [_schedule_record(schedule) for schedule in self.schedules.values()],
+            "history": list(self.history.values()),
+        }
+
+    def put_schedule(self, record):
+        schedule = dict(record, fulfilled={n: latency for n, latency in record["fulfilled"]},
+                        settled=dict(record["settled"]))
+        self.schedules[schedule["id"]] = schedule
+        self.next_schedule_id = max(self.next_schedule_id, schedule["id"] + 1)
+        return schedule
+
+    def put_history(self, record):
+        self.history[record["id"]] = record
+        self.history_index.add(record["id"], record["submitted"])
+        while len(self.history) > self.history_limit:
+            item_id, _ = self.history.popitem(last=False)
+            self.history_index.discard(item_id)
+
+    def record_submitted(self, items, submitted):
+        for item_id, content in items:
+            if item_id not in self.history:
+                info = describe(content)
+                self.put_history({
+                    "id": item_id, "submitted": submitted, "size": info["size"],
+                    "preview": info["preview"][:HISTORY_PREVIEW_CHARS], "finished": None, "outcome": "queued",
+                })
+
+    def record_finished(self, ids, outcome, finished):
+        for item_id in ids:
+            self.progress.pop(item_id, None)
+            self.parked.discard(item_id)
+            if item_id in self.history:
+                self.history[item_id].update(finished=finished, outcome=outcome)
+
+    def active_size(self):
+        return len(self.queue) - len(self.parked)
+
+    def item(self, item_id):
+        return {"id": item_id, "content": self.queue[item_id], "typed": self.progress.get(item_id, 0)}
+
+    def apply(self, record):
+        """Replay a journal record. Records carry absolute values, so replaying
+        one whose effect is already present is harmless."""
+        if record["op"] == "enqueue":
+            for item_id, content in record["items"]:
+                self.queue[item_id] = content
+                self.next_id = max(self.next_id, item_id + 1)
+            self.record_submitted(record["items"], record.get("submitted", 0.0))
+        elif record["op"] == "remove":
+            for item_id in record["ids"]:
+                self.queue.pop(item_id, None)
+            self.record_finished(record["ids"], record.get("outcome", "acknowledged"), record.get("finished"))
+        elif record["op"] == "clear":
+            self.record_finished(record.get("ids", list(self.queue)), "cleared", record.get("finished"))
+            self.queue.clear()
+        elif record["op"] == "progress":
+            for item_id, typed in record["offsets"]:
+                if item_id in self.queue:
+                    self.progress[item_id] = max(self.progress.get(item_id, 0), typed)
+        elif record["op"] == "park":
+            self.parked.update(item_id for item_id in record["ids"] if item_id in self.queue)
+        elif record["op"] == "resume":
+            self.parked.difference_update(record["ids"])
+        elif record["op"] == "schedule":
+            if record["schedule"]["id"] not in self.schedules:  # else the snapshot's copy is newer
+                self.put_schedule(record["schedule"])
+            for schedule_id in record["dropped"]:
+                self.schedules.pop(schedule_id, None)
+        elif record["op"] == "stop":
+            for schedule_id, ends_at in record["schedules"]:
+                if schedule_id in self.schedules:
+                    self.schedules[schedule_id].update(ends_at=ends_at, stopped=True)
+        elif record["op"] == "fulfil":
+            schedule = self.schedules.get(record["schedule_id"])
+            if schedule is not None and record["n"] >= schedule["settled"]["before"]:
+                schedule["fulfilled"][record["n"]] = record["latency"]
+                settle(schedule, record["settle_before"])
+        self.locked = record["locked"]
+        self.kill_switch = record["kill_switch"]
+        self.capture_requested = record["capture_requested"]
+
+    def head(self):
+        for item_id in self.queue:
+            if item_id not in self.parked:
+                return self.item(item_id)
+        return None
+
+    def status(self):
+        return {
+            "locked": self.locked,
+            "queue_size": len(self.queue),
+            "kill_switch": self.kill_switch,
+            "capture_requested": self.capture_requested,
+            "head": self.head(),
+            "parked": sorted(self.parked),
+            "progress": dict(self.progress),
+        }
+
+
+def _schedule_record(schedule):
+    """JSON-safe copy of a schedule (fulfilled as [n, latency] pairs)."""
+    return dict(schedule, fulfilled=sorted(schedule["fulfilled"].items()), settled=dict(schedule["settled"]))
+
+
+def _copy_schedule(schedule):
+    return dict(schedule, fulfilled=dict(schedule["fulfilled"]), settled=dict(schedule["settled"]))
+
+
+def _expired_schedules(schedules, limit, now):
+    """Ids of the oldest finished schedules beyond the newest `limit`."""
+    excess = len(schedules) - limit
+    expired = []
+    for schedule in schedules:
+        if len(expired) >= excess:
+            break
+        if not is_active(schedule, now):
+            expired.append(schedule["id"])
+    return expired
+
+
+class InProcessStateBackend(StateBackend):
+    """State held in this process; for single-worker deployments.
+
+    Clients live in a dict, and each has its own condition, so a publish only
+    wakes that client's subscribers. With `journal_dir`, every change is
+    journaled and durable before the call returns, and a snapshot is taken
+    every `snapshot_every` changes.
+    """
+
+    def __init__(self, event_history=256, submit_window=1, journal_dir=None, snapshot_every=10000,
+                 schedule_history=32, content_history=10000):
+        super().__init__()
+        self.submit_window = submit_window
+        self.event_history = event_history
+        self.schedule_history = schedule_history
+        self.content_history_limit = content_history
+        self._registry_lock = threading.Lock()
+        self._clients = {}
+        self._changes = 0
+        self._journal = None
+        if journal_dir:
+            journal = Journal(journal_dir, self.dump, snapshot_every)
+            self._restore(*journal.recover())
+            journal.start()
+            self._journal = journal
+        self.register_client(DEFAULT_CLIENT_ID)
+
+    def dump(self):
+        """Return every client's queue and flags (the journal snapshot)."""
+        clients = []
+        for client in list(self._clients.values()):
+            with client.cond:
+                clients.append(client.dump())
+        return {"clients": clients}
+
+    def _restore(self, snapshot, records):
+        for dumped in (snapshot or {}).get("clients", ()):
+            client = _ClientState(dumped["client_id"], dumped["name"], self.event_history, dumped["registered_at"],
+                                  self.content_history_limit)
+            client.queue.update((item_id, content) for item_id, content in dumped["queue"])
+            client.progress.update((item_id, typed) for item_id, typed in dumped.get("progress", ()))
+            client.parked.update(dumped.get("parked", ()))
+            client.next_id = dumped["next_id"]
+            for schedule in dumped.get("schedules", ()):
+                client.put_schedule(schedule)
+            for history in dumped.get("history", ()):
+                client.put_history(history)
+            client.apply(dict(dumped, op="flags"))
+            self._clients[client.info["client_id"]] = client
+        for record in records:
+            client = self._clients.get(record["client_id"])
+            if record["op"] == "register":
+                if client is None:
+                    self._clients[record["client_id"]] = _ClientState(
+                        record["client_id"], record["name"], self.event_history, record["registered_at"],
+                        self.content_history_limit,
+                    )
+            elif client is not None:
+                client.apply(record)
+
+    def _client(self, client_id):
+        try:
+            return self._clients[client_id]
+        except KeyError:
+            raise UnknownClient(client_id) from None
+
+    def register_client(self, client_id, name=None):
+        with self._registry_lock:
+            client = self._clients.get(client_id)
+            seq = None
+            if client is None:
+                client = self._clients[client_id] = _ClientState(
+                    client_id, name, self.event_history, history_limit=self.content_history_limit
+                )
+                if self._journal is not None:
+                    seq = self._journal.append({"op": "register", **client.info})
+        if seq is not None:
+            self._journal.wait(seq)
+        return dict(client.info)
+
+    def has_client(self, client_id):
+        return client_id in self._clients
+
+    def clients(self):
+        return [dict(client.info) for client in list(self._clients.values())]
+
+    def submit(self, client_id, contents):
+        client = self._client(client_id)
+        with client.cond:
+            if client.locked or client.active_size() + len(contents) > max(self.submit_window, len(contents)):
+                return None
+            items = []
+            for content in contents:
+                client.queue[client.next_id] = content
+                items.append({"id": client.next_id, "content": content})
+                client.next_id += 1
+            client.locked = client.active_size() >= self.submit_window
+            records = [[item["id"], item["content"]] for item in items]
+            submitted = time.time()
+            client.record_submitted(records, submitted)
+            seq = client.changed(self._journal, "enqueue", items=records, submitted=submitted)
+        self._state_changed(client_id, seq)
+        return items
+
+    def head(self, client_id):
+        client = self._client(client_id)
+        with client.cond:
+            return client.head()
+
+    def next_items(self, client_id, limit, after=None):
+        client = self._client(client_id)
+        with client.cond:
+            items = []
+            for item_id in client.queue:
+                if len(items) >= limit:
+                    break
+                if (after is None or item_id > after) and item_id not in client.parked:
+                    items.append(client.item(item_id))
+            return items
+
+    def recent(self, client_id, limit):
+        client = self._client(client_id)
+        with client.cond:
+            ids = list(client.queue)[-limit:] if limit else []
+            return [{"id": item_id, "content": client.queue[item_id]} for item_id in ids]
+
+    def queue_size(self, client_id):
+        return len(self._client(client_id).queue)
+
+    def report_progress(self, client_id, offsets):
+        client = self._client(client_id)
+        with client.cond:
+            confirmed, changed = {}, []
+            for item_id, typed in offsets.items():
+                if item_id not in client.queue:
+                    continue
+                previous = client.progress.get(item_id, 0)
+                if typed > previous:
+                    client.progress[item_id] = typed
+                    changed.append([item_id, typed])
+                confirmed[item_id] = (max(typed, previous), max(typed - previous, 0))
+            if changed:
+                seq = client.changed(self._journal, "progress", offsets=changed)
+        if changed:
+            self._state_changed(client_id, seq)
+        return confirmed
+
+    def park(self, client_id, ids=None, id_range=None):
+        client = self._client(client_id)
+        with client.cond:
+            if ids is None and id_range is None:
+                head = client.head()
+                ids = [head["id"]] if head else []
+            selected = list(ids or ())
+            if id_range is not None:
+                selected.extend(item_id for item_id in client.queue if id_range[0] <= item_id <= id_range[1])
+            parked = []
+            for item_id in sorted(set(selected)):
+                if item_id in client.queue and item_id not in client.parked:
+                    client.parked.add(item_id)
+                    parked.append(client.item(item_id))
+            if client.active_size() < self.submit_window:
+                client.locked = False
+            if parked:
+                seq = client.changed(self._journal, "park", ids=[item["id"] for item in parked])
+        if parked:
+            self._state_changed(client_id, seq)
+        return parked
+
+    def resume(self, client_id, ids=None):
+        client = self._client(client_id)
+        with client.cond:
+            selected = sorted(client.parked if ids is None else client.parked.intersection(ids))
+            if not selected:
+                return []
+            if client.locked or client.active_size() + len(selected) > max(self.submit_window, len(selected)):
+                return None
+            client.parked.difference_update(selected)
+            client.locked = client.active_size() >= self.submit_window
+            seq = client.changed(self._journal, "resume", ids=selected)
+            resumed = [client.item(item_id) for item_id in selected]
+        self._state_changed(client_id, seq)
+        return resumed
+
+    def content_history(self, client_id, before=None, limit=50, start=None, end=None):
+        client = self._client(client_id)
+        with client.cond:
+            ids, more = client.history_index.page(before, limit, start, end)
+            return [dict(client.history[item_id]) for item_id in ids], more
+
+    def acknowledge(self, client_id, ids=None, id_range=None, outcome="acknowledged"):
+        client = self._client(client_id)
+        with client.cond:
+            if ids is None and id_range is None:
+                head = client.head()
+                ids = [head["id"]] if head else []
+            removed = []
+            for item_id in ids or ():
+                if item_id in client.queue:
+                    removed.append({"id": item_id, "content": client.queue.pop(item_id)})
+            if id_range is not None:
+                first, last = id_range
+                for item_id in [i for i in client.queue if first <= i <= last]:
+                    removed.append({"id": item_id, "content": client.queue.pop(item_id)})
+            if client.active_size() < self.submit_window:
+                client.locked = False
+            if removed:
+                removed_ids = [item["id"] for item in removed]
+                finished = time.time()
+                client.record_finished(removed_ids, outcome, finished)
+                seq = client.changed(self._journal, "remove", ids=removed_ids, outcome=outcome, finished=finished)
+        if removed:
+            self._state_changed(client_id, seq)
+        return removed
+
+    def clear_queue(self, client_id):
+        client = self._client(client_id)
+        with client.cond:
+            removed = [{"id": item_id, "content": content} for item_id, content in client.queue.items()]
+            finished = time.time()
+            client.record_finished(list(client.queue), "cleared", finished)
+            client.queue.clear()
+            client.locked = False
+            seq = client.changed(self._journal, "clear", ids=[item["id"] for item in removed], finished=finished)
+        self._state_changed(client_id, seq)
+        return removed
+
+    def unlock(self, client_id):
+        client = self._client(client_id)
+        with client.cond:
+            client.locked = False
+            seq = client.changed(self._journal)
+        self._state_changed(client_id, seq)
+
+    def set_kill_switch(self, client_id, active):
+        client = self._client(client_id)
+        with client.cond:
+            client.kill_switch = bool(active)
+            seq = client.changed(self._journal)
+        self._state_changed(client_id, seq)
+
+    def request_capture(self, client_id):
+        client = self._client(client_id)
+        with client.cond:
+            client.capture_requested = True
+            seq = client.changed(self._journal)
+        self._state_changed(client_id, seq)
+
+    def take_capture_request(self, client_id):
+        client = self._client(client_id)
+        with client.cond:
+            requested = client.capture_requested
+            client.capture_requested = False
+            if requested:
+                seq = client.changed(self._journal)
+        if requested:
+            self._state_changed(client_id, seq)
+        return requested
+
+    def add_capture_schedule(self, client_id, count=1, interval=0.0, start=None):
+        client = self._client(client_id)
+        now = time.time()
+        start = now if start is None else start
+        with client.cond:
+            schedule = client.put_schedule({
+                "id": client.next_schedule_id,
+                "start": start,
+                "interval": interval,
+                "count": count,
+                "ends_at": schedule_ends_at(start, interval, count),
+                "stopped": False,
+                "fulfilled": [],
+                "settled": new_settled(),
+            })
+            expired = _expired_schedules(list(client.schedules.values()), self.schedule_history, now)
+            for schedule_id in expired:
+                del client.schedules[schedule_id]
+            client.capture_requested = True
+            seq = client.changed(self._journal, "schedule", schedule=_schedule_record(schedule), dropped=expired)
+            schedule = _copy_schedule(schedule)
+        self._state_changed(client_id, seq)
+        return schedule
+
+    def stop_capture_schedules(self, client_id, schedule_id=None):
+        client = self._client(client_id)
+        now = time.time()
+        with client.cond:
+            stopped = []
+            for schedule in client.schedules.values():
+                if schedule_id is not None and schedule["id"] != schedule_id:
+                    continue
+                if schedule["ends_at"] is None or schedule["ends_at"] > now:
+                    schedule.update(ends_at=now, stopped=True)
+                    stopped.append([schedule["id"], now])
+            if stopped:
+                seq = client.changed(self._journal, "stop", schedules=stopped)
+        if stopped:
+            self._state_changed(client_id, seq)
+        return [schedule_id for schedule_id, _ in stopped]
+
+    def capture_schedules(self, client_id, active=False):
+        client = self._client(client_id)
+        now = time.time()
+        with client.cond:
+            return [
+                _copy_schedule(schedule) for schedule in client.schedules.values()
+                if not active or is_active(schedule, now)
+            ]
+
+    def fulfil_capture(self, client_id, schedule_id, n, latency):
+        client = self._client(client_id)
+        with client.cond:
+            schedule = client.schedules.get(schedule_id)
+            if schedule is None:
+                return False
+            before = max(settle_point(schedule, time.time()), schedule["settled"]["before"])
+            if n < before or n in schedule["fulfilled"] or (schedule["count"] is not None and n >= schedule["count"]):
+                return False
+            schedule["fulfilled"][n] = latency
+            settle(schedule, before)
+            seq = client.changed(self._journal, "fulfil", schedule_id=schedule_id, n=n, latency=latency,
+                                 settle_before=before)
+        self._state_changed(client_id, seq)
+        return True
+
+    def status(self, client_id):
+        client = self._client(client_id)
+        with client.cond:
+            return client.status()
+
+    def subscribe_snapshot(self, client_id):
+        client = self._client(client_id)
+        with client.cond:
+            snapshot = client.status()
+            snapshot["last_event_id"] = client.event_seq
+            if client.capture_requested:
+                client.capture_requested = False
+                seq = client.changed(self._journal)
+        if snapshot["capture_requested"]:
+            self._state_changed(client_id, seq)
+        return snapshot
+
+    def publish(self, client_id, event_type, data=None):
+        client = self._client(client_id)
+        with client.cond:
+            client.event_seq += 1
+            client.events.append({"id": client.event_seq, "type": event_type, "data": data or {}})
+            client.cond.notify_all()
+        self._state_changed(client_id)
+
+    def _state_changed(self, client_id, seq=None):
+        # Outside the client's lock, so concurrent changes share the journal's fsync
+        if seq is not None:
+            self._journal.wait(seq)
+        self._changes += 1
+        self._notify_listeners(client_id)
+
+    def event_watermark(self):
+        return self._changes
+
+    def version(self, client_id):
+        return self._client(client_id).version
+
+    def touch(self, client_id):
+        client = self._client(client_id)
+        with client.cond:
+            client.changed()
+        self._state_changed(client_id)
+
+    def wait_for_version(self, client_id, since, timeout):
+        client = self._client(client_id)
+        deadline = time.monotonic() + timeout
+        with client.cond:
+            while client.version == since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                client.cond.wait(remaining)
+            return client.version
+
+    def wait_for_events(self, client_id, since, timeout):
+        client = self._client(client_id)
+        deadline = time.monotonic() + timeout
+        with client.cond:
+            while client.event_seq <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                client.cond.wait(remaining)
+            return [event for event in client.events if event["id"] > since]
+
+    def events_resumable(self, client_id, since):
+        client = self._client(client_id)
+        with client.cond:
+            oldest = client.events[0]["id"] if client.events else client.event_seq + 1
+            return oldest - 1 <= since <= client.event_seq
+
+
+class SQLiteStateBackend(StateBackend):
+    """State in a SQLite database in WAL mode, shared by every worker process.
+
+    Mutations run inside BEGIN IMMEDIATE transactions so test-and-set
+    operations are atomic across processes. Waiters in the same process are
+    woken immediately; waiters in other processes notice new events within
+    `poll_interval` seconds. Every per-client lookup goes through the
+    primary key or a (client_id, id) index.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS clients (
+            client_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            registered_at REAL NOT NULL,
+            submission_locked INTEGER NOT NULL DEFAULT 0,
+            screenshot_capture_requested INTEGER NOT NULL DEFAULT 0,
+            kill_switch_activated INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS content_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id TEXT NOT NULL,
+            content TEXT NOT NULL,
+            typed INTEGER NOT NULL DEFAULT 0,
+            parked INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS content_queue_client ON content_queue (client_id, id);
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS events_client ON events (client_id, id);
+        CREATE TABLE IF NOT EXISTS capture_schedules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            client_id TEXT NOT NULL,
+            start REAL NOT NULL,
+            interval REAL NOT NULL,
+            count INTEGER,
+            ends_at REAL,
+            stopped INTEGER NOT NULL DEFAULT 0,
+            settled TEXT
+        );
+        CREATE INDEX IF NOT EXISTS capture_schedules_client ON capture_schedules (client_id, id);
+        CREATE TABLE IF NOT EXISTS capture_fulfilments (
+            schedule_id INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            latency REAL NOT NULL,
+            PRIMARY KEY (schedule_id, n)
+        );
+        CREATE TABLE IF NOT EXISTS content_history (
+            client_id TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            submitted REAL NOT NULL,
+            size INTEGER NOT NULL,
+            preview TEXT NOT NULL,
+            finished REAL,
+            outcome TEXT NOT NULL DEFAULT 'queued',
+            PRIMARY KEY (client_id, id)
+        );
+        CREATE INDEX IF NOT EXISTS content_history_time ON content_history (client_id, submitted, id);
+    """
+
+    def __init__(self, path, event_history=256, poll_interval=0.2, submit_window=1, schedule_history=32,
+                 content_history=10000):
+        super().__init__()
+        self.path = path
+        self.submit_window = submit_window
+        self.event_history = event_history
+        self.schedule_history = schedule_history
+        self.content_history_limit = content_history
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._conds_lock = threading.Lock()
+        self._conds = {}
+        self._conn().executescript(self.SCHEMA)
+        self._migrate()
+        self.register_client(DEFAULT_CLIENT_ID)
+
+    def _migrate(self):
+        # Columns added since the first release; another worker may add them first
+        for table, column in [("clients", "version"), ("content_queue", "typed"), ("content_queue", "parked")]:
+            columns = {row[1] for row in self._conn().execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                try:
+                    self._conn().execute(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    pass
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        # Connections must not cross a fork (gunicorn --preload)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    def _cond(self, client_id):
+        with self._conds_lock:
+            cond = self._conds.get(client_id)
+            if cond is None:
+                cond = self._conds[client_id] = threading.Condition()
+            return cond
+
+    def _flags(self, conn, client_id):
+        row = conn.execute(
+            "SELECT submission_locked, screenshot_capture_requested, kill_switch_activated"
+            " FROM clients WHERE client_id = ?", (client_id,)
+        ).fetchone()
+        if row is None:
+            raise UnknownClient(client_id)
+        return {
+            "submission_locked": bool(row[0]),
+            "screenshot_capture_requested": bool(row[1]),
+            "kill_switch_activated": bool(row[2]),
+        }
+
+    def _set_flag(self, conn, client_id, name, value):
+        # `name` is always one of the column literals above
+        conn.execute(f"UPDATE clients SET {name} = ? WHERE client_id = ?", (int(value), client_id))
+
+    def _bump_version(self, conn, client_id):
+        conn.execute("UPDATE clients SET version = version + 1 WHERE client_id = ?", (client_id,))
+
+    def _state_changed(self, client_id):
+        # After commit: wake local waiters; other processes poll
+        cond = self._cond(client_id)
+        with cond:
+            cond.notify_all()
+        self._notify_listeners(client_id)
+
+    def _queue_size(self, conn, client_id):
+        return conn.execute("SELECT COUNT(*) FROM content_queue WHERE client_id = ?", (client_id,)).fetchone()[0]
+
+    def _active_size(self, conn, client_id):
+        return conn.execute(
+            "SELECT COUNT(*) FROM content_queue WHERE client_id = ? AND parked = 0", (client_id,)
+        ).fetchone()[0]
+
+    def register_client(self, client_id, name=None):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO clients (client_id, name, registered_at, version) VALUES (?, ?, ?, ?)",
+                (client_id, name or client_id, now, int(now * 1000)),
+            )
+            row = conn.execute(
+                "SELECT client_id, name, registered_at FROM clients WHERE client_id = ?", (client_id,)
+            ).fetchone()
+        return {"client_id": row[0], "name": row[1], "registered_at": row[2]}
+
+    def has_client(self, client_id):
+        return self._conn().execute("SELECT 1 FROM clients WHERE client_id = ?", (client_id,)).fetchone() is not None
+
+    def clients(self):
+        rows = self._conn().execute(
+            "SELECT client_id, name, registered_at FROM clients ORDER BY registered_at, client_id"
+        ).fetchall()
+        return [{"client_id": row[0], "name": row[1], "registered_at": row[2]} for row in rows]
+
+    def submit(self, client_id, contents):
+        with self._transaction() as conn:
+            flags = self._flags(conn, client_id)
+            size = self._active_size(conn, client_id)
+            if flags["submission_locked"] or size + len(contents) > max(self.submit_window, len(contents)):
+                return None
+            items = []
+            submitted = time.time()
+            for content in contents:
+                cursor = conn.execute(
+                    "INSERT INTO content_queue (client_id, content) VALUES (?, ?)", (client_id, content)
+                )
+                items.append({"id": cursor.lastrowid, "content": content})
+                info = describe(content)
+                conn.execute(
+                    "INSERT INTO content_history (client_id, id, submitted, size, preview) VALUES (?, ?, ?, ?, ?)",
+                    (client_id, cursor.lastrowid, submitted, info["size"], info["preview"][:HISTORY_PREVIEW_CHARS]),
+                )
+            conn.execute(
+                "DELETE FROM content_history WHERE client_id = ? AND id <= (SELECT id FROM content_history"
+                " WHERE client_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (client_id, client_id, self.content_history_limit),
+            )
+            self._set_flag(conn, client_id, "submission_locked", size + len(contents) >= self.submit_window)
+            self._bump_version(conn, client_id)
+        self._state_changed(client_id)
+        return items
+
+    def _head(self, conn, client_id):
+        row = conn.execute(
+            "SELECT id, content, typed FROM content_queue WHERE client_id = ? AND parked = 0 ORDER BY id LIMIT 1",
+            (client_id,),
+        ).fetchone()
+        return {"id": row[0], "content": row[1], "typed": row[2]} if row else None
+
+    def head(self, client_id):
+        return self._head(self._conn(), client_id)
+
+    def next_items(self, client_id, limit, after=None):
+        rows = self._conn().execute(
+            "SELECT id, content, typed FROM content_queue WHERE client_id = ? AND id > ? AND parked = 0"
+            " ORDER BY id LIMIT ?",
+            (client_id, after if after is not None else 0, limit),
+        ).fetchall()
+        return [{"id": row[0], "content": row[1], "typed": row[2]} for row in rows]
+
+    def recent(self, client_id, limit):
+        rows = self._conn().execute(
+            "SELECT id, content FROM content_queue WHERE client_id = ? ORDER BY id DESC LIMIT ?",
+            (client_id, limit),
+        ).fetchall()
+        return [{"id": row[0], "content": row[1]} for row in reversed(rows)]
+
+    def queue_size(self, client_id):
+        return self._queue_size(self._conn(), client_id)
+
+    def report_progress(self, client_id, offsets):
+        confirmed = {}
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            for item_id, typed in offsets.items():
+                row = conn.execute(
+                    "SELECT typed FROM content_queue WHERE client_id = ? AND id = ?", (client_id, item_id)
+                ).fetchone()
+                if row is None:
+                    continue
+                if typed > row[0]:
+                    conn.execute("UPDATE content_queue SET typed = ? WHERE id = ?", (typed, item_id))
+                confirmed[item_id] = (max(typed, row[0]), max(typed - row[0], 0))
+            changed = any(advanced for _, advanced in confirmed.values())
+            if changed:
+                self._bump_version(conn, client_id)
+        if changed:
+            self._state_changed(client_id)
+        return confirmed
+
+    def park(self, client_id, ids=None, id_range=None):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            if ids is None and id_range is None:
+                head = self._head(conn, client_id)
+                ids = [head["id"]] if head else []
+            first, last = id_range if id_range is not None else (None, None)
+            rows = conn.execute(
+                "UPDATE content_queue SET parked = 1 WHERE client_id = ? AND parked = 0"
+                f" AND (id IN ({','.join('?' * len(ids or ()))}) OR id BETWEEN ? AND ?) RETURNING id, content, typed",
+                (client_id, *(ids or ()), first, last),
+            ).fetchall()
+            if self._active_size(conn, client_id) < self.submit_window:
+                self._set_flag(conn, client_id, "submission_locked", False)
+            if rows:
+                self._bump_version(conn, client_id)
+        if rows:
+            self._state_changed(client_id)
+        return [{"id": row[0], "content": row[1], "typed": row[2]} for row in sorted(rows)]
+
+    def resume(self, client_id, ids=None):
+        with self._transaction() as conn:
+            flags = self._flags(conn, client_id)
+            rows = conn.execute(
+                "SELECT id, content, typed FROM content_queue WHERE client_id = ? AND parked = 1 ORDER BY id",
+                (client_id,),
+            ).fetchall()
+            if ids is not None:
+                rows = [row for row in rows if row[0] in set(ids)]
+            if not rows:
+                return []
+            size = self._active_size(conn, client_id)
+            if flags["submission_locked"] or size + len(rows) > max(self.submit_window, len(rows)):
+                return None
+            conn.executemany("UPDATE content_queue SET parked = 0 WHERE id = ?", [(row[0],) for row in rows])
+            self._set_flag(conn, client_id, "submission_locked", size + len(rows) >= self.submit_window)
+            self._bump_version(conn, client_id)
+        self._state_changed(client_id)
+        return [{"id": row[0], "content": row[1], "typed": row[2]} for row in rows]
+
+    def content_history(self, client_id, before=None, limit=50, start=None, end=None):
+        conn = self._conn()
+        if not self.has_client(client_id):
+            raise UnknownClient(client_id)
+        clauses, params = ["client_id = ?"], [client_id]
+        if before is not None:
+            row = conn.execute(
+                "SELECT submitted FROM content_history WHERE client_id = ? AND id = ?", (client_id, before)
+            ).fetchone()
+            if row is None:
+                raise ExpiredCursor(before)
+            clauses.append("(submitted, id) < (?, ?)")
+            params += [row[0], before]
+        if start is not None:
+            clauses.append("submitted >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("submitted <= ?")
+            params.append(end)
+        rows = conn.execute(
+            "SELECT id, submitted, size, preview, finished, outcome FROM content_history"
+            f" WHERE {' AND '.join(clauses)} ORDER BY submitted DESC, id DESC LIMIT ?",
+            (*params, limit + 1),
+        ).fetchall()
+        records = [
+            {"id": row[0], "submitted": row[1], "size": row[2], "preview": row[3], "finished": row[4], "outcome": row[5]}
+            for row in rows[:limit]
+        ]
+        return records, len(rows) > limit
+
+    def _finish_history(self, conn, client_id, removed, outcome):
+        finished = time.time()
+        conn.executemany(
+            "UPDATE content_history SET finished = ?, outcome = ? WHERE client_id = ? AND id = ?",
+            [(finished, outcome, client_id, item["id"]) for item in removed],
+        )
+
+    def acknowledge(self, client_id, ids=None, id_range=None, outcome="acknowledged"):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            if ids is None and id_range is None:
+                head = self._head(conn, client_id)
+                ids = [head["id"]] if head else []
+            removed = []
+            for item_id in ids or ():
+                row = conn.execute(
+                    "DELETE FROM content_queue WHERE client_id = ? AND id = ? RETURNING id, content",
+                    (client_id, item_id),
+                ).fetchone()
+                if row:
+                    removed.append({"id": row[0], "content": row[1]})
+            if id_range is not None:
+                rows = conn.execute(
+                    "DELETE FROM content_queue WHERE client_id = ? AND id BETWEEN ? AND ? RETURNING id, content",
+                    (client_id, *id_range),
+                ).fetchall()
+                removed.extend({"id": row[0], "content": row[1]} for row in sorted(rows))
+            if self._active_size(conn, client_id) < self.submit_window:
+                self._set_flag(conn, client_id, "submission_locked", False)
+            if removed:
+                self._finish_history(conn, client_id, removed, outcome)
+                self._bump_version(conn, client_id)
+        if removed:
+            self._state_changed(client_id)
+        return removed
+
+    def clear_queue(self, client_id):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            rows = conn.execute(
+                "DELETE FROM content_queue WHERE client_id = ? RETURNING id, content", (client_id,)
+            ).fetchall()
+            removed = [{"id": row[0], "content": row[1]} for row in sorted(rows)]
+            self._finish_history(conn, client_id, removed, "cleared")
+            self._set_flag(conn, client_id, "submission_locked", False)
+            self._bump_version(conn, client_id)
+        self._state_changed(client_id)
+        return removed
+
+    def unlock(self, client_id):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            self._set_flag(conn, client_id, "submission_locked", False)
+            self._bump_version(conn, client_id)
+        self._state_changed(client_id)
+
+    def set_kill_switch(self, client_id, active):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            self._set_flag(conn, client_id, "kill_switch_activated", active)
+            self._bump_version(conn, client_id)
+        self._state_changed(client_id)
+
+    def request_capture(self, client_id):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            self._set_flag(conn, client_id, "screenshot_capture_requested", True)
+            self._bump_version(conn, client_id)
+        self._state_changed(client_id)
+
+    def take_capture_request(self, client_id):
+        with self._transaction() as conn:
+            requested = self._flags(conn, client_id)["screenshot_capture_requested"]
+            if requested:
+                self._set_flag(conn, client_id, "screenshot_capture_requested", False)
+                self._bump_version(conn, client_id)
+        if requested:
+            self._state_changed(client_id)
+        return requested
+
+    def _schedules(self, conn, client_id, active_since=None, schedule_id=None):
+        rows = conn.execute(
+            "SELECT id, start, interval, count, ends_at, stopped, settled FROM capture_schedules"
+            " WHERE client_id = ? AND (? IS NULL OR ends_at IS NULL OR ends_at >= ?) AND (? IS NULL OR id = ?)"
+            " ORDER BY id",
+            (client_id, active_since, active_since, schedule_id, schedule_id),
+        ).fetchall()
+        schedules = OrderedDict(
+            (row[0], {
+                "id": row[0], "start": row[1], "interval": row[2], "count": row[3],
+                "ends_at": row[4], "stopped": bool(row[5]), "fulfilled": {},
+                "settled": json.loads(row[6]) if row[6] else new_settled(),
+            })
+            for row in rows
+        )
+        if schedules:
+            placeholders = ",".join("?" * len(schedules))
+            for schedule_id, n, latency in conn.execute(
+                f"SELECT schedule_id, n, latency FROM capture_fulfilments WHERE schedule_id IN ({placeholders})",
+                list(schedules),
+            ):
+                schedules[schedule_id]["fulfilled"][n] = latency
+        return list(schedules.values())
+
+    def add_capture_schedule(self, client_id, count=1, interval=0.0, start=None):
+        now = time.time()
+        start = now if start is None else start
+        ends_at = schedule_ends_at(start, interval, count)
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            cursor = conn.execute(
+                "INSERT INTO capture_schedules (client_id, start, interval, count, ends_at) VALUES (?, ?, ?, ?, ?)",
+                (client_id, start, interval, count, ends_at),
+            )
+            schedule = {
+                "id": cursor.lastrowid, "start": start, "interval": interval, "count": count,
+                "ends_at": ends_at, "stopped": False, "fulfilled": {}, "settled": new_settled(),
+            }
+            rows = conn.execute(
+                "SELECT id, ends_at FROM capture_schedules WHERE client_id = ? ORDER BY id", (client_id,)
+            ).fetchall()
+            expired = _expired_schedules(
+                [{"id": row[0], "ends_at": row[1]} for row in rows], self.schedule_history, now
+            )
+            for schedule_id in expired:
+                conn.execute("DELETE FROM capture_fulfilments WHERE schedule_id = ?", (schedule_id,))
+                conn.execute("DELETE FROM capture_schedules WHERE id = ?", (schedule_id,))
+            self._set_flag(conn, client_id, "screenshot_capture_requested", True)
+            self._bump_version(conn, client_id)
+        self._state_changed(client_id)
+        return schedule
+
+    def stop_capture_schedules(self, client_id, schedule_id=None):
+        now = time.time()
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            rows = conn.execute(
+                "UPDATE capture_schedules SET ends_at = ?, stopped = 1"
+                " WHERE client_id = ? AND (? IS NULL OR id = ?) AND (ends_at IS NULL OR ends_at > ?) RETURNING id",
+                (now, client_id, schedule_id, schedule_id, now),
+            ).fetchall()
+            if rows:
+                self._bump_version(conn, client_id)
+        if rows:
+            self._state_changed(client_id)
+        return sorted(row[0] for row in rows)
+
+    def capture_schedules(self, client_id, active=False):
+        conn = self._conn()
+        self._flags(conn, client_id)
+        return self._schedules(conn, client_id, active_since=time.time() - CAPTURE_GRACE if active else None)
+
+    def fulfil_capture(self, client_id, schedule_id, n, latency):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            schedule = next(iter(self._schedules(conn, client_id, schedule_id=schedule_id)), None)
+            if schedule is None:
+                return False
+            before = max(settle_point(schedule, time.time()), schedule["settled"]["before"])
+            if n < before or (schedule["count"] is not None and n >= schedule["count"]):
+                return False
+            recorded = conn.execute(
+                "INSERT OR IGNORE INTO capture_fulfilments (schedule_id, n, latency) VALUES (?, ?, ?)",
+                (schedule_id, n, latency),
+            ).rowcount
+            if recorded:
+                schedule["fulfilled"][n] = latency
+                if before > schedule["settled"]["before"]:
+                    settle(schedule, before)
+                    conn.execute("DELETE FROM capture_fulfilments WHERE schedule_id = ? AND n < ?", (schedule_id, before))
+                    conn.execute("UPDATE capture_schedules SET settled = ? WHERE id = ?",
+                                 (json.dumps(schedule["settled"]), schedule_id))
+                self._bump_version(conn, client_id)
+        if recorded:
+            self._state_changed(client_id)
+        return bool(recorded)
+
+    def _status(self, conn, client_id):
+        flags = self._flags(conn, client_id)
+        return {
+            "locked": flags["submission_locked"],
+            "queue_size": self._queue_size(conn, client_id),
+            "kill_switch": flags["kill_switch_activated"],
+            "capture_requested": flags["screenshot_capture_requested"],
+            "head": self._head(conn, client_id),
+            "parked": [row[0] for row in conn.execute(
+                "SELECT id FROM content_queue WHERE client_id = ? AND parked = 1 ORDER BY id", (client_id,)
+            )],
+            "progress": dict(conn.execute(
+                "SELECT id, typed FROM content_queue WHERE client_id = ? AND typed > 0", (client_id,)
+            ).fetchall()),
+        }
+
+    def status(self, client_id):
+        with self._transaction() as conn:
+            return self._status(conn, client_id)
+
+    def subscribe_snapshot(self, client_id):
+        with self._transaction() as conn:
+            snapshot = self._status(conn, client_id)
+            snapshot["last_event_id"] = self._last_event_id(conn, client_id)
+            if snapshot["capture_requested"]:
+                self._set_flag(conn, client_id, "screenshot_capture_requested", False)
+                self._bump_version(conn, client_id)
+        if snapshot["capture_requested"]:
+            self._state_changed(client_id)
+        return snapshot
+
+    def _last_event_id(self, conn, client_id):
+        # Pruning always keeps the newest events, so MAX(id) is the sequence head
+        return conn.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM events WHERE client_id = ?", (client_id,)
+        ).fetchone()[0]
+
+    def publish(self, client_id, event_type, data=None):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            conn.execute(
+                "INSERT INTO events (client_id, type, data) VALUES (?, ?, ?)",
+                (client_id, event_type, json.dumps(data or {})),
+            )
+            conn.execute(
+                "DELETE FROM events WHERE client_id = ? AND id <= ("
+                "SELECT id FROM events WHERE client_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                (client_id, client_id, self.event_history),
+            )
+        self._state_changed(client_id)
+
+    def event_watermark(self):
+        # Both terms only grow, so the sum changes on any publish or state change
+        return self._conn().execute(
+            "SELECT (SELECT COALESCE(MAX(id), 0) FROM events) + (SELECT COALESCE(SUM(version), 0) FROM clients)"
+        ).fetchone()[0]
+
+    def version(self, client_id):
+        row = self._conn().execute("SELECT version FROM clients WHERE client_id = ?", (client_id,)).fetchone()
+        if row is None:
+            raise UnknownClient(client_id)
+        return row[0]
+
+    def touch(self, client_id):
+        with self._transaction() as conn:
+            self._flags(conn, client_id)
+            self._bump_version(conn, client_id)
+        self._state_changed(client_id)
+
+    def wait_for_version(self, client_id, since, timeout):
+        cond = self._cond(client_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            current = self.version(client_id)
+            remaining = deadline - time.monotonic()
+            if current != since or remaining <= 0:
+                return current
+            with cond:
+                cond.wait(min(self.poll_interval, remaining))
+
+    def _events_since(self, client_id, since):
+        rows = self._conn().execute(
+            "SELECT id, type, data FROM events WHERE client_id = ? AND id > ? ORDER BY id", (client_id, since)
+        ).fetchall()
+        return [{"id": row[0], "type": row[1], "data": json.loads(row[2])} for row in rows]
+
+    def events_resumable(self, client_id, since):
+        # Ids are shared by all clients, so pruning cannot be told from gaps;
+        # only a cursor past the head (a reset database) is caught here
+        return since <= self._last_event_id(self._conn(), client_id)
+
+    def wait_for_events(self, client_id, since, timeout):
+        cond = self._cond(client_id)
+        deadline = time.monotonic() + timeout
+        while True:
+            events = self._events_since(client_id, since)
+            remaining = deadline - time.monotonic()
+            if events or remaining <= 0:
+                return events
+            with cond:
+                cond.wait(min(self.poll_interval, remaining))
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT/ROLLBACK around a block."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def create_state_backend(backend="memory", path=None, journal_dir=None, snapshot_every=10000, **options):
+    """Build a state backend by name ('memory' or 'sqlite').
+
+    `journal_dir` and `snapshot_every` apply to the in-process backend only;
+    other options (event_history, submit_window, schedule_history,
+    content_history) to both.
+    """
+    if backend == "memory":
+        return InProcessStateBackend(journal_dir=journal_dir, snapshot_every=snapshot_every, **options)
+    if backend == "sqlite":
+        return SQLiteStateBackend(path or "state.db", **options)
+    raise ValueError(f"Unknown state backend: {backend}")
@@ -0,0 +1,285 @@
+// Dashboard behaviour. The page passes the key, client id and state version
+// as data- attributes on <body>; everything after the first render is
+// patched in place from /dashboard/state, which is long-polled with
+// ?since=<version> so updates arrive as soon as something changes.
+const dashboard = document.body.dataset;
+const auth = `key=${encodeURIComponent(dashboard.key)}&client_id=${encodeURIComponent(dashboard.clientId)}`;
+let stateVersion = dashboard.version;
+
+function post(url, extra) {
+    return fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/x-www-form-urlencoded',
+        },
+        body: auth + (extra || '')
+    }).then(response => response.text());
+}
+
+function fetchDashboard(since) {
+    return fetch(`/dashboard/state?${auth}${since ? `&since=${since}` : ''}`)
+        .then(response => {
+            if (response.status === 304) {
+                return null; // Nothing changed while we waited
+            }
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (data) {
+                stateVersion = data.version;
+                renderStatus(data);
+                renderGallery(data.screenshots);
+                renderRecentItems(data.recent_items);
+            }
+        });
+}
+
+function refreshDashboard() {
+    fetchDashboard().catch(error => {
+        console.error('Dashboard refresh failed:', error);
+    });
+}
+
+function watchDashboard() {
+    fetchDashboard(stateVersion)
+        .then(watchDashboard)
+        .catch(error => {
+            console.error('Dashboard refresh failed:', error);
+            setTimeout(watchDashboard, 5000);
+        });
+}
+
+function renderStatus(data) {
+    const statusDiv = document.getElementById('status');
+    const killStatusSpan = document.getElementById('kill-status');
+    const submitButton = document.querySelector('form button');
+
+    document.getElementById('queue-size').textContent = data.queue_size;
+    document.getElementById('typing-progress').textContent = formatProgress(data.progress);
+    document.getElementById('parked-items').textContent = data.parked
+        .map(item => `item ${item.id} at ${item.typed} characters`).join(', ');
+    document.getElementById('parked').classList.toggle('hidden', !data.parked.length);
+    document.getElementById('screenshot-count').textContent = data.screenshot_count || 0;
+
+    if (data.kill_switch) {
+        killStatusSpan.textContent = 'ACTIVATED';
+        killStatusSpan.className = 'text-red-700 font-bold';
+    } else {
+        killStatusSpan.textContent = 'Inactive';
+        killStatusSpan.className = 'text-green-700';
+    }
+
+    if (data.locked) {
+        statusDiv.classList.remove('bg-green-100');
+        statusDiv.classList.add('bg-yellow-100');
+        statusDiv.querySelector('p:first-child').innerHTML = '<span class="text-yellow-700">Locked - Waiting for typing acknowledgement</span>';
+        submitButton.disabled = true;
+        submitButton.textContent = 'Submission Locked';
+    } else {
+        statusDiv.classList.remove('bg-yellow-100');
+        statusDiv.classList.add('bg-green-100');
+        statusDiv.querySelector('p:first-child').innerHTML = '<span class="text-green-700">Ready to accept submissions</span>';
+        submitButton.disabled = false;
+        submitButton.textContent = 'Submit Content';
+    }
+    document.getElementById('force-unlock').classList.toggle('hidden', !data.locked);
+}
+
+function formatProgress(progress) {
+    if (!progress) {
+        return 'Idle';
+    }
+    if (!progress.length) {
+        return `item ${progress.id}: ${progress.typed} characters`;
+    }
+    const percent = Math.min(100, Math.floor(100 * progress.typed / progress.length));
+    return `item ${progress.id}: ${progress.typed} / ${progress.length} characters (${percent}%)`;
+}
+
+function renderGallery(screenshots) {
+    const gallery = document.getElementById('screenshot-gallery');
+    if (!screenshots.length) {
+        gallery.innerHTML = '<p class="text-gray-500 col-span-full text-center py-8">No screenshots captured yet</p>';
+        return;
+    }
+    // Keep tiles that are already on the page so their thumbnails are not
+    // refetched, unless the thumbnail has been rendered since
+    const existing = new Map();
+    gallery.querySelectorAll('[data-screenshot-id]').forEach(tile =>
+        existing.set(`${tile.dataset.screenshotId}:${tile.dataset.thumb}`, tile));
+    gallery.replaceChildren(...screenshots.map((screenshot, index) =>
+        existing.get(`${screenshot.id}:${screenshot.thumb}`) || screenshotTile(screenshot, index)));
+}
+
+function screenshotTile(screenshot, index) {
+    const tile = document.createElement('div');
+    tile.className = 'border rounded-lg p-3 bg-gray-50';
+    tile.dataset.screenshotId = screenshot.id;
+    tile.dataset.timestamp = screenshot.timestamp;
+    tile.dataset.thumb = screenshot.thumb;
+
+    const image = document.createElement('img');
+    image.src = `/screenshots/${screenshot.id}/thumb?${auth}`;
+    image.loading = 'lazy';
+    image.alt = `Screenshot ${index + 1}`;
+    image.className = 'w-full h-48 object-cover rounded cursor-pointer';
+
+    const caption = document.createElement('p');
+    caption.className = 'text-xs text-gray-500 mt-2';
+    caption.textContent = screenshot.timestamp;
+
+    tile.append(image, caption);
+    return tile;
+}
+
+function renderRecentItems(items) {
+    const container = document.getElementById('recent-items');
+    if (!items.length) {
+        container.innerHTML = '<p class="text-sm text-gray-500">No submissions yet</p>';
+        return;
+    }
+    const list = document.createElement('ul');
+    list.className = 'space-y-2';
+    for (const item of items) {
+        const entry = document.createElement('li');
+        entry.className = 'text-sm text-gray-600 bg-gray-50 p-3 rounded';
+        entry.textContent = item.content;
+        list.append(entry);
+    }
+    container.replaceChildren(list);
+}
+
+function activateKillSwitch(allClients) {
+    const target = allClients ? 'ALL client applications' : 'the client application';
+    if (confirm(`⚠️ WARNING: This will immediately terminate ${target}. Are you sure?`)) {
+        post('/activate_kill_switch', allClients ? '&broadcast=1' : '')
+            .then(data => {
+                alert('🛑 KILL SWITCH ACTIVATED - Client will terminate');
+                refreshDashboard();
+            })
+            .catch(error => {
+                console.error('Error activating kill switch:', error);
+                alert('Failed to activate kill switch');
+            });
+    }
+}
+
+function deactivateKillSwitch() {
+    post('/deactivate_kill_switch')
+        .then(data => {
+            alert('✅ Kill switch deactivated');
+            refreshDashboard();
+        })
+        .catch(error => {
+            console.error('Error deactivating kill switch:', error);
+            alert('Failed to deactivate kill switch');
+        });
+}
+
+function requestScreenshot(allClients) {
+    post('/request_screenshot', allClients ? '&broadcast=1' : '')
+        .then(data => {
+            alert('Screenshot request sent to client');
+            // The upload bumps the state version; watchDashboard picks it up
+        })
+        .catch(error => {
+            console.error('Error requesting screenshot:', error);
+            alert('Failed to request screenshot');
+        });
+}
+
+function startCaptureSchedule() {
+    const fields = ['count', 'interval', 'duration']
+        .map(name => [name, document.getElementById(`capture-${name}`).value])
+        .filter(([name, value]) => value !== '');
+    const extra = fields.map(([name, value]) => `&${name}=${encodeURIComponent(value)}`).join('');
+    post('/request_screenshot', extra)
+        .then(data => {
+            alert(data.startsWith('{') ? 'Capture schedule started' : data);
+        })
+        .catch(error => {
+            console.error('Error starting capture schedule:', error);
+            alert('Failed to start capture schedule');
+        });
+}
+
+function stopCaptureSchedules() {
+    post('/stop_screenshot_schedule')
+        .then(data => {
+            alert('Capture schedules stopped');
+        })
+        .catch(error => {
+            console.error('Error stopping capture schedules:', error);
+            alert('Failed to stop capture schedules');
+        });
+}
+
+function clearScreenshots() {
+    if (confirm('Are you sure you want to clear all screenshots?')) {
+        post('/clear_screenshots')
+            .then(data => {
+                alert('Screenshots cleared');
+                refreshDashboard();
+            })
+            .catch(error => {
+                console.error('Error clearing screenshots:', error);
+                alert('Failed to clear screenshots');
+            });
+    }
+}
+
+function clearQueue() {
+    if (confirm('Are you sure you want to clear the entire content queue?')) {
+        post('/clear_queue')
+            .then(data => {
+                alert('Content queue cleared');
+                refreshDashboard();
+            })
+            .catch(error => {
+                console.error('Error clearing queue:', error);
+                alert('Failed to clear queue');
+            });
+    }
+}
+
+function resumeItems() {
+    post('/resume')
+        .then(data => {
+            if (!data.startsWith('{')) {
+                alert(data);
+            }
+            // The resume bumps the state version; watchDashboard picks it up
+        })
+        .catch(error => {
+            console.error('Error resuming content:', error);
+            alert('Failed to resume content');
+        });
+}
+
+function openModal(imageUrl, timestamp) {
+    const modal = document.getElementById('screenshot-modal');
+    const modalImage = document.getElementById('modal-image');
+    const modalTimestamp = document.getElementById('modal-timestamp');
+
+    modalImage.src = imageUrl;
+    modalTimestamp.textContent = 'Captured: ' + timestamp;
+    modal.classList.remove('hidden');
+}
+
+function closeModal() {
+    const modal = document.getElementById('screenshot-modal');
+    modal.classList.add('hidden');
+}
+
+// One delegated handler so tiles added by renderGallery need no wiring
+document.getElementById('screenshot-gallery').addEventListener('click', event => {
+    const tile = event.target.closest('[data-screenshot-id]');
+    if (tile && event.target.tagName === 'IMG') {
+        openModal(`/screenshots/${tile.dataset.screenshotId}/display?${auth}`, tile.dataset.timestamp);
+    }
+});
+
+watchDashboard();
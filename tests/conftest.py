@@ -0,0 +1,41 @@
+"""Test setup: server.py reads its configuration from the environment at
+import time, so it is set here, before any test module imports it."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_scratch = tempfile.mkdtemp(prefix="server-tests-")
+os.environ.update({
+    "SECRET_KEY": "test-secret",
+    "CLIENT_TOKENS": "alice=alice-token",
+    "SCREENSHOT_DIR": os.path.join(_scratch, "screenshots"),
+    "CONTENT_SPOOL_DIR": os.path.join(_scratch, "content-spool"),
+    "CONTENT_SPOOL_THRESHOLD": "1024",
+    "IMAGE_WORKERS": "0",  # render variants inline so tests see them at once
+    # Tests poll far faster than clients; test_admission sets its own limiter
+    "RATE_LIMIT_POLL": "",
+    "RATE_LIMIT_UPLOAD": "",
+    "RATE_LIMIT_ADMIN": "",
+})
+KEY = "test-secret"
+
+
+@pytest.fixture
+def server():
+    import server
+    return server
+
+
+@pytest.fixture
+def client(server):
+    return server.app.test_client()
+
+
+@pytest.fixture
+def admin_headers():
+    return {"X-Key": KEY}
@@ -0,0 +1,104 @@
+import io
+import json
+
+import pytest
+
+from admission import ByteBudget, RateLimiter, UploadBudgetExceeded, parse_rate
+from conftest import KEY
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parse_rate():
+    assert parse_rate("") is None
+    assert parse_rate("0") is None
+    assert parse_rate("5") == (5.0, 10.0)
+    assert parse_rate("0.2") == (0.2, 1.0)
+    assert parse_rate("5:20") == (5.0, 20.0)
+    with pytest.raises(ValueError):
+        parse_rate("5:0")
+    with pytest.raises(ValueError):
+        parse_rate("fast")
+
+
+def test_rate_limiter_refills_per_client_and_class():
+    clock = FakeClock()
+    limiter = RateLimiter({"poll": (1.0, 2.0), "upload": None}, clock=clock)
+    assert limiter.admit("a", "poll") == 0.0
+    assert limiter.admit("a", "poll") == 0.0
+    assert limiter.admit("a", "poll") == pytest.approx(1.0)
+    assert limiter.admit("b", "poll") == 0.0  # buckets are per client
+    assert limiter.admit("a", "upload") == 0.0  # and disabled classes are free
+    clock.now = 0.5
+    assert limiter.admit("a", "poll") == pytest.approx(0.5)
+    clock.now = 1.0
+    assert limiter.admit("a", "poll") == 0.0
+
+
+def test_byte_budget():
+    budget = ByteBudget(100)
+    first = budget.reserve(60)
+    with pytest.raises(UploadBudgetExceeded):
+        budget.reserve(50)
+    first.charge(80)  # reading past the declared size reserves more
+    assert budget.in_flight == 80
+    second = budget.reserve(20)
+    with pytest.raises(UploadBudgetExceeded):
+        first.charge(10)
+    first.release()
+    with second:
+        assert budget.in_flight == 20
+    assert budget.in_flight == 0
+    with budget.reserve(500):  # one upload is always admitted on its own
+        assert budget.in_flight == 500
+
+
+@pytest.fixture
+def alice(server):
+    server.state.register_client("alice")
+    return {"X-Key": "alice-token"}
+
+
+def test_rate_limit(server, client, alice, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server, "rate_limiter", RateLimiter({"poll": (0.5, 2.0)}, clock=clock))
+    assert client.get("/status", headers=alice).status_code == 200
+    assert client.get("/status", headers=alice).status_code == 200
+    response = client.get("/status", headers=alice)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    # Other clients and route classes are not affected
+    assert client.get("/status", headers={"X-Key": KEY}).status_code == 200
+    assert client.post("/clear_queue", headers=alice).status_code == 200
+    clock.now = 2.0
+    assert client.get("/status", headers=alice).status_code == 200
+
+
+def test_upload_budget(server, client, monkeypatch):
+    budget = ByteBudget(1000)
+    monkeypatch.setattr(server, "upload_budget", budget)
+    headers = {"X-Key": KEY, "Content-Type": "application/octet-stream"}
+    with budget.reserve(900):
+        response = client.post("/upload_screenshot", data=b"x" * 200, headers=headers)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(server.IMAGE_RETRY_AFTER)
+        response = client.post("/upload_screenshot", json={"screenshot": "eA==" * 100}, headers={"X-Key": KEY})
+        assert response.status_code == 503
+    assert client.post("/upload_screenshot", data=b"x" * 200, headers=headers).status_code == 200
+    assert budget.in_flight == 0
+
+
+def test_json_upload_needs_a_bounded_content_length(server, client, monkeypatch):
+    body = json.dumps({"key": KEY, "screenshot": "eA=="}).encode()
+
+    response = client.post("/upload_screenshot", input_stream=io.BytesIO(body), content_type="application/json",
+                           headers={"Transfer-Encoding": "chunked", "X-Key": KEY})
+    assert response.status_code == 411
+    monkeypatch.setattr(server, "MAX_REQUEST_SIZE", 16)
+    assert client.post("/upload_screenshot", data=body, content_type="application/json").status_code == 413
@@ -0,0 +1,108 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from conftest import KEY
+
+
+@pytest.fixture
+def asgi(server):
+    import asgi
+    return asgi
+
+
+def request(asgi, method, path, query="", headers=(), body=b""):
+    """Run one request through the native handlers or the WSGI adapter.
+
+    Mirrors asgi.app without starting the event hub, which would stay bound
+    to this short-lived loop.
+    """
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query.encode(),
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers],
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    async def run():
+        req = asgi.AsyncRequest(scope, receive)
+        handler = asgi.native_handler(req) or asgi.call_wsgi
+        try:
+            await handler(req, send)
+        except asgi.HTTPError as e:
+            await asgi.send_response(send, e.status, e.message)
+
+    asyncio.run(run())
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def test_native_upload_and_status(server, asgi):
+    before = len(server.screenshot_store_for("default"))
+    status, body = request(asgi, "POST", "/upload_screenshot", headers=[("X-Key", KEY)], body=b"\x89PNG image")
+    assert (status, body) == (200, b"Screenshot uploaded successfully")
+
+    status, body = request(asgi, "GET", "/status", query=f"key={KEY}")
+    assert status == 200
+    assert json.loads(body)["screenshot_count"] == before + 1
+
+
+def test_native_upload_over_budget(server, asgi, monkeypatch):
+    monkeypatch.setattr(server.screenshot_store_for("default"), "max_bytes", 16)
+    status, _ = request(asgi, "POST", "/upload_screenshot", headers=[("X-Key", KEY), ("Content-Length", "64")],
+                        body=b"x" * 64)
+    assert status == 413
+    status, _ = request(asgi, "POST", "/upload_screenshot", headers=[("X-Key", KEY)], body=b"x" * 64)
+    assert status == 413
+
+
+def test_wsgi_body_limit_and_malformed_length(server, asgi, monkeypatch):
+    monkeypatch.setattr(server, "MAX_REQUEST_SIZE", 32)
+    form = [("Content-Type", "application/x-www-form-urlencoded")]
+    body = f"key={KEY}&pad={'x' * 64}".encode()
+    status, _ = request(asgi, "POST", "/clear_queue", headers=[*form, ("Content-Length", str(len(body)))], body=body)
+    assert status == 413
+    status, _ = request(asgi, "POST", "/clear_queue", headers=[*form, ("Content-Length", "12abc")], body=b"key=x")
+    assert status == 400
+
+
+def test_stream_timeout_and_stale_cursor(server, asgi):
+    status, _ = request(asgi, "GET", "/commands/stream", query=f"key={KEY}&mode=poll&timeout=nan")
+    assert status == 400
+
+    ahead = server.state.subscribe_snapshot("default")["last_event_id"] + 1000
+    server.state.request_capture("default")
+    status, body = request(asgi, "GET", "/commands/stream", query=f"key={KEY}&mode=poll&since={ahead}")
+    assert status == 200
+    reply = json.loads(body)
+    assert [event["type"] for event in reply["events"]] == ["capture_screenshot"]
+    assert reply["last_id"] < ahead
+
+
+def test_status_rejects_non_finite_timeout(server, asgi):
+    version = server.state.version("default")
+    status, _ = request(asgi, "GET", "/status", query=f"key={KEY}&since={version}&timeout=nan")
+    assert status == 400
+
+
+def test_native_gzip_upload(server, asgi):
+    image = b"\x89PNG native " * 512
+    status, _ = request(asgi, "POST", "/upload_screenshot", headers=[("X-Key", KEY), ("Content-Encoding", "gzip")],
+                        body=gzip.compress(image))
+    assert status == 200
+    store = server.screenshot_store_for("default")
+    assert store.read(store.recent(1)[0]["id"]) == image
+
+    status, _ = request(asgi, "POST", "/upload_screenshot", headers=[("X-Key", KEY), ("Content-Encoding", "gzip")],
+                        body=b"not gzip")
+    assert status == 400
@@ -0,0 +1,121 @@
+import asyncio
+import gzip
+import json
+
+import pytest
+
+from auth import ALL_CLIENTS, TokenTable, load_client_tokens, request_token
+from conftest import KEY
+
+
+def test_load_client_tokens(tmp_path):
+    assert load_client_tokens("") == {}
+    assert load_client_tokens("laptop=s3cret, desk=0ther") == {"laptop": "s3cret", "desk": "0ther"}
+    path = tmp_path / "tokens.json"
+    path.write_text(json.dumps({"laptop": "s3cret"}))
+    assert load_client_tokens(str(path)) == {"laptop": "s3cret"}
+
+
+@pytest.mark.parametrize("spec", ["laptop", "=token", "laptop=", "*=token", "..=token", "a/b=token", "-x=token"])
+def test_load_client_tokens_rejects_bad_entries(spec):
+    with pytest.raises(ValueError):
+        load_client_tokens(spec)
+
+
+def test_load_client_tokens_rejects_bad_ids_in_files(tmp_path):
+    path = tmp_path / "tokens.json"
+    path.write_text(json.dumps({"*": "token"}))
+    with pytest.raises(ValueError):
+        load_client_tokens(str(path))
+
+
+def test_token_table():
+    tokens = TokenTable("shared", {"alice": "alice-token"})
+    assert tokens.authenticate("shared") == ALL_CLIENTS
+    assert tokens.authenticate("alice-token") == "alice"
+    assert tokens.authenticate("wrong") is None
+    assert tokens.authenticate(None) is None
+    with pytest.raises(ValueError):
+        TokenTable("shared", {"alice": "shared"})
+    with pytest.raises(ValueError):
+        TokenTable("shared", {"alice": "same", "bob": "same"})
+
+
+def test_request_token_precedence():
+    assert request_token("Bearer header", "x-key", "query") == "header"
+    assert request_token("Basic abc", "x-key", "query") == "x-key"
+    assert request_token(None, None, "query") == "query"
+    assert request_token() is None
+
+
+@pytest.fixture
+def alice(server):
+    server.state.register_client("alice")
+    return {"X-Key": "alice-token"}
+
+
+def test_missing_or_wrong_key(client):
+    assert client.get("/status").status_code == 403
+    assert client.get("/status", headers={"X-Key": "wrong"}).status_code == 403
+    assert client.get("/status?key=wrong").status_code == 403
+    assert client.get("/status", headers={"Authorization": f"Bearer {KEY}"}).status_code == 200
+
+
+def test_client_token_is_scoped_to_its_client(client, alice):
+    assert client.get("/status", headers=alice).status_code == 200
+    assert client.get("/status?client_id=alice", headers=alice).status_code == 200
+    assert client.get("/status?client_id=default", headers=alice).status_code == 403
+    assert client.get("/clients", headers=alice).status_code == 403  # admin route
+
+
+def test_key_in_body_is_only_read_from_small_bodies(server, client):
+    assert client.post("/clear_queue", data={"key": KEY}).status_code == 200
+    large = {"key": KEY, "padding": "x" * server.AUTH_BODY_KEY_MAX_SIZE}
+    assert client.post("/clear_queue", data=large).status_code == 403
+
+
+def test_key_in_a_gzip_form_body(client):
+    response = client.post("/clear_queue", data=gzip.compress(f"key={KEY}".encode()),
+                           headers={"Content-Encoding": "gzip"}, content_type="application/x-www-form-urlencoded")
+    assert response.status_code == 200
+
+
+def test_asgi_refuses_a_bad_key_before_reading_the_body(server):
+    import asgi
+    bodies_read = []
+
+    async def post(path, body, **headers):
+        scope = {
+            "type": "http", "method": "POST", "path": path, "query_string": b"",
+            "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+        }
+
+        async def receive():
+            bodies_read.append(path)
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        try:
+            await asgi.call_wsgi(asgi.AsyncRequest(scope, receive), send)
+        except asgi.HTTPError as e:
+            return e.status
+        return sent[0]["status"]
+
+    raw = {"Content-Type": "application/octet-stream"}
+    assert asyncio.run(post("/clear_queue", b"x" * 1024, **raw, **{"X-Key": "wrong"})) == 403
+    assert asyncio.run(post("/clear_queue", b"x" * 1024, **raw)) == 403
+    assert asyncio.run(post("/clients/register", b"x" * 1024, **raw, **{"X-Key": "alice-token"})) == 403
+    assert bodies_read == []
+    # Small form and JSON bodies, gzip ones too, may still carry the key
+    form = b"key=" + KEY.encode()
+    assert asyncio.run(post("/clear_queue", form, **{"Content-Type": "application/x-www-form-urlencoded",
+                                                      "Content-Length": str(len(form))})) == 200
+    zipped = gzip.compress(form)
+    assert asyncio.run(post("/clear_queue", zipped, **{"Content-Type": "application/x-www-form-urlencoded",
+                                                        "Content-Encoding": "gzip",
+                                                        "Content-Length": str(len(zipped))})) == 200
+    assert bodies_read == ["/clear_queue", "/clear_queue"]
@@ -0,0 +1,38 @@
+import json
+import subprocess
+import sys
+
+from conftest import ROOT
+
+import bench
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert bench.percentile(values, 0.50) == 50
+    assert bench.percentile(values, 0.99) == 99
+    assert bench.percentile([7], 0.99) == 7
+    assert bench.percentile([], 0.5) is None
+
+
+def result(throughput, p99):
+    return {"targets": {"flask": {"scenarios": {"poll": {"throughput_rps": throughput, "p99_ms": p99}}}}}
+
+
+def test_compare_reports_regressions_beyond_the_tolerance():
+    assert bench.compare(result(90, 11), result(100, 10), 0.2) == []
+    regressions = bench.compare(result(70, 13), result(100, 10), 0.2)
+    assert [message.split(":")[0] for message in regressions] == ["flask/poll", "flask/poll"]
+    assert bench.compare(result(70, 13), {"targets": {}}, 0.2) == []
+
+
+def test_smoke_run(tmp_path):
+    output = tmp_path / "results.json"
+    subprocess.run(
+        [sys.executable, "bench.py", "--scenarios", "poll,submit", "--clients", "2", "--duration", "0.2",
+         "--warmup", "0", "--output", str(output)],
+        cwd=ROOT, check=True, capture_output=True, timeout=60,
+    )
+    scenarios = json.loads(output.read_text())["targets"]["flask"]["scenarios"]
+    assert set(scenarios) == {"poll", "submit"}
+    assert all(scenario["requests"] > 0 and scenario["errors"] == 0 for scenario in scenarios.values())
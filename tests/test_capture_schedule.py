@@ -0,0 +1,151 @@
+import time
+import uuid
+
+import pytest
+
+from capture_schedule import capture_id, due_captures, schedule_summary
+from conftest import KEY
+from test_state_backends import make_backend
+
+
+@pytest.fixture
+def client_id(client):
+    client_id = f"capture-{uuid.uuid4().hex[:8]}"
+    client.post("/clients/register", data={"key": KEY, "client_id": client_id})
+    return client_id
+
+
+def parse(server, **options):
+    return server.parse_capture_schedule({name: str(value) for name, value in options.items()})
+
+
+def test_parse_defaults_and_duration(server):
+    assert parse(server)[:2] == (1, 0.0)
+    assert parse(server, interval=2)[:2] == (None, 2.0)
+    assert parse(server, interval=2, duration=10)[:2] == (6, 2.0)
+    assert parse(server, interval=2, duration=10, count=3)[:2] == (3, 2.0)
+    assert parse(server, delay=60)[2] == pytest.approx(time.time() + 60, abs=5)
+
+
+@pytest.mark.parametrize("options, limit", [
+    ({"interval": 1, "duration": 3600}, "CAPTURE_MAX_COUNT"),
+    ({"count": 0}, "CAPTURE_MAX_COUNT"),
+    ({"count": 100000}, "CAPTURE_MAX_COUNT"),
+    ({"interval": 0.01}, "CAPTURE_MIN_INTERVAL"),
+    ({"interval": 10 ** 9}, "CAPTURE_MAX_DURATION"),
+    ({"delay": 10 ** 9}, "CAPTURE_MAX_DURATION"),
+    ({"interval": 1, "duration": 10 ** 9}, "CAPTURE_MAX_DURATION"),
+])
+def test_parse_names_the_limit_hit(server, options, limit):
+    with pytest.raises(ValueError, match=limit):
+        parse(server, **options)
+
+
+@pytest.mark.parametrize("options", [{"interval": "nan"}, {"delay": -1}, {"duration": 5}, {"count": "x"}])
+def test_parse_rejects_malformed_values(server, options):
+    with pytest.raises(ValueError):
+        parse(server, **options)
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_until_stopped_schedules_settle_old_captures(kind, tmp_path, monkeypatch):
+    backend = make_backend(kind, tmp_path)
+    backend.register_client("c")
+    now = time.time()
+    schedule = backend.add_capture_schedule("c", count=None, interval=1.0, start=now - 100)
+    assert not backend.fulfil_capture("c", schedule["id"], 10, 1.0)  # dropped already
+    assert backend.fulfil_capture("c", schedule["id"], 75, 0.5)
+    assert backend.fulfil_capture("c", schedule["id"], 99, 1.5)
+
+    now += 60
+    monkeypatch.setattr("state_backend.time.time", lambda: now)
+    assert backend.fulfil_capture("c", schedule["id"], 140, 1.0)
+    stored = backend.capture_schedules("c")[0]
+    assert list(stored["fulfilled"]) == [140]
+    assert stored["settled"] == {"before": 131, "fulfilled": 2, "latency_sum": 2.0, "latency_max": 1.5}
+    assert not backend.fulfil_capture("c", schedule["id"], 99, 1.0)
+
+    summary = schedule_summary(stored, now)
+    assert summary["fulfilled"] == 3
+    assert summary["latency_max"] == 1.5
+    assert summary["latency_avg"] == pytest.approx(1.0)
+    assert summary["fulfilled"] + summary["dropped"] + summary["pending"] == 161
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_bounded_schedules_keep_every_capture(kind, tmp_path):
+    backend = make_backend(kind, tmp_path)
+    backend.register_client("c")
+    schedule = backend.add_capture_schedule("c", count=3, interval=1.0, start=time.time() - 100)
+    assert backend.fulfil_capture("c", schedule["id"], 0, 0.5)
+    assert not backend.fulfil_capture("c", schedule["id"], 0, 0.5)
+    assert not backend.fulfil_capture("c", schedule["id"], 3, 0.5)
+    stored = backend.capture_schedules("c")[0]
+    assert stored["fulfilled"] == {0: 0.5}
+    assert stored["settled"]["before"] == 0
+
+
+def test_settled_captures_survive_a_restart(tmp_path, monkeypatch):
+    backend = make_backend("memory", tmp_path, journal_dir=str(tmp_path))
+    backend.register_client("c")
+    now = time.time()
+    schedule = backend.add_capture_schedule("c", count=None, interval=1.0, start=now - 100)
+    assert backend.fulfil_capture("c", schedule["id"], 80, 1.0)
+    monkeypatch.setattr("state_backend.time.time", lambda: now + 60)
+    assert backend.fulfil_capture("c", schedule["id"], 140, 2.0)
+    expected = backend.capture_schedules("c")
+    assert expected[0]["settled"]["fulfilled"] == 1
+    backend._journal.close()
+
+    restarted = make_backend("memory", tmp_path, journal_dir=str(tmp_path))
+    assert restarted.capture_schedules("c") == expected
+    restarted._journal.close()
+
+
+def test_due_captures_skip_fulfilled_and_overdue():
+    now = 1000.0
+    schedule = {"id": 1, "start": now - 60, "interval": 1.0, "count": None, "ends_at": None, "stopped": False,
+                "fulfilled": {30: 0.1}, "settled": {"before": 0, "fulfilled": 0, "latency_sum": 0.0,
+                                                    "latency_max": None}}
+    ids = [capture["id"] for capture in due_captures(schedule, now)]
+    assert ids[0] == capture_id(1, 31)
+    assert capture_id(1, 30) not in ids
+
+
+def test_request_and_fulfil_a_schedule(client, client_id):
+    response = client.post("/request_screenshot", data={"key": KEY, "client_id": client_id, "count": 2,
+                                                        "interval": 1})
+    assert response.status_code == 200
+    schedule = response.get_json()["schedules"][client_id]
+    assert schedule["count"] == 2
+
+    captures = client.get("/check_screenshot_command",
+                          query_string={"key": KEY, "client_id": client_id}).get_json()["captures"]
+    assert captures and captures[0]["id"] == capture_id(schedule["id"], 0)
+
+    upload = client.post("/upload_screenshot", query_string={"key": KEY, "client_id": client_id},
+                         data=b"\x89PNG scheduled", content_type="application/octet-stream",
+                         headers={"X-Capture-Id": captures[0]["id"]})
+    assert upload.status_code == 200
+    summaries = client.get("/screenshot_schedules",
+                           query_string={"key": KEY, "client_id": client_id}).get_json()["schedules"]
+    assert summaries[0]["fulfilled"] == 1
+
+
+def test_request_reports_the_limit_hit(client, client_id):
+    response = client.post("/request_screenshot", data={"key": KEY, "client_id": client_id,
+                                                        "interval": 1, "duration": 3600})
+    assert response.status_code == 400
+    assert "CAPTURE_MAX_COUNT" in response.get_data(as_text=True)
+
+
+def test_stop_schedule(client, client_id):
+    client.post("/request_screenshot", data={"key": KEY, "client_id": client_id, "interval": 1})
+    response = client.post("/stop_screenshot_schedule", data={"key": KEY, "client_id": client_id})
+    assert response.status_code == 200
+    assert len(response.get_json()["stopped"][client_id]) == 1
+    captures = client.get("/check_screenshot_command",
+                          query_string={"key": KEY, "client_id": client_id}).get_json()["captures"]
+    assert all(capture["id"] == capture_id(1, 0) for capture in captures)  # due when it was stopped
+    assert client.post("/stop_screenshot_schedule",
+                       data={"key": KEY, "client_id": client_id, "schedule_id": "x"}).status_code == 400
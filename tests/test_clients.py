@@ -0,0 +1,52 @@
+import uuid
+
+import pytest
+
+from conftest import KEY
+
+
+def register(client, name=None):
+    client_id = f"client-{uuid.uuid4().hex[:8]}"
+    response = client.post("/clients/register", data={"key": KEY, "client_id": client_id, "name": name or client_id})
+    assert response.status_code == 200
+    return client_id
+
+
+def test_register_and_list(client):
+    client_id = register(client, name="Laptop")
+    listed = client.get(f"/clients?key={KEY}").get_json()["clients"]
+    entry = next(info for info in listed if info["client_id"] == client_id)
+    assert entry["name"] == "Laptop"
+    assert entry["queue_size"] == 0
+
+
+def test_queues_are_per_client(client):
+    first, second = register(client), register(client)
+    assert client.post("/submit", json={"items": ["for first"], "client_id": first}).status_code == 200
+
+    assert client.get(f"/latest?key={KEY}&client_id={first}").data == b"for first"
+    assert client.get(f"/latest?key={KEY}", headers={"X-Client-Id": second}).status_code == 404
+
+
+def test_broadcast_reaches_listed_clients(client):
+    first, second, other = register(client), register(client), register(client)
+    response = client.post("/submit", json={"items": ["hello"], "clients": [first, second]})
+    assert response.status_code == 200
+
+    for client_id in (first, second):
+        assert client.get(f"/latest?key={KEY}&client_id={client_id}").data == b"hello"
+    assert client.get(f"/latest?key={KEY}&client_id={other}").status_code == 404
+
+
+def test_unknown_client_is_404(client):
+    assert client.get(f"/status?key={KEY}&client_id=never-registered").status_code == 404
+
+
+@pytest.mark.parametrize("client_id", [".", "..", ".hidden", "-x", "a/b", "x" * 65])
+def test_invalid_client_id(client, client_id):
+    response = client.get("/status", query_string={"key": KEY, "client_id": client_id})
+    assert response.status_code == 400
+
+
+def test_non_string_client_id_in_json(client):
+    assert client.post("/submit", json={"items": ["a"], "client_id": 5}).status_code == 400
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from conftest import KEY
+
+
+def poll(client, query=""):
+    response = client.get(f"/commands/stream?key={KEY}&mode=poll&timeout=1{query}")
+    assert response.status_code == 200
+    return response.get_json()
+
+
+@pytest.fixture(autouse=True)
+def no_kill_switch(client):
+    client.post("/deactivate_kill_switch", data={"key": KEY})
+    yield
+    client.post("/deactivate_kill_switch", data={"key": KEY})
+
+
+def test_requires_key(client):
+    assert client.get("/commands/stream?mode=poll").status_code == 403
+    assert client.get("/commands/stream?mode=poll&key=wrong").status_code == 403
+
+
+def test_fresh_subscriber_gets_a_snapshot(client):
+    client.post("/activate_kill_switch", data={"key": KEY})
+    body = poll(client)
+    assert {"id": body["last_id"], "type": "kill_switch", "data": {"active": True}} in body["events"]
+
+
+def test_long_poll_resumes_from_last_id(client):
+    last_id = poll(client)["last_id"]
+    client.post("/activate_kill_switch", data={"key": KEY})
+    body = poll(client, f"&since={last_id}")
+    assert [(event["type"], event["data"]) for event in body["events"]] == [("kill_switch", {"active": True})]
+    assert body["last_id"] == body["events"][-1]["id"] > last_id
+    assert poll(client, f"&since={body['last_id']}") == {"events": [], "last_id": body["last_id"]}
+
+
+def test_capture_request_is_delivered_once(client):
+    last_id = poll(client)["last_id"]
+    client.post("/request_screenshot", data={"key": KEY})
+    events = poll(client, f"&since={last_id}")["events"]
+    assert [event["type"] for event in events] == ["capture_screenshot"]
+    # Delivered over the stream, so the legacy flag is already cleared
+    assert client.get(f"/check_screenshot_command?key={KEY}").get_json()["capture_requested"] is False
+
+
+def test_cursor_ahead_of_the_log_gets_a_snapshot(client):
+    # e.g. an id from before a restart
+    client.post("/activate_kill_switch", data={"key": KEY})
+    last_id = poll(client)["last_id"]
+    body = poll(client, f"&since={last_id + 1000}")
+    assert body["last_id"] == last_id
+    assert "kill_switch" in [event["type"] for event in body["events"]]
+
+
+@pytest.mark.parametrize("timeout", ["abc", "nan", ""])
+def test_invalid_timeout(client, timeout):
+    response = client.get(f"/commands/stream?key={KEY}&mode=poll&timeout={timeout}")
+    assert response.status_code == 400
+
+
+def test_timeout_is_at_least_one_second(client):
+    last_id = poll(client)["last_id"]
+    response = client.get(f"/commands/stream?key={KEY}&mode=poll&timeout=-5&since={last_id}")
+    assert response.get_json() == {"events": [], "last_id": last_id}
+
+
+def test_server_sent_events(client):
+    client.post("/activate_kill_switch", data={"key": KEY})
+    response = client.get(f"/commands/stream?key={KEY}&timeout=1", buffered=False)
+    assert response.mimetype == "text/event-stream"
+    chunks = iter(response.response)
+    first = next(chunks)
+    response.close()
+    text = first.decode() if isinstance(first, bytes) else first
+    fields = dict(line.split(": ", 1) for line in text.splitlines() if line)
+    assert fields["event"] == "kill_switch"
+    assert json.loads(fields["data"]) == {"active": True}
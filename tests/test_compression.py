@@ -0,0 +1,104 @@
+import gzip
+import json
+import zlib
+
+import pytest
+
+from compression import BodyDecoder, DecodedBodyTooLarge, choose_encoding, compress, compress_stream
+from conftest import KEY
+
+TEXT = b"compressible text " * 512
+
+
+def test_choose_encoding():
+    assert choose_encoding("gzip, br;q=0.5", ["zstd", "br", "gzip"]) == "gzip"
+    assert choose_encoding("identity", ["gzip"]) is None
+    assert choose_encoding(None, ["gzip"]) is None
+    assert choose_encoding("gzip", []) is None
+
+
+def test_compress_and_stream_round_trip():
+    assert gzip.decompress(compress(TEXT, "gzip")) == TEXT
+    assert gzip.decompress(b"".join(compress_stream(iter([TEXT[:100], TEXT[100:]]), "gzip"))) == TEXT
+
+
+def test_body_decoder_is_bounded():
+    decoder = BodyDecoder(max_size=len(TEXT))
+    data = gzip.compress(TEXT)
+    decoded = decoder.decode(data)
+    while decoder.pending:
+        decoded += decoder.decode(b"")
+    assert decoded + decoder.finish() == TEXT
+
+    with pytest.raises(DecodedBodyTooLarge):
+        decoder = BodyDecoder(max_size=100)
+        decoder.decode(data)
+
+
+def test_json_response_is_compressed(server, client, monkeypatch):
+    monkeypatch.setattr(server, "COMPRESS_ENCODINGS", ["gzip"])
+    monkeypatch.setattr(server, "COMPRESS_MIN_SIZE", 0)
+    response = client.get(f"/status?key={KEY}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert json.loads(gzip.decompress(response.data))["version"]
+    assert response.headers["ETag"].startswith("W/")
+
+
+def test_gzip_form_body_gets_its_decoded_length(server, client):
+    server.state.clear_queue("default")
+    server.state.unlock("default")
+    body = gzip.compress(f"key={KEY}&content=zipped".encode())
+    response = client.post("/submit", data=body, headers={"Content-Encoding": "gzip"},
+                           content_type="application/x-www-form-urlencoded")
+    assert response.status_code == 302
+    assert server.state.head("default")["content"] == "zipped"
+    server.state.clear_queue("default")
+
+
+def test_gzip_json_body(server, client):
+    server.state.clear_queue("default")
+    server.state.unlock("default")
+    body = gzip.compress(json.dumps({"key": KEY, "items": ["a"]}).encode())
+    response = client.post(f"/submit?key={KEY}", data=body, headers={"Content-Encoding": "gzip"},
+                           content_type="application/json")
+    assert response.status_code == 200
+    assert server.state.head("default")["content"] == "a"
+    server.state.clear_queue("default")
+
+
+def test_gzip_raw_upload(server, client):
+    image = b"\x89PNG " + TEXT
+    response = client.post(f"/upload_screenshot?key={KEY}", data=gzip.compress(image),
+                           headers={"Content-Encoding": "gzip"}, content_type="application/octet-stream")
+    assert response.status_code == 200
+    stored = client.get(f"/screenshots/{response.headers['X-Screenshot-Id']}?key={KEY}")
+    assert stored.data == image
+
+
+@pytest.mark.parametrize("headers, body, status", [
+    ({"Content-Encoding": "gzip"}, b"not gzip", 400),
+    ({"Content-Encoding": "gzip"}, zlib.compress(b"zlib, not gzip"), 400),
+    ({"Content-Encoding": "compress"}, b"whatever", 415),
+])
+def test_bad_encodings(client, headers, body, status):
+    for content_type in ("application/octet-stream", "application/json"):
+        response = client.post(f"/upload_screenshot?key={KEY}", data=body, headers=headers,
+                               content_type=content_type)
+        assert response.status_code == status
+
+
+def test_decoded_body_over_the_limit_is_413(server, client, monkeypatch):
+    monkeypatch.setattr(server.app.wsgi_app, "max_size", 1000)
+    response = client.post(f"/upload_screenshot?key={KEY}", data=gzip.compress(b"\x00" * 100000),
+                           headers={"Content-Encoding": "gzip"}, content_type="application/octet-stream")
+    assert response.status_code == 413
+
+
+def test_malformed_content_length_is_400(server):
+    environ = {"REQUEST_METHOD": "POST", "PATH_INFO": "/submit", "CONTENT_LENGTH": "12abc",
+               "wsgi.input": None, "SERVER_NAME": "test", "SERVER_PORT": "80", "wsgi.url_scheme": "http"}
+    statuses = []
+    b"".join(server.app.wsgi_app(environ, lambda status, headers: statuses.append(status)))
+    assert statuses == ["400 BAD REQUEST"]
+
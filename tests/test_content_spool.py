@@ -0,0 +1,98 @@
+import pytest
+
+from conftest import KEY
+from content_spool import ContentSpool, InvalidContent, describe
+
+TEXT = "héllo wörld\n" * 400  # 5600 bytes of UTF-8, 4800 characters
+DATA = TEXT.encode("utf-8")
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return ContentSpool(str(tmp_path), threshold=1024)
+
+
+def test_small_text_stays_inline(spool):
+    assert spool.put_text("short") == "short"
+    assert spool.put_stream([b"sh", b"ort"]) == "short"
+    assert spool.path("short") is None
+
+
+def test_large_stream_is_spooled(spool):
+    # Chunks split multi-byte characters
+    content = spool.put_stream(DATA[n:n + 333] for n in range(0, len(DATA), 333))
+    info = describe(content)
+    assert info["spooled"]
+    assert info["size"] == len(DATA)
+    assert TEXT.startswith(info["preview"])
+    with open(spool.path(content), "rb") as f:
+        assert f.read() == DATA
+
+    copy = spool.copy(content)
+    spool.delete(content)
+    with open(spool.path(copy), "rb") as f:
+        assert f.read() == DATA
+
+
+def test_invalid_utf8_leaves_no_file(spool, tmp_path):
+    with pytest.raises(InvalidContent):
+        spool.put_stream([DATA, b"\xff"])
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.fixture
+def queued(server, client):
+    """A spooled item at the head of its own client's queue."""
+    server.state.register_client("spool-test")
+    server.state.clear_queue("spool-test")
+    server.state.unlock("spool-test")
+    response = client.post(f"/submit?key={KEY}&client_id=spool-test", data=DATA, content_type="text/plain")
+    assert response.status_code == 302
+    item = server.state.head("spool-test")
+    assert describe(item["content"])["spooled"]
+    yield item
+    server.state.clear_queue("spool-test")
+
+
+def get_latest(client, query="", **headers):
+    return client.get(f"/latest?key={KEY}&client_id=spool-test{query}", headers=headers)
+
+
+def test_full_content(client, queued):
+    response = get_latest(client)
+    assert response.status_code == 200
+    assert response.data == DATA
+    assert response.headers["X-Content-Size"] == str(len(DATA))
+    assert response.headers["X-Item-Id"] == str(queued["id"])
+
+
+def test_range_request(client, queued):
+    response = get_latest(client, Range="bytes=100-199")
+    assert response.status_code == 206
+    assert response.data == DATA[100:200]
+    assert response.headers["Content-Range"] == f"bytes 100-199/{len(DATA)}"
+
+    response = get_latest(client, Range="bytes=-10")
+    assert response.data == DATA[-10:]
+
+    response = get_latest(client, Range=f"bytes={len(DATA)}-")
+    assert response.status_code == 416
+
+
+def test_offset_and_length(client, queued):
+    response = get_latest(client, "&offset=5000&length=100")
+    assert response.status_code == 200
+    assert response.data == DATA[5000:5100]
+    assert response.headers["X-Content-Offset"] == "5000"
+
+    response = get_latest(client, "&offset=5500")
+    assert response.data == DATA[5500:]
+
+    response = get_latest(client, f"&offset={len(DATA) + 10}&length=5")
+    assert response.data == b""
+    assert response.headers["X-Content-Offset"] == str(len(DATA))
+
+
+@pytest.mark.parametrize("query", ["&offset=-1", "&offset=abc", "&length=-5", "&length=x"])
+def test_invalid_offset_or_length(client, queued, query):
+    assert get_latest(client, query).status_code == 400
@@ -0,0 +1,30 @@
+import re
+
+from conftest import KEY
+
+
+def test_index_references_versioned_script(server, client):
+    page = client.get("/").get_data(as_text=True)
+    assert server.DASHBOARD_JS_URL in page
+    assert re.search(r"/static/dashboard\.js\?v=[0-9a-f]{12}", server.DASHBOARD_JS_URL)
+
+
+def test_versioned_script_is_immutable(server, client):
+    response = client.get(server.DASHBOARD_JS_URL)
+    assert response.status_code == 200
+    assert "immutable" in response.headers["Cache-Control"]
+    assert f"max-age={server.DASHBOARD_ASSET_MAX_AGE}" in response.headers["Cache-Control"]
+    response.close()
+
+
+def test_dashboard_state(client):
+    assert client.get("/dashboard/state").status_code == 403
+    client.post("/upload_screenshot", query_string={"key": KEY}, data=b"\x89PNG dashboard",
+                content_type="application/octet-stream")
+
+    response = client.get(f"/dashboard/state?key={KEY}")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-cache"
+    state = response.get_json()
+    assert {"locked", "queue_size", "kill_switch", "screenshots", "recent_items"} <= set(state)
+    assert state["screenshots"][-1]["id"]
@@ -0,0 +1,120 @@
+import hashlib
+import io
+import uuid
+
+import pytest
+
+from conftest import KEY
+from screenshot_store import create_screenshot_store
+
+
+@pytest.fixture
+def client_id(client):
+    client_id = f"dedup-{uuid.uuid4().hex[:8]}"
+    client.post("/clients/register", data={"key": KEY, "client_id": client_id})
+    return client_id
+
+
+def upload(client, client_id, data, headers=None):
+    return client.post("/upload_screenshot", query_string={"key": KEY, "client_id": client_id}, data=data,
+                       content_type="application/octet-stream", headers=headers or {})
+
+
+def png(size=(32, 32), color=(0, 0, 0), tile=None):
+    Image = pytest.importorskip("PIL.Image")
+    image = Image.new("RGB", size, color)
+    if tile is not None:
+        x, y, tile_image = tile
+        image.paste(tile_image, (x, y))
+    out = io.BytesIO()
+    image.save(out, format="PNG")
+    return out.getvalue()
+
+
+@pytest.mark.parametrize("backend", ["memory", "disk"])
+def test_identical_images_share_one_blob(backend, tmp_path):
+    store = create_screenshot_store(backend, root=str(tmp_path))
+    first = store.add([b"same bytes"], "t1")
+    second = store.add([b"same ", b"bytes"], "t2")
+    assert second["blob"] == first["blob"]
+    assert store.total_bytes == len(b"same bytes")
+
+    store.remove(first["id"])
+    assert store.read(second["id"]) == b"same bytes"
+    store.remove(second["id"])
+    assert store.total_bytes == 0
+    assert store.open_by_hash(first["sha256"]) is None
+
+
+def test_dedup_survives_a_reload(tmp_path):
+    store = create_screenshot_store("disk", root=str(tmp_path))
+    first = store.add([b"shared"], "t1")
+    store.add([b"shared"], "t2")
+
+    reloaded = create_screenshot_store("disk", root=str(tmp_path))
+    assert reloaded.total_bytes == len(b"shared")
+    assert reloaded.add_existing(first["sha256"], "t3")["blob"] == first["blob"]
+
+
+def test_upload_reports_id_and_hash(client, client_id):
+    response = upload(client, client_id, b"\x89PNG hashed")
+    assert response.status_code == 200
+    assert response.headers["X-Content-SHA256"] == hashlib.sha256(b"\x89PNG hashed").hexdigest()
+    assert int(response.headers["X-Screenshot-Id"]) > 0
+
+
+def test_known_hash_is_recorded_without_a_body(client, client_id):
+    image = b"\x89PNG known"
+    digest = upload(client, client_id, image).headers["X-Content-SHA256"]
+
+    response = upload(client, client_id, b"", headers={"X-Content-SHA256": digest.upper()})
+    assert response.status_code == 200
+    assert response.headers["X-Content-SHA256"] == digest
+    second = client.get(f"/screenshots/{response.headers['X-Screenshot-Id']}",
+                        query_string={"key": KEY, "client_id": client_id})
+    assert second.data == image
+
+
+def test_unknown_hash_without_a_body_is_404(client, client_id):
+    response = upload(client, client_id, b"", headers={"X-Content-SHA256": "0" * 64})
+    assert response.status_code == 404
+
+
+def test_unknown_hash_with_a_body_is_stored(client, client_id):
+    response = upload(client, client_id, b"\x89PNG fresh", headers={"X-Content-SHA256": "0" * 64})
+    assert response.status_code == 200
+    assert response.headers["X-Content-SHA256"] == hashlib.sha256(b"\x89PNG fresh").hexdigest()
+
+
+def delta(client, client_id, base, tiles):
+    data = {"key": KEY, "base": base}
+    for name, image in tiles.items():
+        data[name] = (io.BytesIO(image), f"{name}.png")
+    return client.post("/upload_screenshot/delta", query_string={"client_id": client_id}, data=data,
+                       content_type="multipart/form-data")
+
+
+def test_delta_upload_composes_onto_the_base(client, client_id):
+    Image = pytest.importorskip("PIL.Image")
+    base = upload(client, client_id, png()).headers["X-Content-SHA256"]
+    tile = Image.new("RGB", (8, 8), (255, 255, 255))
+
+    response = delta(client, client_id, base, {"tile-8-16": png((8, 8), (255, 255, 255))})
+    assert response.status_code == 200
+    assert response.headers["X-Content-SHA256"] != base
+    stored = client.get(f"/screenshots/{response.headers['X-Screenshot-Id']}",
+                        query_string={"key": KEY, "client_id": client_id})
+    with Image.open(io.BytesIO(stored.data)) as composite:
+        expected = Image.open(io.BytesIO(png(tile=(8, 16, tile))))
+        assert composite.convert("RGB").tobytes() == expected.tobytes()
+
+
+def test_delta_against_an_unknown_base_is_409(client, client_id):
+    response = delta(client, client_id, "0" * 64, {"tile-0-0": png((8, 8))})
+    assert response.status_code == 409
+
+
+def test_delta_with_bad_tiles_is_400(client, client_id):
+    base = upload(client, client_id, png()).headers["X-Content-SHA256"]
+    assert delta(client, client_id, base, {"tile-0-0": b"not an image"}).status_code == 400
+    assert delta(client, client_id, base, {"tile-a-0": png((8, 8))}).status_code == 400
@@ -0,0 +1,78 @@
+import io
+import json
+import tarfile
+import uuid
+import zipfile
+
+import pytest
+
+from conftest import KEY
+from export_archive import stream_archive
+
+FILES = [("a.bin", b"first file"), ("b.bin", b"x" * 200000), ("empty.bin", b"")]
+
+
+def members():
+    return ((name, len(data), 1700000000.0, io.BytesIO(data)) for name, data in FILES)
+
+
+def test_tar_stream():
+    data = b"".join(stream_archive("tar", members()))
+    with tarfile.open(fileobj=io.BytesIO(data)) as archive:
+        assert [(member.name, archive.extractfile(member).read()) for member in archive] == FILES
+
+
+def test_zip_stream():
+    data = b"".join(stream_archive("zip", members()))
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        assert [(name, archive.read(name)) for name in archive.namelist()] == FILES
+        assert archive.testzip() is None
+
+
+def test_members_are_closed():
+    files = [io.BytesIO(b"data") for _ in range(2)]
+    b"".join(stream_archive("zip", ((f"{n}.bin", 4, 0.0, f) for n, f in enumerate(files))))
+    assert all(f.closed for f in files)
+
+
+@pytest.fixture
+def client_id(client):
+    client_id = f"export-{uuid.uuid4().hex[:8]}"
+    client.post("/clients/register", data={"key": KEY, "client_id": client_id})
+    for n in range(3):
+        client.post("/upload_screenshot",
+                    query_string={"key": KEY, "client_id": client_id, "timestamp": f"2024-01-0{n + 1}T00:00:00"},
+                    data=f"\x89PNG export {n}".encode(), content_type="application/octet-stream")
+    return client_id
+
+
+def export(client, client_id, **query):
+    response = client.get("/export/screenshots", query_string={"key": KEY, "client_id": client_id, **query})
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == "no-store"
+    return response
+
+
+def test_export_tar_oldest_first(client, client_id):
+    response = export(client, client_id)
+    assert response.mimetype == "application/x-tar"
+    with tarfile.open(fileobj=io.BytesIO(response.data)) as archive:
+        contents = [archive.extractfile(member).read() for member in archive]
+    assert contents == [f"\x89PNG export {n}".encode() for n in range(3)]
+
+
+def test_export_zip_range_with_manifest(client, client_id):
+    response = export(client, client_id, format="zip", manifest=1, **{"from": "2024-01-02T00:00:00"})
+    assert f'filename="screenshots-{client_id}.zip"' in response.headers["Content-Disposition"]
+    with zipfile.ZipFile(io.BytesIO(response.data)) as archive:
+        names = archive.namelist()
+        manifest = json.loads(archive.read("manifest.json"))
+    assert names[-1] == "manifest.json"
+    assert [entry["timestamp"] for entry in manifest["screenshots"]] == ["2024-01-02T00:00:00", "2024-01-03T00:00:00"]
+    assert [entry["name"] for entry in manifest["screenshots"]] == names[:-1]
+
+
+@pytest.mark.parametrize("query", [{"format": "rar"}, {"variant": "huge"}, {"from": "someday"}])
+def test_export_rejects_bad_parameters(client, client_id, query):
+    response = client.get("/export/screenshots", query_string={"key": KEY, "client_id": client_id, **query})
+    assert response.status_code == 400
@@ -0,0 +1,97 @@
+import uuid
+
+import pytest
+
+from conftest import KEY
+from history_index import ExpiredCursor, TimeIndex, parse_timestamp
+from test_state_backends import make_backend
+
+
+def test_parse_timestamp():
+    assert parse_timestamp("1700000000.5") == 1700000000.5
+    assert parse_timestamp(12) == 12.0
+    assert parse_timestamp("2024-01-02T03:04:05+00:00") == 1704164645.0
+    assert parse_timestamp("yesterday", default=-1) == -1
+    assert parse_timestamp("nan") is None
+
+
+def test_time_index_pages_newest_first():
+    index = TimeIndex()
+    for item_id, timestamp in [(1, 10.0), (2, 30.0), (3, 20.0), (4, 30.0)]:
+        index.add(item_id, timestamp)
+    assert index.page(limit=2) == ([4, 2], True)
+    assert index.page(before=2, limit=2) == ([3, 1], False)
+    assert index.page(start=15, end=30, limit=10) == ([4, 2, 3], False)
+    assert index.page(before=4, start=25) == ([2], False)
+
+    index.add(1, 40.0)  # re-adding moves an entry
+    assert index.page(limit=1) == ([1], True)
+    index.discard(3)
+    assert len(index) == 3
+    with pytest.raises(ExpiredCursor):
+        index.page(before=3)
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_content_history(kind, tmp_path):
+    backend = make_backend(kind, tmp_path, submit_window=5)
+    backend.register_client("c")
+    items = backend.submit("c", ["one", "two", "three"])
+    backend.acknowledge("c")
+    backend.clear_queue("c")
+
+    records, more = backend.content_history("c", limit=2)
+    assert [record["id"] for record in records] == [items[2]["id"], items[1]["id"]]
+    assert more
+    assert [record["outcome"] for record in records] == ["cleared", "cleared"]
+    records, more = backend.content_history("c", before=items[1]["id"])
+    assert [(record["id"], record["outcome"], record["preview"]) for record in records] == [
+        (items[0]["id"], "acknowledged", "one"),
+    ]
+    assert not more
+    assert records[0]["finished"] >= records[0]["submitted"]
+    with pytest.raises(ExpiredCursor):
+        backend.content_history("c", before=999)
+
+
+@pytest.fixture
+def client_id(client):
+    client_id = f"history-{uuid.uuid4().hex[:8]}"
+    client.post("/clients/register", data={"key": KEY, "client_id": client_id})
+    return client_id
+
+
+def test_screenshot_listing_pages(client, client_id):
+    query = {"key": KEY, "client_id": client_id}
+    for n in range(3):
+        client.post("/upload_screenshot", query_string={**query, "timestamp": f"2024-01-0{n + 1}T00:00:00"},
+                    data=f"\x89PNG {n}".encode(), content_type="application/octet-stream")
+
+    page = client.get("/screenshots", query_string={**query, "limit": 2}).get_json()
+    assert len(page["items"]) == 2
+    assert page["items"][0]["timestamp"] == "2024-01-03T00:00:00"
+    assert "key=" not in page["items"][0]["url"]
+    older = client.get(page["next"], headers={"X-Key": KEY}).get_json()
+    assert [item["timestamp"] for item in older["items"]] == ["2024-01-01T00:00:00"]
+    assert older["next"] is None
+
+    ranged = client.get("/screenshots", query_string={**query, "from": "2024-01-02T00:00:00",
+                                                     "to": "2024-01-02T12:00:00"}).get_json()
+    assert [item["timestamp"] for item in ranged["items"]] == ["2024-01-02T00:00:00"]
+
+
+@pytest.mark.parametrize("path", ["/screenshots", "/items"])
+def test_history_errors(client, client_id, path):
+    query = {"key": KEY, "client_id": client_id}
+    for bad in ({"before": "x"}, {"limit": "x"}, {"from": "someday"}):
+        assert client.get(path, query_string={**query, **bad}).status_code == 400
+    assert client.get(path, query_string={**query, "before": 12345}).status_code == 410
+
+
+def test_items_listing_links_queued_content(client, client_id):
+    response = client.post("/submit", json={"key": KEY, "client_id": client_id, "items": ["queued text"]})
+    assert response.status_code == 200
+    items = client.get("/items", query_string={"key": KEY, "client_id": client_id}).get_json()["items"]
+    assert items[0]["outcome"] == "queued"
+    content = client.get(items[0]["content_url"], headers={"X-Key": KEY})
+    assert content.data == b"queued text"
@@ -0,0 +1,95 @@
+import io
+import threading
+
+import pytest
+
+import image_pipeline
+from conftest import KEY
+from image_pipeline import ImagePipeline, PipelineFull, compose_delta, render_variants
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def png(size=(64, 48), color=(200, 40, 40)):
+    out = io.BytesIO()
+    Image.new("RGB", size, color).save(out, format="PNG")
+    return out.getvalue()
+
+
+def fail():
+    raise ValueError("bad image")
+
+
+def test_render_variants_makes_a_thumbnail():
+    variants = render_variants(png((640, 480)), 32)
+    data, content_type = variants["thumb"]
+    assert content_type == "image/jpeg"
+    with Image.open(io.BytesIO(data)) as thumb:
+        assert max(thumb.size) == 32
+
+
+def test_compose_delta_pastes_tiles():
+    tile = png((8, 8), (255, 255, 255))
+    composite = compose_delta(png((32, 32), (0, 0, 0)), [(8, 16, tile)])
+    with Image.open(io.BytesIO(composite)) as image:
+        assert image.getpixel((8, 16)) == (255, 255, 255)
+        assert image.getpixel((0, 0)) == (0, 0, 0)
+
+
+def test_worker_processes_run_jobs():
+    pipeline = ImagePipeline(workers=1, max_pending=2)
+    try:
+        assert pipeline._pool()._mp_context.get_start_method() != "fork"
+        assert "thumb" in pipeline.run(render_variants, png(), 16)
+        with pytest.raises(OSError):
+            pipeline.run(compose_delta, b"not an image", [])
+        assert pipeline.pending == 0
+    finally:
+        pipeline.shutdown()
+
+
+def test_falls_back_inline_without_worker_processes(monkeypatch):
+    monkeypatch.setattr(image_pipeline, "_mp_context", lambda: None)
+    pipeline = ImagePipeline(workers=2)
+    assert "thumb" in pipeline.run(render_variants, png(), 16)
+    assert pipeline.workers == 0
+
+
+def test_full_pipeline_refuses_and_unused_slots_are_returned():
+    pipeline = ImagePipeline(workers=0, max_pending=1)
+    with pipeline.slot():
+        with pytest.raises(PipelineFull):
+            with pipeline.slot():
+                pass
+    assert pipeline.pending == 0
+    with pytest.raises(ValueError):
+        pipeline.run(fail)
+    assert pipeline.pending == 0
+
+
+def test_upload_gets_503_while_the_pipeline_is_full(server, client):
+    pipeline = server.image_pipeline
+    held = [threading.Event(), threading.Event()]
+    slots = []
+
+    def hold():
+        with pipeline.slot():
+            slots.append(True)
+            if len(slots) == pipeline.max_pending:
+                held[0].set()
+            held[1].wait(5)
+
+    threads = [threading.Thread(target=hold) for _ in range(pipeline.max_pending)]
+    for thread in threads:
+        thread.start()
+    try:
+        assert held[0].wait(5)
+        response = client.post(f"/upload_screenshot?key={KEY}", data=png(),
+                               content_type="application/octet-stream")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == str(server.IMAGE_RETRY_AFTER)
+    finally:
+        held[1].set()
+        for thread in threads:
+            thread.join()
+    assert pipeline.pending == 0
@@ -0,0 +1,73 @@
+import threading
+
+import pytest
+
+from journal import Journal, JournalError
+from state_backend import InProcessStateBackend
+
+
+def state_of(backend, client_ids):
+    return {
+        client_id: (backend.status(client_id), backend.next_items(client_id, 1000))
+        for client_id in client_ids
+    }
+
+
+def test_replay_after_snapshots_taken_during_writes(tmp_path):
+    client_ids = [f"client-{n}" for n in range(4)]
+    backend = InProcessStateBackend(journal_dir=str(tmp_path), snapshot_every=7, submit_window=1000)
+    for client_id in client_ids:
+        backend.register_client(client_id)
+
+    def work(client_id):
+        for n in range(60):
+            items = backend.submit(client_id, [f"{client_id} item {n}"])
+            if n % 3 == 0:
+                backend.acknowledge(client_id)
+            if n % 10 == 0:
+                backend.set_kill_switch(client_id, n % 20 == 0)
+            if n % 7 == 0:
+                backend.acknowledge(client_id, ids=[items[0]["id"]])
+            if n % 11 == 0:
+                backend.request_capture(client_id)
+
+    threads = [threading.Thread(target=work, args=(client_id,)) for client_id in client_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    expected = state_of(backend, client_ids)
+    backend._journal.close()
+
+    assert (tmp_path / "snapshot.json").exists()
+    restored = InProcessStateBackend(journal_dir=str(tmp_path), snapshot_every=7, submit_window=1000)
+    assert state_of(restored, client_ids) == expected
+    restored._journal.close()
+
+
+def test_replay_tolerates_a_torn_final_record(tmp_path):
+    backend = InProcessStateBackend(journal_dir=str(tmp_path), submit_window=10)
+    backend.register_client("c")
+    backend.submit("c", ["kept"])
+    backend._journal.close()
+    segment = sorted(tmp_path.glob("journal.*.log"))[-1]
+    with open(segment, "a", encoding="utf-8") as f:
+        f.write('{"op": "submit", "cli')
+
+    restored = InProcessStateBackend(journal_dir=str(tmp_path), submit_window=10)
+    assert [item["content"] for item in restored.next_items("c", 10)] == ["kept"]
+    restored._journal.close()
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_wait_raises_once_the_writer_fails(tmp_path):
+    def failing_snapshot():
+        raise OSError("disk full")
+
+    journal = Journal(str(tmp_path), failing_snapshot, snapshot_every=1)
+    journal.recover()
+    journal.start()
+    journal.wait(journal.append({"op": "first"}))  # written before the snapshot fails
+    with pytest.raises(JournalError):
+        journal.wait(journal.append({"op": "second"}))
+    journal.close()
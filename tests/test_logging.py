@@ -0,0 +1,44 @@
+import logging
+import queue
+
+from logging_setup import DeferredQueueHandler, RateLimitFilter
+
+
+def record(msg, *args, name="server.poll", level=logging.DEBUG):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, None)
+
+
+def test_rate_limit_filter_drops_repeats_and_counts_them(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr("logging_setup.time.monotonic", lambda: now[0])
+    limit = RateLimitFilter(60)
+
+    assert limit.filter(record("Status request from %s", "a"))
+    assert not limit.filter(record("Status request from %s", "b"))
+    assert not limit.filter(record("Status request from %s", "c"))
+    assert limit.filter(record("Other message"))
+
+    now[0] += 61
+    passed = record("Status request from %s", "d")
+    assert limit.filter(passed)
+    assert passed.getMessage() == "Status request from d (+2 similar)"
+
+
+def test_queued_records_keep_their_arguments():
+    # Formatting is left to the listener thread
+    records = queue.SimpleQueue()
+    DeferredQueueHandler(records).handle(record("Content %s", "x" * 10, name="server", level=logging.INFO))
+    queued = records.get_nowait()
+    assert queued.msg == "Content %s"
+    assert queued.args == ("x" * 10,)
+
+
+def test_invalid_key_is_not_logged(client, caplog):
+    logger = logging.getLogger("server")
+    logger.addHandler(caplog.handler)
+    try:
+        client.post("/clear_queue", data={"key": "leaked-guess"})
+    finally:
+        logger.removeHandler(caplog.handler)
+    assert "POST /clear_queue rejected: Invalid key" in caplog.text
+    assert "leaked-guess" not in caplog.text
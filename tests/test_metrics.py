@@ -0,0 +1,57 @@
+import re
+
+from conftest import KEY
+from metrics import InFlightTimer, Registry
+
+
+def sample(text, name, **labels):
+    """Return the value of one sample in an exposition, or None."""
+    rendered = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    pattern = re.escape(name + (f"{{{rendered}}}" if labels else "")) + r" (\S+)$"
+    match = re.search(pattern, text, re.M)
+    return float(match.group(1)) if match else None
+
+
+def test_registry_renders_counters_histograms_and_gauges():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ["route"])
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+    registry.gauge("depth", "Depth", lambda: [(("a\"b",), 3)], ["client"])
+    requests.inc("/x")
+    requests.inc("/x", amount=2)
+    latency.observe(0.5)
+    latency.observe(2)
+
+    text = registry.render()
+    assert "# TYPE requests_total counter" in text
+    assert sample(text, "requests_total", route="/x") == 3
+    assert sample(text, "latency_seconds_bucket", le="0.1") == 0
+    assert sample(text, "latency_seconds_bucket", le="1") == 1
+    assert sample(text, "latency_seconds_bucket", le="+Inf") == 2
+    assert sample(text, "latency_seconds_count") == 2
+    assert sample(text, "latency_seconds_sum") == 2.5
+    assert 'depth{client="a\\"b"} 3' in text
+
+
+def test_inflight_timer_forgets_the_oldest(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("metrics.time.monotonic", lambda: now[0])
+    timer = InFlightTimer(max_open=2)
+    for key in ("a", "b", "c"):
+        timer.start(key)
+        now[0] += 1
+    assert timer.finish("a") is None
+    assert timer.oldest() == {"b": 2.0, "c": 1.0}
+    assert timer.finish("b") == 2.0
+
+
+def test_metrics_endpoint(client):
+    assert client.get("/metrics").status_code == 403
+    client.get(f"/status?key={KEY}")
+
+    response = client.get(f"/metrics?key={KEY}")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert sample(response.get_data(as_text=True), "http_requests_total",
+                  method="GET", route="/status", status="200") >= 1
+    assert "content_queue_depth" in response.get_data(as_text=True)
@@ -0,0 +1,76 @@
+import uuid
+
+import pytest
+
+from conftest import KEY
+
+
+@pytest.fixture
+def client_id(server, client):
+    client_id = f"progress-{uuid.uuid4().hex[:8]}"
+    client.post("/clients/register", data={"key": KEY, "client_id": client_id})
+    return client_id
+
+
+def submit(client, client_id, *items):
+    response = client.post("/submit", json={"key": KEY, "client_id": client_id, "items": list(items)})
+    assert response.status_code == 200
+    return response.get_json()["ids"]
+
+
+def progress(client, client_id, **body):
+    return client.post("/progress", query_string={"key": KEY, "client_id": client_id}, json=body)
+
+
+def test_progress_only_moves_forward(client, client_id):
+    [item_id] = submit(client, client_id, "hello world")
+    response = progress(client, client_id, offsets={str(item_id): 5})
+    assert response.status_code == 200
+    assert response.get_json() == {"progress": {str(item_id): 5}}
+    assert progress(client, client_id, item_id=item_id, offset=3).get_json() == {"progress": {str(item_id): 5}}
+
+    latest = client.get("/latest", query_string={"key": KEY, "client_id": client_id})
+    assert latest.headers["X-Typed-Offset"] == "5"
+
+
+def test_progress_form_fields(client, client_id):
+    [item_id] = submit(client, client_id, "hello")
+    response = client.post("/progress", data={"key": KEY, "client_id": client_id, "item_id": item_id, "offset": 2})
+    assert response.get_json() == {"progress": {str(item_id): 2}}
+
+
+@pytest.mark.parametrize("body", [[1, 2], "offsets", 7, None])
+def test_progress_body_must_be_an_object(client, client_id, body):
+    response = client.post("/progress", query_string={"key": KEY, "client_id": client_id}, json=body)
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("body", [{"item_id": "x", "offset": 1}, {"item_id": 1, "offset": -1}, {},
+                                  {"offsets": {"1": "many"}}])
+def test_malformed_progress(client, client_id, body):
+    assert progress(client, client_id, **body).status_code == 400
+
+
+def test_interrupt_parks_and_resume_continues(client, client_id):
+    [item_id] = submit(client, client_id, "long text to type")
+    progress(client, client_id, item_id=item_id, offset=4)
+
+    response = client.post("/interrupt_acknowledge", data={"key": KEY, "client_id": client_id, "resume": 1})
+    assert response.get_json() == {"parked": [{"id": item_id, "typed": 4}]}
+    latest = client.get("/latest", query_string={"key": KEY, "client_id": client_id})
+    assert latest.status_code != 200 or latest.headers.get("X-Item-Id") != str(item_id)
+
+    response = client.post("/resume", data={"key": KEY, "client_id": client_id})
+    assert response.status_code == 200
+    latest = client.get("/latest", query_string={"key": KEY, "client_id": client_id})
+    assert latest.headers["X-Item-Id"] == str(item_id)
+    assert latest.headers["X-Typed-Offset"] == "4"
+
+
+def test_interrupt_without_resume_removes_the_item(client, client_id):
+    [item_id] = submit(client, client_id, "dropped")
+    response = client.post("/interrupt_acknowledge", data={"key": KEY, "client_id": client_id, "id": item_id})
+    assert response.get_json() == {"interrupted": [item_id]}
+    items = client.get("/items", query_string={"key": KEY, "client_id": client_id}).get_json()["items"]
+    assert items[0]["outcome"] == "interrupted"
+    assert client.post("/resume", data={"key": KEY, "client_id": client_id, "from": 1, "to": 2}).status_code == 400
@@ -0,0 +1,48 @@
+import pytest
+
+from conftest import KEY
+
+
+@pytest.fixture(autouse=True)
+def empty_queue(server, client, monkeypatch):
+    monkeypatch.setattr(server.state, "submit_window", 3)
+    client.post("/clear_queue", data={"key": KEY})
+    yield
+    client.post("/clear_queue", data={"key": KEY})
+
+
+def test_batch_submit_is_consumed_in_order(client):
+    response = client.post("/submit", json={"items": ["one", "two", "three"]})
+    assert response.status_code == 200
+    ids = response.get_json()["ids"]
+    assert ids == sorted(ids)
+
+    latest = client.get(f"/latest?key={KEY}")
+    assert latest.data == b"one"
+    assert latest.headers["X-Item-Id"] == str(ids[0])
+
+    items = client.get(f"/next?key={KEY}&n=5&after={ids[0]}").get_json()["items"]
+    assert [item["content"] for item in items] == ["two", "three"]
+
+    acked = client.post("/acknowledge", data={"key": KEY, "from": ids[0], "to": ids[1]}).get_json()
+    assert acked == {"acknowledged": ids[:2]}
+    assert client.get(f"/latest?key={KEY}").data == b"three"
+
+
+def test_window_locks_further_submissions(client):
+    assert client.post("/submit", json={"items": ["a", "b", "c"]}).status_code == 200
+    assert client.post("/submit", json={"items": ["d"]}).status_code == 403
+    client.post("/acknowledge", data={"key": KEY})
+    assert client.post("/submit", json={"items": ["d"]}).status_code == 200
+
+
+@pytest.mark.parametrize("body", [["a", "b"], {"items": "abc"}, {"items": None}, {"content": "a"}, "a"])
+def test_submit_rejects_malformed_json(client, body):
+    response = client.post("/submit", json=body)
+    assert response.status_code == 400
+    assert client.get(f"/latest?key={KEY}").status_code == 404
+
+
+def test_malformed_ack_ids(client):
+    client.post("/submit", json={"items": ["a"]})
+    assert client.post("/acknowledge", data={"key": KEY, "ids": "1,x"}).status_code == 400
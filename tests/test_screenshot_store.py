@@ -0,0 +1,88 @@
+import time
+
+import pytest
+
+from conftest import KEY
+from screenshot_store import ScreenshotTooLarge, create_screenshot_store
+
+
+@pytest.fixture(params=["memory", "disk"])
+def make_store(request, tmp_path):
+    def make(**limits):
+        return create_screenshot_store(request.param, root=str(tmp_path / "shots"), **limits)
+    return make
+
+
+def test_add_and_read(make_store):
+    store = make_store()
+    entry = store.add([b"ab", b"cd"], "t1")
+    assert entry["size"] == 4
+    assert store.read(entry["id"]) == b"abcd"
+    assert store.open(entry["id"]).read() == b"abcd"
+    assert [e["id"] for e in store.recent(5)] == [entry["id"]]
+
+
+def test_count_limit_evicts_least_recently_used(make_store):
+    store = make_store(max_count=2)
+    first = store.add([b"1"], "t1")
+    second = store.add([b"2"], "t2")
+    store.read(first["id"])
+    store.add([b"3"], "t3")
+    assert store.get(first["id"]) is not None
+    assert store.get(second["id"]) is None
+    assert len(store) == 2
+
+
+def test_byte_limit_evicts_until_within_budget(make_store):
+    store = make_store(max_bytes=10)
+    for n in range(3):
+        store.add([str(n).encode() * 4], f"t{n}")
+    assert len(store) == 2
+    assert store.total_bytes == 8
+
+
+def test_age_limit_drops_old_entries(make_store, monkeypatch):
+    store = make_store(max_age=60)
+    entry = store.add([b"old"], "t1")
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    assert store.get(entry["id"]) is None
+    assert len(store) == 0
+
+
+def test_oversized_upload_stops_reading(make_store):
+    store = make_store(max_bytes=8)
+    consumed = []
+
+    def chunks():
+        for i in range(100):
+            consumed.append(i)
+            yield b"x" * 4
+
+    with pytest.raises(ScreenshotTooLarge):
+        store.add(chunks(), "t1")
+    assert len(consumed) == 3
+    assert len(store) == 0
+    assert store.total_bytes == 0
+
+
+def test_disk_store_reloads_index(tmp_path):
+    root = str(tmp_path / "shots")
+    store = create_screenshot_store("disk", root=root)
+    kept = store.add([b"keep"], "t1")
+    dropped = store.add([b"drop"], "t2")
+    store.remove(dropped["id"])
+
+    reopened = create_screenshot_store("disk", root=root)
+    assert reopened.read(kept["id"]) == b"keep"
+    assert reopened.get(dropped["id"]) is None
+
+
+def test_raw_upload_over_budget_is_refused(server, client, monkeypatch):
+    store = server.screenshot_store_for("default")
+    monkeypatch.setattr(store, "max_bytes", 16)
+    before = len(store)
+    response = client.post(f"/upload_screenshot?key={KEY}", data=b"x" * 64,
+                           content_type="application/octet-stream")
+    assert response.status_code == 413
+    assert len(store) == before
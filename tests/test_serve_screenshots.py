@@ -0,0 +1,59 @@
+import io
+
+import pytest
+
+from conftest import KEY
+
+
+def png_bytes(size=(64, 48)):
+    Image = pytest.importorskip("PIL.Image")
+    out = io.BytesIO()
+    Image.new("RGB", size, (200, 40, 40)).save(out, format="PNG")
+    return out.getvalue()
+
+
+def upload(server, client, image):
+    response = client.post(f"/upload_screenshot?key={KEY}", data=image,
+                           content_type="application/octet-stream")
+    assert response.status_code == 200
+    return server.screenshot_store_for("default").recent(1)[0]
+
+
+def test_serves_original_with_cache_headers(server, client):
+    image = png_bytes()
+    entry = upload(server, client, image)
+
+    response = client.get(f"/screenshots/{entry['id']}?key={KEY}")
+    assert response.status_code == 200
+    assert response.data == image
+    assert response.mimetype == "image/png"
+    assert response.headers["ETag"] == f'"{entry["sha256"]}-full"'
+    assert "Last-Modified" in response.headers
+    assert "private" in response.headers["Cache-Control"]
+    assert "immutable" in response.headers["Cache-Control"]
+
+
+def test_conditional_request_gets_304(server, client):
+    entry = upload(server, client, png_bytes())
+    etag = client.get(f"/screenshots/{entry['id']}?key={KEY}").headers["ETag"]
+
+    response = client.get(f"/screenshots/{entry['id']}?key={KEY}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_thumbnail_is_a_small_jpeg(server, client):
+    Image = pytest.importorskip("PIL.Image")
+    entry = upload(server, client, png_bytes((1000, 800)))
+
+    response = client.get(f"/screenshots/{entry['id']}/thumb?key={KEY}")
+    assert response.status_code == 200
+    assert response.mimetype == "image/jpeg"
+    with Image.open(io.BytesIO(response.data)) as thumb:
+        assert max(thumb.size) <= server.THUMBNAIL_SIZE
+
+
+def test_unknown_id_and_bad_key(server, client):
+    entry = upload(server, client, png_bytes())
+    assert client.get(f"/screenshots/{entry['id']}?key=wrong").status_code == 403
+    assert client.get(f"/screenshots/999999?key={KEY}").status_code == 404
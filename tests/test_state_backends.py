@@ -0,0 +1,169 @@
+import pytest
+
+from state_backend import InProcessStateBackend, SQLiteStateBackend, UnknownClient
+
+TIME_FIELDS = {"registered_at", "submitted", "finished"}
+
+
+def without_times(value):
+    if isinstance(value, dict):
+        return {key: without_times(item) for key, item in value.items() if key not in TIME_FIELDS}
+    if isinstance(value, (list, tuple)):
+        return type(value)(without_times(item) for item in value)
+    return value
+
+
+def make_backend(kind, tmp_path, **options):
+    if kind == "memory":
+        return InProcessStateBackend(**options)
+    return SQLiteStateBackend(str(tmp_path / "state.db"), poll_interval=0.01, **options)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    backend = make_backend(request.param, tmp_path)
+    backend.register_client("c")
+    return backend
+
+
+def scenario(backend):
+    """Drive the queue through batches, the window, acknowledge and capture schedules; collect every result."""
+    backend.register_client("c", name="Client C")
+    seen = [backend.clients()]
+    seen.append(backend.submit("c", ["first", "second"]))
+    seen.append(backend.submit("c", ["refused while locked"]))
+    seen.append(backend.status("c"))
+    seen.append(backend.head("c"))
+    seen.append(backend.next_items("c", 10, after=1))
+    seen.append(backend.acknowledge("c"))
+    seen.append(backend.submit("c", ["third"]))
+    seen.append(backend.recent("c", 5))
+    seen.append(backend.queue_size("c"))
+    seen.append(backend.acknowledge("c", ids=[3], id_range=(1, 2)))
+    seen.append(backend.submit("c", ["fourth"]))
+    seen.append(backend.unlock("c"))
+    seen.append(backend.clear_queue("c"))
+    backend.set_kill_switch("c", True)
+    backend.request_capture("c")
+    seen.append(backend.take_capture_request("c"))
+    seen.append(backend.take_capture_request("c"))
+    seen.append(backend.status("c"))
+    schedule = backend.add_capture_schedule("c", count=2, interval=1.0, start=100.0)
+    seen.append(schedule)
+    seen.append(backend.fulfil_capture("c", schedule["id"], 1, 0.5))
+    seen.append(backend.fulfil_capture("c", schedule["id"], 1, 0.5))
+    seen.append(backend.capture_schedules("c"))
+    seen.append(backend.stop_capture_schedules("c"))
+    items = backend.submit("c", ["fifth", "sixth"])
+    seen.append(backend.report_progress("c", {items[0]["id"]: 3, 999: 1}))
+    seen.append(backend.report_progress("c", {items[0]["id"]: 2}))
+    seen.append(backend.park("c", ids=[items[0]["id"]]))
+    seen.append(backend.status("c"))
+    seen.append(backend.head("c"))
+    seen.append(backend.resume("c"))
+    seen.append(backend.next_items("c", 5))
+    seen.append(backend.content_history("c", limit=3))
+    seen.append(backend.content_history("c", before=3))
+    seen.append(backend.status("default"))
+    return without_times(seen)
+
+
+def test_backends_agree(tmp_path):
+    memory = make_backend("memory", tmp_path, submit_window=2)
+    sqlite = make_backend("sqlite", tmp_path, submit_window=2)
+    assert scenario(memory) == scenario(sqlite)
+
+
+def test_unknown_client(backend):
+    with pytest.raises(UnknownClient):
+        backend.status("nobody")
+    with pytest.raises(UnknownClient):
+        backend.publish("nobody", "content")
+
+
+def test_submit_window(backend):
+    assert [item["content"] for item in backend.submit("c", ["a"])] == ["a"]
+    assert backend.submit("c", ["b"]) is None
+    backend.acknowledge("c")
+    assert [item["content"] for item in backend.next_items("c", 5)] == []
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_queue_is_fifo(kind, tmp_path):
+    backend = make_backend(kind, tmp_path, submit_window=3)
+    backend.register_client("c")
+    items = backend.submit("c", ["a", "b", "c"])
+    assert [item["id"] for item in items] == [1, 2, 3]
+    assert backend.head("c") == {**items[0], "typed": 0}
+    assert backend.acknowledge("c") == [items[0]]
+    assert [(item["id"], item["content"]) for item in backend.next_items("c", 5)] == [(2, "b"), (3, "c")]
+
+
+def test_clients_are_isolated(backend):
+    backend.register_client("d")
+    backend.submit("c", ["for c"])
+    backend.set_kill_switch("d", True)
+    assert backend.head("d") is None
+    assert not backend.status("c")["kill_switch"]
+    assert backend.status("d")["kill_switch"]
+
+
+def test_changes_bump_the_version(backend):
+    version = backend.version("c")
+    backend.submit("c", ["a"])
+    assert backend.version("c") > version
+    version = backend.version("c")
+    backend.touch("c")
+    assert backend.wait_for_version("c", version, 1) > version
+    assert backend.wait_for_version("c", backend.version("c"), 0) == backend.version("c")
+
+
+def test_snapshot_consumes_capture_request(backend):
+    backend.request_capture("c")
+    snapshot = backend.subscribe_snapshot("c")
+    assert snapshot["capture_requested"]
+    assert not backend.take_capture_request("c")
+
+
+def test_events_resume_from_a_cursor(backend):
+    last_id = backend.subscribe_snapshot("c")["last_event_id"]
+    assert backend.events_resumable("c", last_id)
+    assert backend.wait_for_events("c", last_id, 0) == []
+
+    backend.publish("c", "kill_switch", {"active": True})
+    backend.publish("c", "content", {"id": 1})
+    events = backend.wait_for_events("c", last_id, 1)
+    assert [(event["type"], event["data"]) for event in events] == [
+        ("kill_switch", {"active": True}),
+        ("content", {"id": 1}),
+    ]
+    assert events[0]["id"] > last_id
+    assert backend.wait_for_events("c", events[0]["id"], 1) == events[1:]
+    assert backend.events_resumable("c", events[-1]["id"])
+    assert not backend.events_resumable("c", events[-1]["id"] + 1)
+
+
+def test_event_cursor_from_before_a_restart_is_stale(tmp_path):
+    backend = InProcessStateBackend(journal_dir=str(tmp_path))
+    backend.register_client("c")
+    backend.publish("c", "content", {"id": 1})
+    cursor = backend.wait_for_events("c", 0, 0)[-1]["id"]
+    backend.set_kill_switch("c", True)
+    backend._journal.close()
+
+    restarted = InProcessStateBackend(journal_dir=str(tmp_path))
+    assert not restarted.events_resumable("c", cursor)
+    snapshot = restarted.subscribe_snapshot("c")
+    assert snapshot["kill_switch"]
+    assert restarted.events_resumable("c", snapshot["last_event_id"])
+    restarted._journal.close()
+
+
+def test_pruned_events_are_not_resumable():
+    backend = InProcessStateBackend(event_history=2)
+    backend.register_client("c")
+    cursor = backend.subscribe_snapshot("c")["last_event_id"]
+    for n in range(3):
+        backend.publish("c", "content", {"id": n})
+    assert not backend.events_resumable("c", cursor)
+    assert backend.events_resumable("c", cursor + 1)
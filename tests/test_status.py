@@ -0,0 +1,66 @@
+import threading
+import time
+
+import pytest
+
+from conftest import KEY
+
+
+def current(client, path="/status"):
+    response = client.get(f"{path}?key={KEY}")
+    assert response.status_code == 200
+    return response
+
+
+def test_status_carries_version_etag(client):
+    response = current(client)
+    version = response.get_json()["version"]
+    assert response.headers["ETag"] == f'"{version}"'
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    again = client.get(f"/status?key={KEY}", headers={"If-None-Match": response.headers["ETag"]})
+    assert again.status_code == 304
+
+
+def test_change_moves_the_version(client):
+    version = current(client).get_json()["version"]
+    client.post("/activate_kill_switch", data={"key": KEY})
+    client.post("/deactivate_kill_switch", data={"key": KEY})
+    assert current(client).get_json()["version"] > version
+
+
+def test_since_current_version_times_out_with_304(client):
+    version = current(client).get_json()["version"]
+    started = time.monotonic()
+    response = client.get(f"/status?key={KEY}&since={version}&timeout=0.2")
+    assert response.status_code == 304
+    assert 0.15 <= time.monotonic() - started < 5
+
+
+def test_since_older_version_returns_at_once(client):
+    version = current(client).get_json()["version"]
+    response = client.get(f"/status?key={KEY}&since={version - 1}&timeout=10")
+    assert response.status_code == 200
+    assert response.get_json()["version"] == version
+
+
+def test_since_wakes_on_change(server, client):
+    version = current(client).get_json()["version"]
+    timer = threading.Timer(0.2, server.state.touch, ["default"])
+    timer.start()
+    try:
+        response = client.get(f"/status?key={KEY}&since={version}&timeout=10")
+    finally:
+        timer.join()
+    assert response.status_code == 200
+    assert response.get_json()["version"] > version
+
+
+@pytest.mark.parametrize("path", ["/status", "/dashboard/state"])
+@pytest.mark.parametrize("query", ["since=abc", "timeout=nan", "timeout=inf", "timeout=-inf", "timeout=x"])
+def test_malformed_since_or_timeout(client, path, query):
+    version = current(client).get_json()["version"]
+    if not query.startswith("since="):
+        query = f"since={version}&{query}"
+    response = client.get(f"{path}?key={KEY}&{query}")
+    assert response.status_code == 400
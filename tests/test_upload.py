@@ -0,0 +1,70 @@
+import base64
+import io
+
+import pytest
+
+from conftest import KEY
+
+IMAGE = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 64
+
+
+def screenshot_count(client):
+    return client.get(f"/status?key={KEY}").get_json()["screenshot_count"]
+
+
+def test_raw_upload(client):
+    before = screenshot_count(client)
+    response = client.post(f"/upload_screenshot?key={KEY}&timestamp=2024-01-01T00:00:00", data=IMAGE,
+                           content_type="application/octet-stream")
+    assert response.status_code == 200
+    response = client.post("/upload_screenshot", data=IMAGE, content_type="application/octet-stream",
+                           headers={"X-Key": KEY, "X-Timestamp": "2024-01-01T00:00:01"})
+    assert response.status_code == 200
+    assert screenshot_count(client) == before + 2
+
+
+def test_multipart_upload(client):
+    before = screenshot_count(client)
+    response = client.post("/upload_screenshot", data={
+        "key": KEY,
+        "timestamp": "2024-01-01T00:00:00",
+        "screenshot": (io.BytesIO(IMAGE), "screen.png"),
+    }, content_type="multipart/form-data")
+    assert response.status_code == 200
+    assert screenshot_count(client) == before + 1
+
+
+def test_json_upload(client):
+    before = screenshot_count(client)
+    response = client.post("/upload_screenshot", json={"key": KEY, "screenshot": base64.b64encode(IMAGE).decode()})
+    assert response.status_code == 200
+    assert screenshot_count(client) == before + 1
+
+
+def test_invalid_key(client):
+    response = client.post("/upload_screenshot?key=wrong", data=IMAGE, content_type="application/octet-stream")
+    assert response.status_code == 403
+
+
+def test_empty_bodies(client):
+    assert client.post(f"/upload_screenshot?key={KEY}", data=b"",
+                       content_type="application/octet-stream").status_code == 400
+    assert client.post("/upload_screenshot", data={"key": KEY},
+                       content_type="multipart/form-data").status_code == 400
+
+
+@pytest.mark.parametrize("body", [
+    [KEY],
+    "not an object",
+    {"key": KEY},
+    {"key": KEY, "screenshot": "not base64!"},
+    {"key": KEY, "screenshot": "abc"},
+    {"key": KEY, "screenshot": "===="},
+    {"key": KEY, "screenshot": 12},
+])
+def test_malformed_json_upload(client, body):
+    before = screenshot_count(client)
+    # A body that is not an object cannot carry the key
+    headers = {} if isinstance(body, dict) else {"X-Key": KEY}
+    assert client.post("/upload_screenshot", json=body, headers=headers).status_code == 400
+    assert screenshot_count(client) == before